@@ -3,7 +3,7 @@
 
 {
     'name': 'Account Invoice Import',
-    'version': '12.0.1.0.0',
+    'version': '12.0.1.1.0',
     'category': 'Accounting & Finance',
     'license': 'AGPL-3',
     'summary': 'Import supplier invoices/refunds as PDF or XML files',
@@ -19,6 +19,8 @@
         'security/ir.model.access.csv',
         'security/rule.xml',
         'views/account_invoice_import_config.xml',
+        'views/account_invoice_import_job.xml',
+        'data/ir_cron.xml',
         'views/res_config_settings.xml',
         'wizard/account_invoice_import_view.xml',
         'views/account_invoice.xml',
@@ -3,3 +3,9 @@ from . import company
 from . import res_config_settings
 from . import account_invoice_import_config
 from . import account_invoice
+from . import account_invoice_import_job
+from . import account_invoice_import_ledger
+from . import account_fiscal_position
+from . import account_payment_term
+from . import res_partner_bank
+from . import ir_property
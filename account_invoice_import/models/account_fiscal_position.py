@@ -0,0 +1,40 @@
+# Copyright 2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+
+# Fields read by account.fiscal.position.get_fiscal_position()
+FISCAL_POSITION_ONCHANGE_FIELDS = [
+    'auto_apply', 'active', 'company_id', 'sequence', 'vat_required',
+    'country_id', 'country_group_id', 'state_ids', 'zip_from', 'zip_to']
+
+
+class AccountFiscalPosition(models.Model):
+    _inherit = 'account.fiscal.position'
+
+    # Invalidate account.invoice.import._get_partner_onchange_vals(): a
+    # fiscal position that is not set on the partner is only selected by
+    # get_fiscal_position() when it is applied automatically
+    @api.model
+    def create(self, vals):
+        fiscal_position = super().create(vals)
+        if fiscal_position.auto_apply:
+            self.env[
+                'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return fiscal_position
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if any(field in vals for field in FISCAL_POSITION_ONCHANGE_FIELDS):
+            self.env[
+                'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self.env[
+            'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return res
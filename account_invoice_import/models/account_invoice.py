@@ -1,12 +1,44 @@
 # © 2015-2016 Akretion (Alexis de Lattre <alexis.delattre@akretion.com>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import models, api, _
+from odoo import models, fields, api, _
+from odoo.tools.sql import create_index, index_exists
+
+
+def normalize_invoice_reference(reference):
+    '''Supplier invoice number without spaces and in upper case, used to
+    detect the invoices that have already been imported'''
+    if not reference:
+        return False
+    return ''.join(reference.split()).upper() or False
 
 
 class AccountInvoice(models.Model):
     _inherit = 'account.invoice'
 
+    reference_normalized = fields.Char(
+        compute='_compute_reference_normalized', store=True, readonly=True,
+        string='Normalized Vendor Reference')
+    import_match_trace = fields.Text(
+        string='Import Match Trace', readonly=True, copy=False,
+        help="JSON trace of the matching of the imported invoice file: "
+        "for each match, the strategy used, the number of SQL queries "
+        "and the time spent (in seconds).")
+
+    @api.model_cr
+    def init(self):
+        index_name = 'account_invoice_import_duplicate_index'
+        if not index_exists(self.env.cr, index_name):
+            create_index(self.env.cr, index_name, self._table, [
+                'company_id', 'commercial_partner_id', 'type',
+                'reference_normalized'])
+
+    @api.depends('reference')
+    def _compute_reference_normalized(self):
+        for inv in self:
+            inv.reference_normalized = normalize_invoice_reference(
+                inv.reference)
+
     @api.multi
     def name_get(self):
         """Add amount_untaxed in name_get of invoices"""
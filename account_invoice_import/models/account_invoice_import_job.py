@@ -0,0 +1,167 @@
+# Copyright 2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.tools import config
+from datetime import timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AccountInvoiceImportJob(models.Model):
+    _name = 'account.invoice.import.job'
+    _description = 'Background import of a supplier invoice file'
+    _order = 'id desc'
+    _rec_name = 'invoice_filename'
+
+    invoice_file = fields.Binary(
+        string='PDF or XML Invoice', required=True, attachment=True)
+    invoice_filename = fields.Char(string='Filename', required=True)
+    company_id = fields.Many2one(
+        'res.company', required=True, ondelete='cascade',
+        default=lambda self: self.env['res.company']._company_default_get(
+            'account.invoice.import.job'))
+    import_config_id = fields.Many2one(
+        'account.invoice.import.config',
+        string='Invoice Import Configuration', ondelete='set null',
+        help="If empty, the first invoice import configuration of the "
+        "supplier is used.")
+    origin = fields.Char()
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], default='pending', required=True, readonly=True, index=True)
+    attempts = fields.Integer(readonly=True)
+    max_attempts = fields.Integer(string='Maximum Attempts', default=3)
+    error = fields.Text(readonly=True)
+    invoice_id = fields.Many2one(
+        'account.invoice', string='Invoice', readonly=True,
+        ondelete='set null')
+    date_started = fields.Datetime(
+        string='Date Started', readonly=True,
+        help="Start date of the last attempt")
+    date_done = fields.Datetime(readonly=True)
+
+    @api.multi
+    def run(self):
+        """Import the invoice file of the jobs, in the transaction of the
+        request (button Run Now). A failed import doesn't stop
+        the other jobs: the job goes back to pending (the cron will retry
+        it) until its maximum number of attempts is reached"""
+        for job in self:
+            job._run_one()
+        return True
+
+    @api.multi
+    def _run_one(self, commit=False):
+        self.ensure_one()
+        self.write({
+            'state': 'running',
+            'attempts': self.attempts + 1,
+            'date_started': fields.Datetime.now(),
+            })
+        # In the cron, the claim of the job is committed before the import:
+        # if the worker is killed during the import (time or memory limit),
+        # the attempt is counted and the job stays 'running' until
+        # _reset_stuck_jobs() processes it
+        if commit and not config['test_enable']:
+            self.env.cr.commit()
+        # Run the import with the user who created the job, as the
+        # wizard would have done
+        aiio = self.env['account.invoice.import'].sudo(
+            self.create_uid.id).with_context(force_company=self.company_id.id)
+        import_config = None
+        if self.import_config_id:
+            import_config = self.import_config_id.sudo(
+                self.create_uid.id).convert_to_import_config()
+        try:
+            with self.env.cr.savepoint():
+                invoice = aiio._import_invoice_unattended(
+                    self.invoice_file, self.invoice_filename,
+                    import_config=import_config)
+                invoice.message_post(body=_(
+                    "This invoice has been created automatically via the "
+                    "background import of file %s (origin: %s)") % (
+                        self.invoice_filename, self.origin or _('none')))
+        except Exception as e:
+            error = isinstance(e, UserError) and e.name or str(e)
+            logger.warning(
+                'Invoice import job ID %d (file %s) failed (attempt %d/%d): '
+                '%s', self.id, self.invoice_filename, self.attempts,
+                self.max_attempts, error)
+            self.write({
+                'state':
+                self.attempts >= self.max_attempts and 'failed' or 'pending',
+                'error': error,
+                })
+        else:
+            logger.info(
+                'Invoice import job ID %d: invoice ID %d created',
+                self.id, invoice.id)
+            self.write({
+                'state': 'done',
+                'invoice_id': invoice.id,
+                'error': False,
+                'date_done': fields.Datetime.now(),
+                })
+
+    @api.multi
+    def requeue(self):
+        self.write({'state': 'pending', 'attempts': 0, 'error': False})
+        return True
+
+    @api.model
+    def _reset_stuck_jobs(self):
+        """The jobs that are running for longer than the number of minutes
+        of the system parameter account_invoice_import.job_timeout have
+        been interrupted (worker killed, server restart...): they go back
+        to pending, or to failed when they have reached their maximum
+        number of attempts"""
+        timeout = int(self.env['ir.config_parameter'].sudo().get_param(
+            'account_invoice_import.job_timeout', 60))
+        jobs = self.search([
+            ('state', '=', 'running'),
+            ('date_started', '<',
+             fields.Datetime.now() - timedelta(minutes=timeout)),
+            ])
+        for job in jobs:
+            logger.warning(
+                'Invoice import job ID %d (file %s) is running for more '
+                'than %d minutes (attempt %d/%d): considered as failed',
+                job.id, job.invoice_filename, timeout, job.attempts,
+                job.max_attempts)
+            job.write({
+                'state':
+                job.attempts >= job.max_attempts and 'failed' or 'pending',
+                'error': _(
+                    "The import didn't finish within %d minutes.") % timeout,
+                })
+
+    @api.model
+    def _cron_run_jobs(self, limit=50):
+        """Run up to limit pending jobs, with one transaction per job.
+        The job is locked with SKIP LOCKED, so several workers can run
+        this cron at the same time without processing the same job."""
+        self._reset_stuck_jobs()
+        done_ids = [0]
+        for i in range(limit):
+            self.env.cr.execute("""
+                SELECT id FROM account_invoice_import_job
+                WHERE state = 'pending' AND NOT (id = ANY(%s))
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+                """, (done_ids, ))
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+            self.browse(row[0])._run_one(commit=True)
+            done_ids.append(row[0])
+            if not config['test_enable']:
+                self.env.cr.commit()
+        return True
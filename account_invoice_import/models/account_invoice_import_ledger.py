@@ -0,0 +1,32 @@
+# Copyright 2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, fields, models
+
+
+class AccountInvoiceImportLedger(models.Model):
+    _name = 'account.invoice.import.ledger'
+    _description = 'Imported invoice files'
+    _order = 'id desc'
+    _rec_name = 'file_hash'
+
+    file_hash = fields.Char(
+        string='SHA-256', required=True, readonly=True, index=True,
+        help="SHA-256 of the content of the imported file")
+    invoice_filename = fields.Char(string='Filename', readonly=True)
+    invoice_id = fields.Many2one(
+        'account.invoice', string='Invoice', required=True, readonly=True,
+        ondelete='cascade')
+    company_id = fields.Many2one(
+        'res.company', required=True, readonly=True, ondelete='cascade')
+
+    @api.model
+    def _get_invoice(self, file_hash, company_id):
+        '''Returns the invoice created or updated by the import of a file
+        with the same content (empty recordset if there are none)'''
+        entry = self.sudo().search([
+            ('file_hash', '=', file_hash),
+            ('company_id', '=', company_id),
+            ], limit=1)
+        return self.env['account.invoice'].browse(entry.invoice_id.id)
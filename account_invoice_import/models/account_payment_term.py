@@ -0,0 +1,19 @@
+# Copyright 2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+
+
+class AccountPaymentTerm(models.Model):
+    _inherit = 'account.payment.term'
+
+    # Invalidate account.invoice.import._get_partner_onchange_vals(),
+    # which only returns the ID of the payment term of the partner (the
+    # due date is computed outside of the cache)
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self.env[
+            'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return res
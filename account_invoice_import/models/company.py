@@ -20,6 +20,17 @@ class ResCompany(models.Model):
         "invoices received by the mail gateway in the appropriate company")
     invoice_import_create_bank_account = fields.Boolean(
         string='Auto-create Bank Account of Supplier')
+    invoice_import_match_trace = fields.Boolean(
+        string='Trace Matching of Imported Invoices',
+        help="If enabled, the strategy used to match the partner, the "
+        "products, the taxes... of the imported invoices, with the number "
+        "of SQL queries and the time spent, is stored on the invoice "
+        "(visible in debug mode).")
+    invoice_import_background = fields.Boolean(
+        string='Import Invoices in Background',
+        help="If enabled, the import wizard and the mail gateway create "
+        "an invoice import job that is processed by a scheduled action, "
+        "instead of importing the invoice immediately.")
 
     _sql_constraints = [(
         'invoice_import_email_uniq',
@@ -0,0 +1,47 @@
+# Copyright 2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+from .partner import PARTNER_ONCHANGE_PROPERTIES
+
+
+class IrProperty(models.Model):
+    _inherit = 'ir.property'
+
+    # The accounts, the payment terms and the fiscal position of the
+    # partners are company dependent fields, stored as ir.property: the
+    # default values don't go through res.partner.write()
+    @api.multi
+    def _is_partner_property(self):
+        return any(
+            prop.fields_id.model == 'res.partner' and
+            prop.fields_id.name in PARTNER_ONCHANGE_PROPERTIES
+            for prop in self.sudo())
+
+    # Invalidate account.invoice.import._get_partner_onchange_vals()
+    @api.model
+    def create(self, vals):
+        prop = super().create(vals)
+        if prop._is_partner_property():
+            self.env[
+                'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return prop
+
+    @api.multi
+    def write(self, vals):
+        partner_property = self._is_partner_property()
+        res = super().write(vals)
+        if partner_property or self._is_partner_property():
+            self.env[
+                'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return res
+
+    @api.multi
+    def unlink(self):
+        partner_property = self._is_partner_property()
+        res = super().unlink()
+        if partner_property:
+            self.env[
+                'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return res
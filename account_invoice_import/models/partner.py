@@ -1,7 +1,22 @@
 # © 2015-2017 Akretion (Alexis de Lattre <alexis.delattre@akretion.com>)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import fields, models
+from odoo import api, fields, models
+
+# Fields read by the onchange of the partner of the invoice, whose result
+# is cached by account.invoice.import._get_partner_onchange_vals()
+PARTNER_ONCHANGE_FIELDS = [
+    'parent_id', 'child_ids', 'type', 'is_company', 'company_id', 'active',
+    'country_id', 'state_id', 'zip', 'vat', 'bank_ids',
+    'property_account_payable_id', 'property_account_receivable_id',
+    'property_payment_term_id', 'property_supplier_payment_term_id',
+    'property_account_position_id', 'invoice_warn', 'invoice_warn_msg']
+# Company dependent fields of the partner (stored as ir.property) read by
+# this onchange
+PARTNER_ONCHANGE_PROPERTIES = [
+    'property_account_payable_id', 'property_account_receivable_id',
+    'property_payment_term_id', 'property_supplier_payment_term_id',
+    'property_account_position_id']
 
 
 class ResPartner(models.Model):
@@ -23,3 +38,11 @@ class ResPartner(models.Model):
             for config in config_data])
         for partner in self:
             partner.invoice_import_count = mapped_data.get(partner.id, 0)
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if any(field in vals for field in PARTNER_ONCHANGE_FIELDS):
+            self.env[
+                'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return res
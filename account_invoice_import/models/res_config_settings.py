@@ -16,3 +16,7 @@ class AccountConfigSettings(models.TransientModel):
     invoice_import_create_bank_account = fields.Boolean(
         related='company_id.invoice_import_create_bank_account',
         readonly=False)
+    invoice_import_match_trace = fields.Boolean(
+        related='company_id.invoice_import_match_trace', readonly=False)
+    invoice_import_background = fields.Boolean(
+        related='company_id.invoice_import_background', readonly=False)
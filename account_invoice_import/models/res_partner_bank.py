@@ -0,0 +1,35 @@
+# Copyright 2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+
+
+class ResPartnerBank(models.Model):
+    _inherit = 'res.partner.bank'
+
+    # Invalidate account.invoice.import._get_partner_onchange_vals(),
+    # which reads the first bank account of the partner
+    @api.model
+    def create(self, vals):
+        partner_bank = super().create(vals)
+        self.env[
+            'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return partner_bank
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if any(
+                field in vals
+                for field in ['partner_id', 'sequence', 'company_id']):
+            self.env[
+                'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self.env[
+            'account.invoice.import']._clear_partner_onchange_vals_cache()
+        return res
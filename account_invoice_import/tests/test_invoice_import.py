@@ -2,7 +2,19 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
 from odoo.tests.common import TransactionCase
-from odoo.tools import float_compare
+from odoo.addons.account_invoice_import.wizard.account_invoice_import import\
+    ParsedInvoiceCache, compile_xpath, BATCH_CACHE_KEY
+from odoo.addons.base_business_document_import.models.\
+    business_document_import import MATCH_TRACE_KEY
+from unittest import mock
+from lxml import etree
+from odoo import fields
+from odoo.tools import float_compare, config
+from odoo.exceptions import UserError
+from datetime import timedelta
+from collections import namedtuple
+import base64
+import json
 
 
 class TestInvoiceImport(TransactionCase):
@@ -101,6 +113,286 @@ class TestInvoiceImport(TransactionCase):
             self.env['account.invoice.import'].create_invoice(
                 parsed_inv, import_config)
 
+    def test_import_in_invoice_match_trace(self):
+        parsed_inv = {
+            'type': 'in_invoice',
+            'amount_untaxed': 100.0,
+            'amount_total': 101.0,
+            'invoice_number': 'INV-2017-9877',
+            'date_invoice': '2017-08-16',
+            'partner': {
+                'name': 'Wood Corner',
+            },
+            'lines': [{
+                'product': {'code': 'AII-TEST-PRODUCT'},
+                'name': 'Super test product',
+                'qty': 2,
+                'price_unit': 50,
+                'taxes': [{
+                    'amount_type': 'percent',
+                    'amount': 1.0,
+                    'unece_type_code': 'VAT',
+                    'unece_categ_code': 'S',
+                }],
+            }],
+            'match_trace': [],
+        }
+        inv = self.env['account.invoice.import'].create_invoice(
+            parsed_inv, {'invoice_line_method': 'nline_auto_product'})
+        trace = json.loads(inv.import_match_trace)
+        entities = [entry['entity'] for entry in trace]
+        self.assertIn('partner', entities)
+        self.assertIn('product', entities)
+        partner_entry = trace[entities.index('partner')]
+        self.assertEqual(partner_entry['strategy'], 'name')
+        self.assertEqual(partner_entry['res_ids'], [inv.partner_id.id])
+
+    def test_import_in_invoice_onchange_memo(self):
+        aiio = self.env['account.invoice.import']
+        line = {
+            'product': {'code': 'AII-TEST-PRODUCT'},
+            'qty': 1,
+            'price_unit': 25,
+        }
+        parsed_inv = {
+            'type': 'in_invoice',
+            'amount_untaxed': 100.0,
+            'amount_total': 101.0,
+            'invoice_number': 'INV-2017-9879',
+            'date_invoice': '2017-08-16',
+            'partner': {
+                'name': 'Wood Corner',
+            },
+            'lines': [dict(line, name='Line %d' % i) for i in range(4)],
+        }
+        inv = aiio.create_invoice(
+            parsed_inv, {'invoice_line_method': 'nline_auto_product'})
+        self.assertEqual(len(inv.invoice_line_ids), 4)
+        self.assertEqual(
+            inv.invoice_line_ids.mapped('product_id'), self.product)
+        self.assertEqual(
+            inv.invoice_line_ids.mapped('account_id'), self.expense_account)
+        self.assertEqual(
+            inv.invoice_line_ids.mapped('invoice_line_tax_ids'),
+            self.purchase_tax)
+        onchange_memo = {}
+        vals = {
+            'partner_id': inv.partner_id.id,
+            'type': 'in_invoice',
+            'company_id': inv.company_id.id,
+            }
+        aiio._play_product_onchanges(self.product, vals, onchange_memo)
+        aiio._play_product_onchanges(self.product, vals, onchange_memo)
+        self.assertEqual(len(onchange_memo), 1)
+        self.assertEqual(
+            list(onchange_memo.values())[0]['account_id'],
+            self.expense_account.id)
+
+    def test_update_invoice_lines_uom(self):
+        aiio = self.env['account.invoice.import']
+        parsed_inv = {
+            'type': 'in_invoice',
+            'amount_untaxed': 300.0,
+            'amount_total': 303.0,
+            'invoice_number': 'INV-2017-9880',
+            'date_invoice': '2017-08-16',
+            'partner': {
+                'name': 'Wood Corner',
+            },
+            'lines': [{
+                'product': {'code': 'AII-TEST-PRODUCT'},
+                'qty': 12,
+                'price_unit': 25,
+                }],
+        }
+        inv = aiio.create_invoice(
+            parsed_inv, {'invoice_line_method': 'nline_auto_product'})
+        unit = self.env.ref('uom.product_uom_unit')
+        self.assertEqual(inv.invoice_line_ids.uom_id, unit)
+        # Same product, other unit of measure: the line is replaced and
+        # the new line has the imported unit of measure
+        dozen = self.env.ref('uom.product_uom_dozen')
+        update_inv = {
+            'chatter_msg': [],
+            'lines': [{
+                'product': {'code': 'AII-TEST-PRODUCT'},
+                'qty': 1,
+                'price_unit': 300,
+                'uom': {'recordset': dozen},
+                }],
+            }
+        aiio.update_invoice_lines(update_inv, inv, inv.partner_id)
+        self.assertEqual(len(inv.invoice_line_ids), 1)
+        self.assertEqual(inv.invoice_line_ids.uom_id, dozen)
+        self.assertEqual(inv.invoice_line_ids.quantity, 1)
+        # Unit of measure of another category
+        update_inv['lines'][0]['uom'] = {
+            'recordset': self.env.ref('uom.product_uom_kgm')}
+        with self.assertRaises(UserError):
+            aiio.update_invoice_lines(update_inv, inv, inv.partner_id)
+
+    def test_import_context(self):
+        aiio = self.env['account.invoice.import']._with_batch_cache()
+        company = self.env.user.company_id
+        ictx = aiio._get_import_context()
+        self.assertEqual(ictx.company_id, company.id)
+        self.assertEqual(
+            ictx.prec_uom, self.env['decimal.precision'].precision_get(
+                'Product Unit of Measure'))
+        self.assertFalse(ictx.cannot_refund_vat)
+        self.assertEqual(
+            ictx.journal_id('in_invoice'),
+            self.env['account.journal'].search([
+                ('type', '=', 'purchase'),
+                ('company_id', '=', company.id)], limit=1).id)
+        # computed once per batch
+        self.assertIs(aiio._get_import_context(company.id), ictx)
+        with self.assertRaises(AttributeError):
+            ictx.prec_uom = 42
+
+    def test_import_context_once(self):
+        aiio = self.env['account.invoice.import']
+        partner = self.env['res.partner'].create({
+            'name': 'Import Context Supplier',
+            'supplier': True,
+        })
+        config = self.env['account.invoice.import.config'].create({
+            'name': 'Import Context Config',
+            'partner_id': partner.id,
+            'invoice_line_method': '1line_no_product',
+            'account_id': self.expense_account.id,
+            'tax_ids': [(6, 0, [self.purchase_tax.id])],
+        })
+        parsed_inv = {
+            'type': 'in_invoice',
+            'amount_untaxed': 100.0,
+            'amount_total': 101.0,
+            'invoice_number': 'INV-IMPORT-CONTEXT',
+            'date_invoice': '2017-08-16',
+            'currency': {'iso': 'EUR'},
+            'partner': {'name': 'Import Context Supplier'},
+        }
+        wiz = aiio.create({
+            'invoice_file': base64.b64encode(b'%PDF-1.4 import context'),
+            'invoice_filename': 'import_context.pdf',
+            'import_config_id': config.id,
+        })
+        prepare_import_context = type(aiio)._prepare_import_context
+        with mock.patch.object(
+                type(aiio), '_parse_invoice_file', autospec=True,
+                return_value=parsed_inv), mock.patch.object(
+                type(aiio), '_prepare_import_context', autospec=True,
+                side_effect=prepare_import_context) as mocked:
+            action = wiz.create_invoice_action()
+        # parse_invoice() and create_invoice() share the ImportContext
+        self.assertEqual(mocked.call_count, 1)
+        self.assertTrue(action['res_id'])
+        # the mutable objects of the import don't leak in the context of
+        # the created invoice
+        invoice = aiio.create_invoice({
+            'type': 'in_invoice',
+            'amount_untaxed': 100.0,
+            'amount_total': 101.0,
+            'invoice_number': 'INV-IMPORT-CONTEXT-2',
+            'date_invoice': '2017-08-16',
+            'partner': {'name': 'Import Context Supplier'},
+            'match_trace': [],
+        }, config.convert_to_import_config())
+        self.assertNotIn(BATCH_CACHE_KEY, invoice.env.context)
+        self.assertNotIn(MATCH_TRACE_KEY, invoice.env.context)
+
+    def test_partner_onchange_cache(self):
+        aiio = self.env['account.invoice.import']
+        partner = self.env['res.partner'].create({
+            'name': 'Onchange Cache Supplier',
+            'supplier': True,
+            'is_company': True,
+            })
+        company = self.env.user.company_id
+        args = (
+            partner.id, 'in_invoice', company.id, company.currency_id.id,
+            False)
+        res = aiio._get_partner_onchange_vals(*args)
+        self.assertIs(aiio._get_partner_onchange_vals(*args), res)
+        self.assertFalse(res.get('payment_term_id'))
+        self.assertNotIn('date_due', res)
+        # the properties that are not read by the onchange keep the cache
+        bdio = self.env['business.document.import']
+        version = bdio._get_cache_version('partner_onchange')
+        self.env['ir.property'].set_default(
+            'property_account_expense_categ_id', 'product.category',
+            self.expense_account.id, company)
+        self.assertEqual(
+            bdio._get_cache_version('partner_onchange'), version)
+        self.assertIs(aiio._get_partner_onchange_vals(*args), res)
+        # Default value of the company: stored as ir.property only
+        default_term = self.env.ref('account.account_payment_term_15days')
+        self.env['ir.property'].set_default(
+            'property_supplier_payment_term_id', 'res.partner',
+            default_term.id, company)
+        self.assertGreater(
+            bdio._get_cache_version('partner_onchange'), version)
+        res = aiio._get_partner_onchange_vals(*args)
+        self.assertEqual(res['payment_term_id'], default_term.id)
+        payment_term = self.env.ref('account.account_payment_term_immediate')
+        partner.property_supplier_payment_term_id = payment_term.id
+        res = aiio._get_partner_onchange_vals(*args)
+        self.assertEqual(res['payment_term_id'], payment_term.id)
+        # The due date depends on the invoice date, which is not in the key
+        date_due = aiio._get_invoice_date_due({
+            'company_id': company.id,
+            'payment_term_id': default_term.id,
+            'date_invoice': '2017-08-16',
+            })
+        self.assertEqual(
+            fields.Date.to_date(date_due), fields.Date.to_date('2017-08-31'))
+        self.assertFalse(aiio._get_invoice_date_due({
+            'company_id': company.id,
+            'date_invoice': '2017-08-16',
+            }))
+
+    def test_import_ledger(self):
+        aiio = self.env['account.invoice.import']
+        parsed_inv = {
+            'type': 'in_invoice',
+            'amount_untaxed': 100.0,
+            'amount_total': 101.0,
+            'invoice_number': 'inv-2017 9878',
+            'date_invoice': '2017-08-16',
+            'partner': {
+                'name': 'Wood Corner',
+            },
+            'description': 'New hi-tech gadget',
+            'file_hash': 'a' * 64,
+            'file_name': 'inv-2017-9878.pdf',
+        }
+        inv = aiio.create_invoice(parsed_inv, self.all_import_config[0])
+        self.assertEqual(inv.reference_normalized, 'INV-20179878')
+        self.assertEqual(
+            aiio.invoice_already_exists(inv.commercial_partner_id, {
+                'type': 'in_invoice',
+                'invoice_number': ' INV-2017 9878',
+                }), inv)
+        # an invoice without number is not a duplicate of the invoices
+        # without reference
+        inv_noref = inv.copy({'reference': False})
+        self.assertFalse(inv_noref.reference_normalized)
+        for invoice_number in [False, '', ' ']:
+            self.assertFalse(
+                aiio.invoice_already_exists(inv.commercial_partner_id, {
+                    'type': 'in_invoice',
+                    'invoice_number': invoice_number,
+                    }))
+        self.assertEqual(
+            self.env['account.invoice.import.ledger']._get_invoice(
+                'a' * 64, inv.company_id.id), inv)
+        # the draft invoice can be updated by the wizard...
+        aiio._check_invoice_file_not_imported('a' * 64, allow_draft=True)
+        # ... but a file sent again is rejected by the unattended import
+        with self.assertRaises(UserError):
+            aiio._check_invoice_file_not_imported('a' * 64)
+        aiio._check_invoice_file_not_imported('b' * 64)
+
     def test_import_out_invoice(self):
         parsed_inv = {
             'type': 'out_invoice',
@@ -133,3 +425,210 @@ class TestInvoiceImport(TransactionCase):
                 inv.amount_untaxed, 30.66, precision_rounding=prec))
             self.assertFalse(float_compare(
                 inv.amount_total, 30.97, precision_rounding=prec))
+
+    def test_import_job_retry(self):
+        job = self.env['account.invoice.import.job'].create({
+            'invoice_file': base64.b64encode(b'<not-an-invoice/>'),
+            'invoice_filename': 'not-an-invoice.xml',
+            'max_attempts': 2,
+        })
+        self.assertEqual(job.state, 'pending')
+        job.run()
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(job.error)
+        self.env['account.invoice.import.job']._cron_run_jobs()
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertFalse(job.invoice_id)
+        job.requeue()
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.attempts, 0)
+        # only the cron commits, the button runs the job in the
+        # transaction of the request
+        with mock.patch.dict(config.options, {'test_enable': False}), \
+                mock.patch.object(type(self.env.cr), 'commit') as commit:
+            job.run()
+            self.assertEqual(commit.call_count, 0)
+            self.env['account.invoice.import.job']._cron_run_jobs()
+            self.assertTrue(commit.call_count)
+        self.assertEqual(job.state, 'failed')
+
+    def test_import_job_stuck(self):
+        jobo = self.env['account.invoice.import.job']
+        job = jobo.create({
+            'invoice_file': base64.b64encode(b'<not-an-invoice/>'),
+            'invoice_filename': 'not-an-invoice.xml',
+            'max_attempts': 2,
+        })
+        # a job whose worker has been killed during the import
+        job.write({
+            'state': 'running',
+            'attempts': 1,
+            'date_started': fields.Datetime.now() - timedelta(hours=1),
+        })
+        jobo._reset_stuck_jobs()
+        self.assertEqual(job.state, 'pending')
+        self.assertTrue(job.error)
+        job.write({
+            'state': 'running',
+            'attempts': 2,
+            'date_started': fields.Datetime.now() - timedelta(hours=1),
+        })
+        jobo._reset_stuck_jobs()
+        self.assertEqual(job.state, 'failed')
+        # a job that is really running is left untouched
+        job.write({
+            'state': 'running',
+            'date_started': fields.Datetime.now(),
+        })
+        jobo._reset_stuck_jobs()
+        self.assertEqual(job.state, 'running')
+
+    def test_import_invoices_batch(self):
+        files = [
+            (base64.b64encode(b'<not-an-invoice/>'), 'not-an-invoice.xml'),
+            (base64.b64encode(b'<garbage'), 'garbage.xml'),
+        ]
+        res = self.env['account.invoice.import'].import_invoices_batch(
+            files, chunk_size=1)
+        self.assertEqual(
+            [filename for (filename, invoice_id, error) in res],
+            ['not-an-invoice.xml', 'garbage.xml'])
+        for (filename, invoice_id, error) in res:
+            self.assertFalse(invoice_id)
+            self.assertTrue(error)
+
+    def test_import_unexpected_errors(self):
+        aiio = self.env['account.invoice.import']
+        jobo = self.env['account.invoice.import.job']
+        self.env.user.company_id.write({
+            'invoice_import_email': 'invoices-triage@example.com',
+            'invoice_import_background': True,
+            })
+        attachment = namedtuple('Attachment', ['fname', 'content', 'info'])
+        msg_dict = {
+            'email_from': 'supplier@example.com',
+            'to': 'invoices-triage@example.com',
+            'cc': '',
+            'subject': 'Invoice',
+            'attachments': [attachment('inv-error.xml', b'<inv/>', {})],
+            }
+        # an error that is not a UserError rejects the file only
+        with mock.patch.object(
+                type(aiio), '_triage_invoice_file',
+                side_effect=ValueError('unexpected')):
+            aiio.message_new(msg_dict)
+            self.assertFalse(jobo.search(
+                [('invoice_filename', '=', 'inv-error.xml')]))
+            res = aiio.import_invoices_batch(
+                [(base64.b64encode(b'<inv/>'), 'inv-error.xml')],
+                triage=True)
+        self.assertEqual(res, [('inv-error.xml', False, 'unexpected')])
+        self.env.user.company_id.invoice_import_background = False
+        with mock.patch.object(
+                type(aiio), '_import_invoice_unattended',
+                side_effect=ValueError('unexpected')) as import_mock:
+            aiio.message_new(msg_dict)
+        self.assertEqual(import_mock.call_count, 1)
+
+    def test_parsed_invoice_cache(self):
+        cache = ParsedInvoiceCache(ttl=600, max_size=2)
+        raw = memoryview(b'%PDF-1.4')
+        parsed_inv = {
+            'partner': {'name': 'Wood Corner'},
+            'attachments': {'inv.pdf': raw},
+        }
+        cache.put('key1', parsed_inv)
+        # the cached value is isolated from the changes of the caller...
+        parsed_inv['partner']['name'] = 'Changed'
+        res = cache.get('key1')
+        self.assertEqual(res['partner']['name'], 'Wood Corner')
+        # ... but the attachments are not copied
+        self.assertIs(res['attachments']['inv.pdf'], raw)
+        res['partner']['name'] = 'Changed again'
+        self.assertEqual(cache.get('key1')['partner']['name'], 'Wood Corner')
+        cache.put('key2', {})
+        cache.put('key3', {})
+        self.assertIsNone(cache.get('key1'))
+        self.assertEqual(cache.get('key3'), {})
+        expired_cache = ParsedInvoiceCache(ttl=-1)
+        expired_cache.put('key1', {})
+        self.assertIsNone(expired_cache.get('key1'))
+
+    def test_parsed_invoice_cache_wizard(self):
+        aiio = self.env['account.invoice.import']
+        partner = self.env['res.partner'].create({
+            'name': 'Parsed Cache Supplier',
+            'supplier': True,
+        })
+        # 2 configurations: the wizard goes through the 'config' step
+        configs = [self.env['account.invoice.import.config'].create({
+            'name': 'Parsed Cache Config %d' % i,
+            'partner_id': partner.id,
+            'invoice_line_method': '1line_no_product',
+            'account_id': self.expense_account.id,
+            'tax_ids': [(6, 0, [self.purchase_tax.id])],
+            }) for i in range(2)]
+        parsed_inv = {
+            'type': 'in_invoice',
+            'amount_untaxed': 100.0,
+            'amount_total': 101.0,
+            'invoice_number': 'INV-PARSED-CACHE',
+            'date_invoice': '2017-08-16',
+            'currency': {'iso': 'EUR'},
+            'partner': {'name': 'Parsed Cache Supplier'},
+        }
+        wiz = aiio.create({
+            'invoice_file': base64.b64encode(b'%PDF-1.4 parsed cache'),
+            'invoice_filename': 'parsed_cache.pdf',
+        })
+        with mock.patch(
+                'odoo.addons.account_invoice_import.wizard.'
+                'account_invoice_import.parsed_inv_cache',
+                ParsedInvoiceCache()), mock.patch.object(
+                type(aiio), '_parse_invoice_file', autospec=True,
+                return_value=parsed_inv) as mocked:
+            wiz.import_invoice()
+            self.assertEqual(wiz.state, 'config')
+            wiz.import_config_id = configs[0]
+            wiz.create_invoice_action_button()
+        # the file has been parsed only once
+        self.assertEqual(mocked.call_count, 1)
+        invoices = self.env['account.invoice'].search([
+            ('commercial_partner_id', '=', partner.id),
+            ('reference', '=', 'INV-PARSED-CACHE')])
+        self.assertEqual(len(invoices), 1)
+
+    def test_xpath_helpers(self):
+        aiio = self.env['account.invoice.import']
+        namespaces = {'ex': 'urn:example'}
+        xml_root = etree.fromstring(
+            b'<ex:Invoice xmlns:ex="urn:example">'
+            b'<ex:ID>INV-42</ex:ID>'
+            b'<ex:IssueDate format="102">20170816</ex:IssueDate>'
+            b'<ex:Total><ex:Amount>101.5</ex:Amount></ex:Total>'
+            b'</ex:Invoice>')
+        self.assertIs(
+            compile_xpath('/ex:Invoice/ex:ID', namespaces),
+            compile_xpath('/ex:Invoice/ex:ID', dict(namespaces)))
+        xpath_dict = {
+            'invoice_number': ['/ex:Invoice/ex:Number', '/ex:Invoice/ex:ID'],
+            'date': ['/ex:Invoice/ex:IssueDate'],
+            'total': {'amount_total': ['//ex:Total/ex:Amount']},
+            'origin': False,
+        }
+        res = aiio.xpath_to_dict_helper(xml_root, xpath_dict, namespaces)
+        self.assertEqual(res, {
+            'invoice_number': 'INV-42',
+            'date': '2017-08-16',
+            'total': {'amount_total': 101.5},
+            'origin': False,
+        })
+        compiled_dict = aiio.compile_xpath_dict(
+            {'invoice_number': ['/ex:Invoice/ex:ID']}, namespaces)
+        self.assertEqual(
+            aiio.evaluate_xpath_dict(xml_root, compiled_dict),
+            {'invoice_number': 'INV-42'})
+        self.assertEqual(len(aiio.raw_multi_xpath_helper(
+            xml_root, ['//ex:Amount'], namespaces)), 1)
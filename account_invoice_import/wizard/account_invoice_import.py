@@ -3,17 +3,120 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
 import base64
-from odoo import api, fields, models, _
+from odoo import api, fields, models, tools, _
 import odoo.addons.decimal_precision as dp
+from odoo.addons.base_business_document_import.models.\
+    business_document_import import MATCH_TRACE_KEY
+from odoo.addons.account_invoice_import.models.account_invoice import\
+    normalize_invoice_reference
 from odoo.tools import float_compare, float_round, float_is_zero, config
 from odoo.exceptions import UserError
 from lxml import etree
+from collections import OrderedDict, namedtuple
+import copy
+import hashlib
+import itertools
+import json
 import logging
+import threading
+import time
 from datetime import datetime
 import mimetypes
 
 logger = logging.getLogger(__name__)
 
+# Key of the context that holds the batch cache (see _batch_memoize())
+BATCH_CACHE_KEY = 'invoice_import_batch_cache'
+
+
+class ParsedInvoiceCache(object):
+    """Cache (per process) of the result of the parsing of the invoice
+    files, so that the steps of the wizard don't parse the same file
+    again. The entries expire after ttl seconds.
+    As the cache is not shared between processes, the next step of the
+    wizard misses it when it is processed by another worker (multi-worker
+    setups): the file is then parsed again, which only costs time."""
+
+    def __init__(self, ttl=600, max_size=32):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _copy(parsed_inv):
+        # the attachments (raw file content) are immutable: no need to
+        # copy them (and memoryviews can't be copied)
+        memo = dict(
+            (id(data), data)
+            for data in (parsed_inv.get('attachments') or {}).values())
+        return copy.deepcopy(parsed_inv, memo)
+
+    def _evict(self):
+        # all the entries have the same TTL, so the oldest entries are
+        # the first to expire
+        now = time.time()
+        while self._entries and (
+                len(self._entries) > self.max_size or
+                next(iter(self._entries.values()))[0] < now):
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return self._copy(entry[1])
+
+    def put(self, key, parsed_inv):
+        parsed_inv = self._copy(parsed_inv)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, parsed_inv)
+            self._evict()
+
+
+parsed_inv_cache = ParsedInvoiceCache()
+
+
+class ImportContext(namedtuple('ImportContext', [
+        'company_id', 'journals', 'prec_account', 'prec_price', 'prec_uom',
+        'cannot_refund_vat', 'adjustment_debit_account_id',
+        'adjustment_credit_account_id', 'start_end_dates_installed'])):
+    """Data that only depend on the company, computed once for all the
+    invoices imported in the same company (see _get_import_context()).
+    journals is a tuple of (invoice type, default journal ID)."""
+    __slots__ = ()
+
+    def journal_id(self, inv_type):
+        return dict(self.journals).get(inv_type, False)
+
+
+# lxml's compiled XPath objects must not be shared between threads,
+# so the cache of the compiled expressions is per thread
+_xpath_cache = threading.local()
+
+
+def compile_xpath(xpath, namespaces=None):
+    """Return xpath (a string) compiled as an etree.XPath object. Each
+    expression is compiled only once (per thread). Already compiled
+    expressions are returned as is."""
+    if isinstance(xpath, etree.XPath):
+        return xpath
+    cache = getattr(_xpath_cache, 'cache', None)
+    if cache is None:
+        cache = _xpath_cache.cache = {}
+    # the default namespace (None prefix) is not allowed in XPath
+    namespaces = dict(
+        (prefix, uri) for (prefix, uri) in (namespaces or {}).items()
+        if prefix)
+    key = (xpath, frozenset(namespaces.items()))
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = cache[key] = etree.XPath(xpath, namespaces=namespaces)
+    return compiled
+
 
 class AccountInvoiceImport(models.TransientModel):
     _name = 'account.invoice.import'
@@ -125,8 +228,14 @@ class AccountInvoiceImport(models.TransientModel):
         #                                      # importing the invoice in the
         #                                      # wrong company by mistake
         # 'invoice_number': 'I1501243',
+        # 'profile': 'en16931',  # profile/level of the e-invoicing
+        #                        # standard, when there is one. Some profiles
+        #                        # don't have the lines
         # 'description': 'TGV Paris-Lyon',
-        # 'attachments': {'file1.pdf': base64data1, 'file2.pdf': base64data2},
+        # 'attachments': {'file1.pdf': data1, 'file2.pdf': data2},
+        #                # raw file content as a memoryview, base64-encoded
+        #                # by post_create_or_update() (base64-encoded
+        #                # values are still accepted)
         # 'chatter_msg': ['Notes added in chatter of the invoice'],
         # 'note': 'Note embedded in the document',
         # 'origin': 'Origin note',
@@ -173,14 +282,11 @@ class AccountInvoiceImport(models.TransientModel):
         assert parsed_inv.get('pre-processed'), 'pre-processing not done'
         # WARNING: on future versions, import_config will probably become
         # a required argument
-        aio = self.env['account.invoice']
-        ailo = self.env['account.invoice.line']
+        ailo = self._get_clean_env()['account.invoice.line']
         bdio = self.env['business.document.import']
         rpo = self.env['res.partner']
-        company = self.env['res.company'].browse(
-            self.env.context.get('force_company')) or self.env.user.company_id
-        start_end_dates_installed = hasattr(ailo, 'start_date') and\
-            hasattr(ailo, 'end_date')
+        ictx = self._get_import_context()
+        company = self.env['res.company'].browse(ictx.company_id)
         if parsed_inv['type'] in ('out_invoice', 'out_refund'):
             partner_type = 'customer'
         else:
@@ -189,11 +295,20 @@ class AccountInvoiceImport(models.TransientModel):
             parsed_inv['partner'], parsed_inv['chatter_msg'],
             partner_type=partner_type)
         partner = partner.commercial_partner_id
+        config = import_config  # just to make variable name shorter
+        if not config:
+            if not partner.invoice_import_ids:
+                raise UserError(_(
+                    "Missing Invoice Import Configuration on partner '%s'.")
+                    % partner.display_name)
+            else:
+                import_config_obj = partner.invoice_import_ids[0]
+                config = import_config_obj.convert_to_import_config()
+        # Fail fast, before matching the other data of the invoice
+        self._check_invoice_line_method(parsed_inv, config)
         currency = bdio._match_currency(
             parsed_inv.get('currency'), parsed_inv['chatter_msg'])
-        journal_id = aio.with_context(
-            type=parsed_inv['type'],
-            company_id=company.id)._default_journal().id
+        journal_id = ictx.journal_id(parsed_inv['type'])
         vals = {
             'partner_id': partner.id,
             'currency_id': currency.id,
@@ -205,11 +320,18 @@ class AccountInvoiceImport(models.TransientModel):
             'journal_id': journal_id,
             'invoice_line_ids': [],
         }
-        vals = aio.play_onchanges(vals, ['partner_id'])
+        partner_onchange_vals = self._get_partner_onchange_vals(
+            partner.id, parsed_inv['type'], company.id, currency.id,
+            journal_id)
+        for field_name, value in partner_onchange_vals.items():
+            if field_name not in vals:
+                vals[field_name] = copy.deepcopy(value)
         vals['invoice_line_ids'] = []
         # Force due date of the invoice
         if parsed_inv.get('date_due'):
             vals['date_due'] = parsed_inv.get('date_due')
+        else:
+            vals['date_due'] = self._get_invoice_date_due(vals)
         # Bank info
         if parsed_inv.get('iban'):
             partner = rpo.browse(vals['partner_id'])
@@ -219,15 +341,6 @@ class AccountInvoiceImport(models.TransientModel):
                 create_if_not_found=company.invoice_import_create_bank_account)
             if partner_bank:
                 vals['partner_bank_id'] = partner_bank.id
-        config = import_config  # just to make variable name shorter
-        if not config:
-            if not partner.invoice_import_ids:
-                raise UserError(_(
-                    "Missing Invoice Import Configuration on partner '%s'.")
-                    % partner.display_name)
-            else:
-                import_config_obj = partner.invoice_import_ids[0]
-                config = import_config_obj.convert_to_import_config()
 
         if config['invoice_line_method'].startswith('1line'):
             if config['invoice_line_method'] == '1line_no_product':
@@ -255,59 +368,26 @@ class AccountInvoiceImport(models.TransientModel):
             self.set_1line_start_end_dates(il_vals, parsed_inv)
             vals['invoice_line_ids'].append((0, 0, il_vals))
         elif config['invoice_line_method'].startswith('nline'):
-            if not parsed_inv.get('lines'):
-                raise UserError(_(
-                    "You have selected a Multi Line method for this import "
-                    "but Odoo could not extract/read any XML file inside "
-                    "the PDF invoice."))
-            if config['invoice_line_method'] == 'nline_no_product':
-                static_vals = {
-                    'account_id': config['account'].id,
-                    }
-            elif config['invoice_line_method'] == 'nline_static_product':
-                sproduct = config['product']
-                static_vals = {'product_id': sproduct.id, 'invoice_id': vals}
-                static_vals = ailo.play_onchanges(static_vals, ['product_id'])
-                static_vals.pop('invoice_id')
-            else:
-                static_vals = {}
-            for line in parsed_inv['lines']:
-                il_vals = static_vals.copy()
+            # In streaming mode, the lines are created by
+            # _create_invoice_lines_streaming() once the invoice is created
+            if not parsed_inv.get('streaming'):
+                static_vals = self._prepare_create_invoice_nline_static_vals(
+                    vals, config)
+                bdio.resolve_parsed_document(
+                    parsed_inv, seller=partner,
+                    products=config['invoice_line_method'] ==
+                    'nline_auto_product',
+                    taxes=config['invoice_line_method'] == 'nline_no_product')
+                onchange_memo = {}
                 if config['invoice_line_method'] == 'nline_auto_product':
-                    product = bdio._match_product(
-                        line['product'], parsed_inv['chatter_msg'],
-                        seller=partner)
-                    il_vals = {'product_id': product.id, 'invoice_id': vals}
-                    il_vals = ailo.play_onchanges(il_vals, ['product_id'])
-                    il_vals.pop('invoice_id')
-                elif config['invoice_line_method'] == 'nline_no_product':
-                    taxes = bdio._match_taxes(
-                        line.get('taxes'), parsed_inv['chatter_msg'])
-                    il_vals['invoice_line_tax_ids'] = [(6, 0, taxes.ids)]
-                if not il_vals.get('account_id') and il_vals.get('product_id'):
-                    product = self.env['product.product'].browse(
-                        il_vals['product_id'])
-                    raise UserError(_(
-                        "Account missing on product '%s' or on it's related "
-                        "category '%s'.") % (product.display_name,
-                                             product.categ_id.display_name))
-                if line.get('name'):
-                    il_vals['name'] = line['name']
-                elif not il_vals.get('name'):
-                    il_vals['name'] = _('MISSING DESCRIPTION')
-                if start_end_dates_installed:
-                    il_vals['start_date'] =\
-                        line.get('date_start') or parsed_inv.get('date_start')
-                    il_vals['end_date'] =\
-                        line.get('date_end') or parsed_inv.get('date_end')
-                uom = bdio._match_uom(
-                    line.get('uom'), parsed_inv['chatter_msg'])
-                il_vals['uom_id'] = uom.id
-                il_vals.update({
-                    'quantity': line['qty'],
-                    'price_unit': line['price_unit'],  # TODO fix for tax incl
-                    })
-                vals['invoice_line_ids'].append((0, 0, il_vals))
+                    self._play_product_onchanges(
+                        self._get_resolved_products(parsed_inv['lines']),
+                        vals, onchange_memo)
+                for line in parsed_inv['lines']:
+                    il_vals = self._prepare_create_invoice_nline_vals(
+                        vals, config, static_vals, parsed_inv, line, partner,
+                        onchange_memo=onchange_memo)
+                    vals['invoice_line_ids'].append((0, 0, il_vals))
         # Write analytic account + fix syntax for taxes
         aacount_id = config.get('account_analytic') and\
             config['account_analytic'].id or False
@@ -316,6 +396,241 @@ class AccountInvoiceImport(models.TransientModel):
                 line[2]['account_analytic_id'] = aacount_id
         return (vals, config)
 
+    @api.model
+    def _check_invoice_line_method(self, parsed_inv, import_config):
+        '''Raise if the invoice line method of the import configuration
+        can't be used with the parsed invoice'''
+        if (
+                import_config['invoice_line_method'].startswith('nline') and
+                not parsed_inv.get('lines')):
+            if parsed_inv.get('profile'):
+                raise UserError(_(
+                    "You have selected a Multi Line method for this import "
+                    "but the invoice file is at the '%s' profile, which "
+                    "doesn't contain the invoice lines. Select a Single Line "
+                    "method in the Invoice Import Configuration.")
+                    % parsed_inv['profile'])
+            raise UserError(_(
+                "You have selected a Multi Line method for this import "
+                "but Odoo could not extract/read any XML file inside "
+                "the PDF invoice."))
+
+    def init(self):
+        self.env['business.document.import']._init_cache_version(
+            'partner_onchange')
+
+    @api.model
+    @tools.ormcache(
+        "self.env['business.document.import']"
+        "._get_cache_version('partner_onchange')",
+        'self.env.uid', "self.env.context.get('lang')",
+        'partner_id', 'inv_type', 'company_id', 'currency_id', 'journal_id')
+    def _get_partner_onchange_vals(
+            self, partner_id, inv_type, company_id, currency_id, journal_id):
+        '''Values set by the onchange of the partner of the invoice
+        (account, payment term, fiscal position, bank account...).
+        The invoice date is not in the key: the due date, which is the
+        only value that depends on it, is not in the result (see
+        _get_invoice_date_due()).
+        The result is cached per process, and the version of the cache
+        is bumped when the fields of the partners, of their properties,
+        of the fiscal positions and of the bank accounts read by the
+        onchange are modified.
+        The result is shared: it must not be modified.'''
+        aio = self._get_clean_env()['account.invoice'].with_context(
+            force_company=company_id)
+        vals = {
+            'partner_id': partner_id,
+            'currency_id': currency_id,
+            'type': inv_type,
+            'company_id': company_id,
+            'date_invoice': False,
+            'journal_id': journal_id,
+            'invoice_line_ids': [],
+            }
+        new_vals = aio.play_onchanges(vals, ['partner_id'])
+        return dict([
+            (field_name, value) for (field_name, value) in new_vals.items()
+            if field_name not in vals and field_name != 'date_due'])
+
+    @api.model
+    def _clear_partner_onchange_vals_cache(self):
+        self.env['business.document.import']._bump_cache_version(
+            'partner_onchange')
+
+    @api.model
+    def _get_invoice_date_due(self, vals):
+        '''Due date set by the onchange of the payment term and of the
+        date of the invoice (same computation as
+        account.invoice._onchange_payment_term_date_invoice())'''
+        if not vals.get('payment_term_id'):
+            return False
+        date_invoice = vals.get('date_invoice') or\
+            fields.Date.context_today(self)
+        company = self.env['res.company'].browse(vals['company_id'])
+        pterm = self.env['account.payment.term'].browse(
+            vals['payment_term_id'])
+        pterm_list = pterm.with_context(
+            currency_id=company.currency_id.id).compute(
+            value=1, date_ref=date_invoice)[0]
+        return max(line[0] for line in pterm_list)
+
+    @api.model
+    def _prepare_create_invoice_nline_static_vals(self, vals, config):
+        '''Invoice line values that are the same on all the lines with
+        the nline_* methods. vals are the values of the invoice'''
+        ailo = self._get_clean_env()['account.invoice.line']
+        if config['invoice_line_method'] == 'nline_no_product':
+            static_vals = {
+                'account_id': config['account'].id,
+                }
+        elif config['invoice_line_method'] == 'nline_static_product':
+            sproduct = config['product']
+            static_vals = {'product_id': sproduct.id, 'invoice_id': vals}
+            static_vals = ailo.play_onchanges(static_vals, ['product_id'])
+            static_vals.pop('invoice_id')
+        else:
+            static_vals = {}
+        return static_vals
+
+    @api.model
+    def _get_resolved_products(self, lines):
+        '''Products of the lines already resolved by
+        resolve_parsed_document()'''
+        products = self.env['product.product'].browse()
+        for line in lines:
+            if line.get('product') and line['product'].get('recordset'):
+                products |= line['product']['recordset']
+        return products
+
+    @api.model
+    def _product_onchange_key(self, product, partner_id, fiscal_position_id,
+                              company_id, inv_type):
+        return (product.id, partner_id, fiscal_position_id, company_id,
+                inv_type)
+
+    @api.model
+    def _play_product_onchanges(self, products, vals, onchange_memo):
+        '''Play the onchange of product_id of the invoice line once per
+        distinct product: the result only depends on the product and on
+        the invoice, so the lines with the same product re-use it.
+        vals are the values of the invoice. The result is stored in
+        the dict onchange_memo, which must be the same for all the
+        lines of the invoice'''
+        ailo = self._get_clean_env()['account.invoice.line']
+        for product in products:
+            key = self._product_onchange_key(
+                product, vals.get('partner_id'),
+                vals.get('fiscal_position_id'), vals.get('company_id'),
+                vals.get('type'))
+            if key not in onchange_memo:
+                il_vals = {'product_id': product.id, 'invoice_id': vals}
+                il_vals = ailo.play_onchanges(il_vals, ['product_id'])
+                il_vals.pop('invoice_id')
+                onchange_memo[key] = il_vals
+        return onchange_memo
+
+    @api.model
+    def _prepare_create_invoice_nline_vals(
+            self, vals, config, static_vals, parsed_inv, line, partner,
+            onchange_memo=None):
+        bdio = self.env['business.document.import']
+        start_end_dates_installed =\
+            self._get_import_context().start_end_dates_installed
+        il_vals = static_vals.copy()
+        if config['invoice_line_method'] == 'nline_auto_product':
+            product = bdio._match_product(
+                line['product'], parsed_inv['chatter_msg'],
+                seller=partner)
+            if onchange_memo is None:
+                onchange_memo = {}
+            self._play_product_onchanges(product, vals, onchange_memo)
+            il_vals = copy.deepcopy(onchange_memo[self._product_onchange_key(
+                product, vals.get('partner_id'),
+                vals.get('fiscal_position_id'), vals.get('company_id'),
+                vals.get('type'))])
+        elif config['invoice_line_method'] == 'nline_no_product':
+            taxes = bdio._match_taxes(
+                line.get('taxes'), parsed_inv['chatter_msg'])
+            il_vals['invoice_line_tax_ids'] = [(6, 0, taxes.ids)]
+        if not il_vals.get('account_id') and il_vals.get('product_id'):
+            product = self.env['product.product'].browse(
+                il_vals['product_id'])
+            raise UserError(_(
+                "Account missing on product '%s' or on it's related "
+                "category '%s'.") % (product.display_name,
+                                     product.categ_id.display_name))
+        if line.get('name'):
+            il_vals['name'] = line['name']
+        elif not il_vals.get('name'):
+            il_vals['name'] = _('MISSING DESCRIPTION')
+        if start_end_dates_installed:
+            il_vals['start_date'] =\
+                line.get('date_start') or parsed_inv.get('date_start')
+            il_vals['end_date'] =\
+                line.get('date_end') or parsed_inv.get('date_end')
+        uom = bdio._match_uom(
+            line.get('uom'), parsed_inv['chatter_msg'])
+        il_vals['uom_id'] = uom.id
+        il_vals.update({
+            'quantity': line['qty'],
+            'price_unit': line['price_unit'],  # TODO fix for tax incl
+            })
+        return il_vals
+
+    @api.model
+    def _create_invoice_lines_streaming(
+            self, parsed_inv, invoice, vals, config, chunk_size=500):
+        '''Streaming mode: consume the generator parsed_inv['lines'] and
+        create the invoice lines by chunks, so that the lines of the
+        parsed file are never all in memory at the same time.
+        vals are the values used to create the invoice.'''
+        bdio = self.env['business.document.import']
+        partner = invoice.commercial_partner_id
+        static_vals = self._prepare_create_invoice_nline_static_vals(
+            vals, config)
+        aacount_id = config.get('account_analytic') and\
+            config['account_analytic'].id or False
+        onchange_memo = {}
+        lines = iter(parsed_inv['lines'])
+        line_count = 0
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                break
+            bdio.resolve_parsed_document(
+                {'lines': chunk, 'chatter_msg': parsed_inv['chatter_msg']},
+                seller=partner,
+                products=config['invoice_line_method'] ==
+                'nline_auto_product',
+                taxes=config['invoice_line_method'] == 'nline_no_product')
+            if config['invoice_line_method'] == 'nline_auto_product':
+                self._play_product_onchanges(
+                    self._get_resolved_products(chunk), vals, onchange_memo)
+            il_vals_list = []
+            for line in chunk:
+                il_vals = self._prepare_create_invoice_nline_vals(
+                    vals, config, static_vals, parsed_inv, line, partner,
+                    onchange_memo=onchange_memo)
+                if aacount_id:
+                    il_vals['account_analytic_id'] = aacount_id
+                il_vals_list.append((0, 0, il_vals))
+            invoice.write({'invoice_line_ids': il_vals_list})
+            # the lines of the chunk won't be in parsed_inv['lines'] when
+            # post_create_or_update() stores the match memory
+            bdio._store_match_memory({'lines': chunk})
+            line_count += len(chunk)
+            logger.debug(
+                'Streaming import: %d lines created on invoice ID %d',
+                line_count, invoice.id)
+        if not line_count:
+            raise UserError(_(
+                "You have selected a Multi Line method for this import "
+                "but Odoo could not read any line in the invoice file."))
+        # the lines have been consumed: post_process_invoice() will only
+        # create a global adjustment line if necessary
+        parsed_inv['lines'] = []
+
     @api.model
     def set_1line_price_unit_and_quantity(self, il_vals, parsed_inv):
         """For the moment, we only take into account the 'price_include'
@@ -341,12 +656,10 @@ class AccountInvoiceImport(models.TransientModel):
     def set_1line_start_end_dates(self, il_vals, parsed_inv):
         """Only useful if you have installed the module account_cutoff_prepaid
         from https://github.com/OCA/account-closing"""
-        ailo = self.env['account.invoice.line']
         if (
                 parsed_inv.get('date_start') and
                 parsed_inv.get('date_end') and
-                hasattr(ailo, 'start_date') and
-                hasattr(ailo, 'end_date')):
+                self._get_import_context().start_end_dates_installed):
             il_vals['start_date'] = parsed_inv.get('date_start')
             il_vals['end_date'] = parsed_inv.get('date_end')
 
@@ -356,29 +669,245 @@ class AccountInvoiceImport(models.TransientModel):
         vat_purchase_taxes = self.env['account.tax'].search([
             ('company_id', '=', company_id),
             ('amount_type', '=', 'percent'),
-            ('type_tax_use', '=', 'purchase')])
+            ('type_tax_use', '=', 'purchase')], limit=1)
         if not vat_purchase_taxes:
             return True
         return False
 
     @api.model
-    def parse_invoice(self, invoice_file_b64, invoice_filename):
-        assert invoice_file_b64, 'No invoice file'
+    def _batch_memoize(self, key, compute):
+        '''Inside import_invoices_batch() or the import of an invoice
+        (see _with_batch_cache()), compute() is only called the first
+        time and its result is re-used afterwards. Without the
+        batch cache in the context, compute() is called each time.'''
+        cache = self.env.context.get(BATCH_CACHE_KEY)
+        if cache is None:
+            return compute()
+        if key not in cache:
+            cache[key] = compute()
+        return cache[key]
+
+    @api.multi
+    def _with_batch_cache(self):
+        '''Returns self with a batch cache in the context, if there
+        isn't one yet'''
+        if self.env.context.get(BATCH_CACHE_KEY) is None:
+            return self.with_context(**{BATCH_CACHE_KEY: {}})
+        return self
+
+    @api.model
+    def _get_clean_env(self):
+        '''Returns the environment of self without the keys of the context
+        that hold the mutable objects of the import (batch cache, match
+        trace). The records of the other models that the import creates or
+        modifies (invoices, invoice lines, attachments, messages...) are
+        browsed in this environment, so that these objects don't reach
+        their ORM methods.'''
+        context = dict(self.env.context)
+        for key in (BATCH_CACHE_KEY, MATCH_TRACE_KEY):
+            context.pop(key, None)
+        return self.env(context=context)
+
+    @api.model
+    def _get_import_context(self, company_id=None):
+        '''Returns the ImportContext of the company (by default, the
+        company of the import), computed once per batch'''
+        if company_id is None:
+            company_id = self.env.context.get('force_company') or\
+                self.env.user.company_id.id
+        return self._batch_memoize(
+            ('import_context', company_id),
+            lambda: self._prepare_import_context(company_id))
+
+    @api.model
+    def _prepare_import_context(self, company_id):
+        aio = self.env['account.invoice']
+        ailo = self.env['account.invoice.line']
+        dpo = self.env['decimal.precision']
+        company = self.env['res.company'].browse(company_id)
+        adjustment_debit_account = company.adjustment_debit_account_id
+        adjustment_credit_account = company.adjustment_credit_account_id
+        journals = tuple([
+            (inv_type, aio.with_context(
+                type=inv_type, company_id=company_id)._default_journal().id)
+            for inv_type in [
+                'in_invoice', 'in_refund', 'out_invoice', 'out_refund']])
+        return ImportContext(
+            company_id=company_id,
+            journals=journals,
+            prec_account=dpo.precision_get('Account'),
+            prec_price=dpo.precision_get('Product Price'),
+            prec_uom=dpo.precision_get('Product Unit of Measure'),
+            cannot_refund_vat=self.with_context(
+                force_company=company_id).company_cannot_refund_vat(),
+            adjustment_debit_account_id=adjustment_debit_account.id,
+            adjustment_credit_account_id=adjustment_credit_account.id,
+            start_end_dates_installed=hasattr(ailo, 'start_date') and
+            hasattr(ailo, 'end_date'))
+
+    @api.model
+    def parse_invoice(
+            self, invoice_file_b64, invoice_filename, file_data=None,
+            file_hash=None):
+        '''The invoice file is given either base64-encoded
+        (invoice_file_b64) or raw (file_data, bytes): giving the raw
+        content avoids to encode and decode big files several times.
+        file_hash is the SHA-256 of the file, if already computed'''
+        assert invoice_file_b64 or file_data, 'No invoice file'
+        self = self._with_batch_cache()
         logger.info('Starting to import invoice %s', invoice_filename)
-        file_data = base64.b64decode(invoice_file_b64)
+        if file_data is None:
+            file_data = base64.b64decode(invoice_file_b64)
+        if file_hash is None:
+            file_hash = hashlib.sha256(file_data).hexdigest()
+        company = self.env['res.company'].browse(
+            self.env.context.get('force_company') or
+            self.env.user.company_id.id)
+        if self._use_streaming_parse(file_data, invoice_filename):
+            parsed_inv = self._parse_invoice_file(
+                file_data, invoice_filename, streaming=True)
+        else:
+            cache_key = (
+                self.env.cr.dbname, company.id, invoice_filename, file_hash)
+            parsed_inv = parsed_inv_cache.get(cache_key)
+            if parsed_inv is None:
+                parsed_inv = self._parse_invoice_file(
+                    file_data, invoice_filename)
+                parsed_inv_cache.put(cache_key, parsed_inv)
+            else:
+                logger.info(
+                    'Invoice %s has already been parsed: re-using the result',
+                    invoice_filename)
+        if 'attachments' not in parsed_inv:
+            parsed_inv['attachments'] = {}
+        # memoryview: no copy of the file, it will be base64-encoded
+        # when stored by post_create_or_update()
+        parsed_inv['attachments'][invoice_filename] = memoryview(file_data)
+        # to record the file in the import ledger
+        parsed_inv['file_hash'] = file_hash
+        parsed_inv['file_name'] = invoice_filename
+        if company.invoice_import_match_trace:
+            parsed_inv['match_trace'] = []
+        # pre_process_parsed_inv() will be called again a second time,
+        # but it's OK
+        pp_parsed_inv = self.pre_process_parsed_inv(parsed_inv)
+        return pp_parsed_inv
+
+    @api.model
+    def _use_streaming_parse(self, file_data, invoice_filename):
+        '''Big XML files are parsed in streaming mode: the lines of
+        the invoice are read one by one while the invoice is created,
+        instead of loading the full XML tree in memory. The streaming mode
+        can also be forced with the context key invoice_import_streaming.
+        The size threshold (in bytes) is set by the system parameter
+        account_invoice_import.streaming_min_size'''
+        filetype = mimetypes.guess_type(invoice_filename)
+        if not filetype or filetype[0] not in ['application/xml', 'text/xml']:
+            return False
+        if self.env.context.get('invoice_import_streaming'):
+            return True
+        min_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'account_invoice_import.streaming_min_size', 20 * 1024 * 1024))
+        return len(file_data) >= min_size
+
+    @api.model
+    def parse_xml_invoice_streaming(self, file_data):
+        '''To be inherited by the modules that support the streaming
+        mode for their XML format. Must return a parsed_inv dict with the
+        key 'streaming' set to True and a generator of the invoice lines
+        in the key 'lines', or False if the format is not supported
+        (then the file is parsed the usual way)'''
+        return False
+
+    @api.model
+    def parse_invoice_header(
+            self, invoice_file_b64, invoice_filename, file_data=None):
+        '''Header-only parsing of the invoice file, to sort the files
+        before importing them (unknown supplier, invoice already imported,
+        supplier without invoice import configuration) at a fraction
+        of the cost of parse_invoice(): the lines, the taxes and the
+        allowances/charges are not read. Returns a dict in the invoice
+        pivot format with only the keys that identify the invoice (type,
+        partner, company, invoice_number, date, currency, amount_total,
+        amount_untaxed), or False if the format of the file doesn't support
+        the header-only parsing (then, use parse_invoice())'''
+        assert invoice_file_b64 or file_data, 'No invoice file'
+        if file_data is None:
+            file_data = base64.b64decode(invoice_file_b64)
+        filetype = mimetypes.guess_type(invoice_filename)
+        header = False
+        if filetype and filetype[0] in ['application/xml', 'text/xml']:
+            if self._use_streaming_parse(file_data, invoice_filename):
+                header = self.parse_xml_invoice_header_streaming(file_data)
+            else:
+                try:
+                    xml_root = etree.fromstring(file_data)
+                except Exception:
+                    # parse_invoice() will raise the error
+                    return False
+                header = self.parse_xml_invoice_header(xml_root)
+        else:
+            bdio = self.env['business.document.import']
+            xml_files_dict = bdio.get_xml_files_from_pdf(file_data)
+            for xml_filename, xml_root in xml_files_dict.items():
+                header = self.parse_xml_invoice_header(xml_root)
+                if header:
+                    break
+        if not header:
+            return False
+        header['chatter_msg'] = []
+        # Refunds: same conversion as in pre_process_parsed_inv()
+        if not header.get('type'):
+            header['type'] = 'in_invoice'
+        if (
+                header['type'] == 'in_invoice' and
+                float_compare(
+                    header['amount_total'], 0,
+                    precision_digits=self._get_import_context().prec_account)
+                < 0):
+            header['type'] = 'in_refund'
+            for entry in ['amount_untaxed', 'amount_total']:
+                if entry in header:
+                    header[entry] *= -1
+        return header
+
+    @api.model
+    def parse_xml_invoice_header(self, xml_root):
+        '''To be inherited by the modules that support the header-only
+        parsing of their XML format (see parse_invoice_header()).
+        Returns False if the format is not supported'''
+        return False
+
+    @api.model
+    def parse_xml_invoice_header_streaming(self, file_data):
+        '''Same as parse_xml_invoice_header(), for the big XML files
+        (see _use_streaming_parse()): the XML file is given as bytes'''
+        return False
+
+    @api.model
+    def _parse_invoice_file(
+            self, file_data, invoice_filename, streaming=False):
         filetype = mimetypes.guess_type(invoice_filename)
         logger.debug('Invoice mimetype: %s', filetype)
+        parsed_inv = False
+        if streaming:
+            parsed_inv = self.parse_xml_invoice_streaming(file_data)
+            if parsed_inv is not False:
+                logger.info(
+                    'Invoice %s parsed in streaming mode', invoice_filename)
+                return parsed_inv
         if filetype and filetype[0] in ['application/xml', 'text/xml']:
             try:
                 xml_root = etree.fromstring(file_data)
             except Exception as e:
                 raise UserError(_(
                     "This XML file is not XML-compliant. Error: %s") % e)
-            pretty_xml_string = etree.tostring(
-                xml_root, pretty_print=True, encoding='UTF-8',
-                xml_declaration=True)
-            logger.debug('Starting to import the following XML file:')
-            logger.debug(pretty_xml_string)
+            if logger.isEnabledFor(logging.DEBUG):
+                pretty_xml_string = etree.tostring(
+                    xml_root, pretty_print=True, encoding='UTF-8',
+                    xml_declaration=True)
+                logger.debug('Starting to import the following XML file:')
+                logger.debug(pretty_xml_string)
             parsed_inv = self.parse_xml_invoice(xml_root)
             if parsed_inv is False:
                 raise UserError(_(
@@ -388,13 +917,7 @@ class AccountInvoiceImport(models.TransientModel):
         # Fallback on PDF
         else:
             parsed_inv = self.parse_pdf_invoice(file_data)
-        if 'attachments' not in parsed_inv:
-            parsed_inv['attachments'] = {}
-        parsed_inv['attachments'][invoice_filename] = invoice_file_b64
-        # pre_process_parsed_inv() will be called again a second time,
-        # but it's OK
-        pp_parsed_inv = self.pre_process_parsed_inv(parsed_inv)
-        return pp_parsed_inv
+        return parsed_inv
 
     @api.model
     def pre_process_parsed_inv(self, parsed_inv):
@@ -405,10 +928,10 @@ class AccountInvoiceImport(models.TransientModel):
             parsed_inv['chatter_msg'] = []
         if parsed_inv.get('type') in ('out_invoice', 'out_refund'):
             return parsed_inv
-        prec_ac = self.env['decimal.precision'].precision_get('Account')
-        prec_pp = self.env['decimal.precision'].precision_get('Product Price')
-        prec_uom = self.env['decimal.precision'].precision_get(
-            'Product Unit of Measure')
+        ictx = self._get_import_context()
+        prec_ac = ictx.prec_account
+        prec_pp = ictx.prec_price
+        prec_uom = ictx.prec_uom
         if 'amount_tax' in parsed_inv and 'amount_untaxed' not in parsed_inv:
             parsed_inv['amount_untaxed'] =\
                 parsed_inv['amount_total'] - parsed_inv['amount_tax']
@@ -421,45 +944,35 @@ class AccountInvoiceImport(models.TransientModel):
         # method b)
         if not parsed_inv.get('type'):
             parsed_inv['type'] = 'in_invoice'  # default value
+        refund = False
         if (
                 parsed_inv['type'] == 'in_invoice' and
                 float_compare(
                 parsed_inv['amount_total'], 0, precision_digits=prec_ac) < 0):
             parsed_inv['type'] = 'in_refund'
+            refund = True
             for entry in ['amount_untaxed', 'amount_total']:
                 parsed_inv[entry] *= -1
-            for line in parsed_inv.get('lines', []):
-                line['qty'] *= -1
-                if 'price_subtotal' in line:
-                    line['price_subtotal'] *= -1
         # Handle the case where we import an invoice with VAT in a company that
         # cannot deduct VAT
-        if self.company_cannot_refund_vat():
+        cannot_refund_vat = ictx.cannot_refund_vat
+        if cannot_refund_vat:
             parsed_inv['amount_tax'] = 0
             parsed_inv['amount_untaxed'] = parsed_inv['amount_total']
-            for line in parsed_inv.get('lines', []):
-                if line.get('taxes'):
-                    if len(line['taxes']) > 1:
-                        raise UserError(_(
-                            "You are importing an invoice in a company that "
-                            "cannot deduct VAT and the imported invoice has "
-                            "several VAT taxes on the same line (%s). We do "
-                            "not support this scenario for the moment.")
-                            % line.get('name'))
-                    vat_rate = line['taxes'][0].get('amount')
-                    if not float_is_zero(vat_rate, precision_digits=2):
-                        line['price_unit'] = line['price_unit'] *\
-                            (1 + vat_rate/100.0)
-                        line.pop('price_subtotal')
-                        line['taxes'] = []
         # Rounding work
         for entry in ['amount_untaxed', 'amount_total']:
             parsed_inv[entry] = float_round(
                 parsed_inv[entry], precision_digits=prec_ac)
-        for line in parsed_inv.get('lines', []):
-            line['qty'] = float_round(line['qty'], precision_digits=prec_uom)
-            line['price_unit'] = float_round(
-                line['price_unit'], precision_digits=prec_pp)
+        if parsed_inv.get('streaming'):
+            # the lines will be pre-processed when they are read
+            parsed_inv['lines'] = (
+                self._pre_process_parsed_inv_line(
+                    line, refund, cannot_refund_vat, prec_pp, prec_uom)
+                for line in parsed_inv['lines'])
+        else:
+            for line in parsed_inv.get('lines', []):
+                self._pre_process_parsed_inv_line(
+                    line, refund, cannot_refund_vat, prec_pp, prec_uom)
         logger.debug('Result of invoice parsing parsed_inv=%s', parsed_inv)
         # the 'company' dict in parsed_inv is NOT used to auto-detect
         # the company, but to check that we are not importing an
@@ -475,31 +988,170 @@ class AccountInvoiceImport(models.TransientModel):
                 parsed_inv['company'], parsed_inv['chatter_msg'])
         return parsed_inv
 
+    @api.model
+    def _pre_process_parsed_inv_line(
+            self, line, refund, cannot_refund_vat, prec_pp, prec_uom):
+        if refund:
+            line['qty'] *= -1
+            if 'price_subtotal' in line:
+                line['price_subtotal'] *= -1
+        if cannot_refund_vat and line.get('taxes'):
+            if len(line['taxes']) > 1:
+                raise UserError(_(
+                    "You are importing an invoice in a company that "
+                    "cannot deduct VAT and the imported invoice has "
+                    "several VAT taxes on the same line (%s). We do "
+                    "not support this scenario for the moment.")
+                    % line.get('name'))
+            vat_rate = line['taxes'][0].get('amount')
+            if not float_is_zero(vat_rate, precision_digits=2):
+                line['price_unit'] = line['price_unit'] *\
+                    (1 + vat_rate/100.0)
+                line.pop('price_subtotal')
+                line['taxes'] = []
+        line['qty'] = float_round(line['qty'], precision_digits=prec_uom)
+        line['price_unit'] = float_round(
+            line['price_unit'], precision_digits=prec_pp)
+        return line
+
+    @api.model
+    def _with_match_trace(self, parsed_inv):
+        '''Returns self with a context that makes the _match_*() methods
+        of business.document.import append their trace to
+        parsed_inv['match_trace'] (only if parse_invoice() created it)'''
+        if isinstance(parsed_inv.get('match_trace'), list):
+            return self.with_context(
+                **{MATCH_TRACE_KEY: parsed_inv['match_trace']})
+        return self
+
+    @api.model
+    def _store_match_trace(self, parsed_inv, invoice):
+        trace = parsed_inv.get('match_trace')
+        if trace:
+            logger.info(
+                'Invoice ID %d: %d matches, %d SQL queries, %.3f seconds',
+                invoice.id, len(trace),
+                sum([entry['queries'] for entry in trace]),
+                sum([entry['duration'] for entry in trace]))
+            invoice.write({
+                'import_match_trace': json.dumps(trace, indent=2)})
+
     @api.model
     def invoice_already_exists(self, commercial_partner, parsed_inv):
         company_id = self.env.context.get('force_company') or\
             self.env.user.company_id.id
+        reference_normalized = normalize_invoice_reference(
+            parsed_inv.get('invoice_number'))
+        # Without invoice number, ('reference_normalized', '=', False)
+        # would match all the invoices of the supplier without reference
+        if not reference_normalized:
+            return self.env['account.invoice']
+        # equality on reference_normalized, to use the index
+        # account_invoice_import_duplicate_index
         existing_inv = self.env['account.invoice'].search([
             ('company_id', '=', company_id),
             ('commercial_partner_id', '=', commercial_partner.id),
             ('type', '=', parsed_inv['type']),
-            ('reference', '=ilike', parsed_inv.get('invoice_number')),
+            ('reference_normalized', '=', reference_normalized),
             ], limit=1)
         return existing_inv
 
+    @api.model
+    def _check_invoice_file_not_imported(self, file_hash, allow_draft=False):
+        '''Raise an error if a file with the same content has already been
+        imported, before parsing it. With allow_draft=True, no error is
+        raised when the invoice of the first import is still a draft
+        (the wizard can update it)'''
+        company_id = self.env.context.get('force_company') or\
+            self.env.user.company_id.id
+        existing_inv = self.env['account.invoice.import.ledger']._get_invoice(
+            file_hash, company_id)
+        if existing_inv and not (
+                allow_draft and existing_inv.sudo().state == 'draft'):
+            existing_inv = existing_inv.sudo()
+            raise UserError(_(
+                "This file has already been imported in Odoo (invoice ID %d "
+                "number %s supplier number %s)") % (
+                    existing_inv.id, existing_inv.number,
+                    existing_inv.reference))
+
+    @api.model
+    def _triage_invoice_header(self, header, import_config=None):
+        '''Raise a UserError if the invoice of header (the result of
+        parse_invoice_header()) can't be imported: unknown supplier,
+        invoice already in Odoo or supplier without invoice import
+        configuration. Returns the supplier'''
+        company_id = self.env.context.get('force_company') or\
+            self.env.user.company_id.id
+        bdio = self.env['business.document.import']
+        partner = bdio._match_partner(
+            header['partner'], header['chatter_msg'])
+        partner = partner.commercial_partner_id
+        existing_inv = self.invoice_already_exists(partner, header)
+        if existing_inv:
+            raise UserError(_(
+                "This supplier invoice already exists in Odoo (ID %d "
+                "number %s supplier number %s)") % (
+                    existing_inv.id, existing_inv.number,
+                    header.get('invoice_number')))
+        if import_config is None:
+            self._batch_memoize(
+                ('import_config', partner.id, company_id),
+                lambda: self._get_partner_import_config(partner, company_id))
+        return partner
+
+    @api.model
+    def _triage_invoice_file(
+            self, file_data, invoice_filename, import_config=None):
+        '''Cheap checks of an invoice file before importing it: raise a
+        UserError if the file has already been imported or, with a
+        header-only parsing, if the invoice can't be imported (see
+        _triage_invoice_header()). Returns the header, or False if the
+        format of the file doesn't support the header-only parsing (then,
+        only the file itself is checked)'''
+        self._check_invoice_file_not_imported(
+            hashlib.sha256(file_data).hexdigest())
+        header = self.parse_invoice_header(
+            False, invoice_filename, file_data=file_data)
+        if header:
+            self._triage_invoice_header(header, import_config=import_config)
+        return header
+
+    @api.model
+    def _record_invoice_file(self, parsed_inv, invoice):
+        '''Record the imported file in the import ledger'''
+        if parsed_inv.get('file_hash'):
+            aiilo = self._get_clean_env()['account.invoice.import.ledger']
+            aiilo.sudo().create({
+                'file_hash': parsed_inv['file_hash'],
+                'invoice_filename': parsed_inv.get('file_name'),
+                'invoice_id': invoice.id,
+                'company_id': invoice.company_id.id,
+                })
+
     @api.multi
     def import_invoice(self):
         """Method called by the button of the wizard
         (import step AND config step)"""
         self.ensure_one()
+        self = self._with_batch_cache()
         aio = self.env['account.invoice']
         aiico = self.env['account.invoice.import.config']
         bdio = self.env['business.document.import']
         iaao = self.env['ir.actions.act_window']
         company_id = self.env.context.get('force_company') or\
             self.env.user.company_id.id
+        if self.env['res.company'].browse(
+                company_id).invoice_import_background:
+            return self.enqueue_import_job()
+        file_data = base64.b64decode(self.invoice_file)
+        file_hash = hashlib.sha256(file_data).hexdigest()
+        self._check_invoice_file_not_imported(file_hash, allow_draft=True)
         parsed_inv = self.parse_invoice(
-            self.invoice_file, self.invoice_filename)
+            False, self.invoice_filename, file_data=file_data,
+            file_hash=file_hash)
+        self = self._with_match_trace(parsed_inv)
+        bdio = self.env['business.document.import']
         partner = bdio._match_partner(
             parsed_inv['partner'], parsed_inv['chatter_msg'])
         partner = partner.commercial_partner_id
@@ -569,6 +1221,123 @@ class AccountInvoiceImport(models.TransientModel):
         self.write(wiz_vals)
         return action
 
+    @api.multi
+    def enqueue_import_job(self):
+        '''Create a background import job for the invoice file of the
+        wizard and return the action to display it'''
+        self.ensure_one()
+        company_id = self.env.context.get('force_company') or\
+            self.env.user.company_id.id
+        job = self._get_clean_env()['account.invoice.import.job'].create({
+            'invoice_file': self.invoice_file,
+            'invoice_filename': self.invoice_filename,
+            'company_id': company_id,
+            'import_config_id': self.import_config_id.id or False,
+            'origin': _('Import wizard'),
+            })
+        logger.info(
+            'Invoice import job ID %d created for file %s',
+            job.id, self.invoice_filename)
+        action = self.env['ir.actions.act_window'].for_xml_id(
+            'account_invoice_import', 'account_invoice_import_job_action')
+        action.update({
+            'view_mode': 'form,tree',
+            'views': False,
+            'res_id': job.id,
+            })
+        return action
+
+    @api.model
+    def _import_invoice_unattended(
+            self, invoice_file_b64, invoice_filename, import_config=None,
+            file_data=None):
+        '''Import an invoice file without user interaction (mail gateway,
+        background jobs). If import_config is None, the first invoice
+        import configuration of the supplier is used.
+        Raise a UserError when the invoice cannot be imported.'''
+        self = self._with_batch_cache()
+        company_id = self.env.context.get('force_company') or\
+            self.env.user.company_id.id
+        if file_data is None:
+            file_data = base64.b64decode(invoice_file_b64)
+        file_hash = hashlib.sha256(file_data).hexdigest()
+        # reject the files that are sent again before parsing them
+        self._check_invoice_file_not_imported(file_hash)
+        parsed_inv = self.parse_invoice(
+            False, invoice_filename, file_data=file_data, file_hash=file_hash)
+        bdio = self._with_match_trace(parsed_inv).env[
+            'business.document.import']
+        partner = bdio._match_partner(
+            parsed_inv['partner'], parsed_inv['chatter_msg'])
+        existing_inv = self.invoice_already_exists(partner, parsed_inv)
+        if existing_inv:
+            raise UserError(_(
+                "This supplier invoice already exists in Odoo (ID %d "
+                "number %s supplier number %s)") % (
+                    existing_inv.id, existing_inv.number,
+                    parsed_inv.get('invoice_number')))
+        if import_config is None:
+            import_config = self._batch_memoize(
+                ('import_config', partner.id, company_id),
+                lambda: self._get_partner_import_config(partner, company_id))
+        return self.create_invoice(parsed_inv, import_config)
+
+    @api.model
+    def _get_partner_import_config(self, partner, company_id):
+        import_configs = self.env['account.invoice.import.config'].search([
+            ('partner_id', '=', partner.id),
+            ('company_id', '=', company_id)])
+        if not import_configs:
+            raise UserError(_(
+                "Missing Invoice Import Configuration on partner '%s'.")
+                % partner.display_name)
+        elif len(import_configs) > 1:
+            logger.info(
+                "There are %d invoice import configs for partner %s. "
+                "Using the first one '%s''", len(import_configs),
+                partner.display_name, import_configs[0].name)
+        return import_configs[0].convert_to_import_config()
+
+    @api.model
+    def import_invoices_batch(self, files, chunk_size=100, triage=False):
+        '''Import many invoice files without user interaction.
+        files is an iterable of (invoice_file_b64, invoice_filename).
+        Each invoice is imported in a savepoint, so that an invoice that
+        fails doesn't prevent the import of the others, and the
+        transaction is committed every chunk_size invoices.
+        The data that only depend on the company (decimal precisions,
+        default journals, import configuration of the suppliers...)
+        are computed once for the whole batch.
+        With triage=True, the files are first checked with a header-only
+        parsing (see _triage_invoice_file()): it is faster when many files
+        are expected to be rejected (duplicates, unknown suppliers...).
+        Returns a list of (invoice_filename, invoice_id, error_msg),
+        with invoice_id=False when the import failed.'''
+        self = self.with_context(**{BATCH_CACHE_KEY: {}})
+        res = []
+        for i, (invoice_file_b64, invoice_filename) in enumerate(files, 1):
+            try:
+                with self.env.cr.savepoint():
+                    file_data = base64.b64decode(invoice_file_b64)
+                    if triage:
+                        self._triage_invoice_file(file_data, invoice_filename)
+                    invoice = self._import_invoice_unattended(
+                        False, invoice_filename, file_data=file_data)
+            except Exception as e:
+                error = isinstance(e, UserError) and e.name or str(e)
+                logger.warning(
+                    'Batch import: failed to import file %s: %s',
+                    invoice_filename, error)
+                res.append((invoice_filename, False, error))
+            else:
+                res.append((invoice_filename, invoice.id, False))
+            if not i % chunk_size and not config['test_enable']:
+                self.env.cr.commit()
+                # don't keep the records of the previous chunks in the cache
+                self.invalidate_cache()
+                logger.info('Batch import: %d files processed', i)
+        return res
+
     @api.multi
     def create_invoice_action_button(self):
         '''Workaround for a v10 bug: if I call create_invoice_action()
@@ -579,6 +1348,8 @@ class AccountInvoiceImport(models.TransientModel):
     def create_invoice_action(self, parsed_inv=None, import_config=None):
         '''parsed_inv is not a required argument'''
         self.ensure_one()
+        # parse_invoice() and create_invoice() share the same batch cache
+        self = self._with_batch_cache()
         iaao = self.env['ir.actions.act_window']
         if parsed_inv is None:
             parsed_inv = self.parse_invoice(
@@ -599,16 +1370,27 @@ class AccountInvoiceImport(models.TransientModel):
 
     @api.model
     def create_invoice(self, parsed_inv, import_config=False):
-        aio = self.env['account.invoice']
-        bdio = self.env['business.document.import']
+        self = self._with_batch_cache()._with_match_trace(parsed_inv)
+        # the invoice is created without the batch cache and the match
+        # trace in its context (all the following operations on the
+        # invoice use the environment of the invoice)
+        aio = self._get_clean_env()['account.invoice']
+        bdio = self._get_clean_env()['business.document.import']
         parsed_inv = self.pre_process_parsed_inv(parsed_inv)
         (vals, import_config) = self._prepare_create_invoice_vals(
             parsed_inv, import_config=import_config)
         logger.debug('Invoice vals for creation: %s', vals)
         invoice = aio.create(vals)
+        if (
+                parsed_inv.get('streaming') and
+                import_config['invoice_line_method'].startswith('nline')):
+            self._create_invoice_lines_streaming(
+                parsed_inv, invoice, vals, import_config)
         self.post_process_invoice(parsed_inv, invoice, import_config)
         logger.info('Invoice ID %d created', invoice.id)
         bdio.post_create_or_update(parsed_inv, invoice)
+        self._record_invoice_file(parsed_inv, invoice)
+        self._store_match_trace(parsed_inv, invoice)
         return invoice
 
     @api.model
@@ -631,19 +1413,19 @@ class AccountInvoiceImport(models.TransientModel):
             il_vals['account_id'] = account.id
         elif import_config['invoice_line_method'] == 'nline_auto_product':
             res_cmp = float_compare(diff_amount, 0, precision_rounding=prec)
-            company = invoice.company_id
+            ictx = self._get_import_context(invoice.company_id.id)
             if res_cmp > 0:
-                if not company.adjustment_debit_account_id:
+                if not ictx.adjustment_debit_account_id:
                     raise UserError(_(
                         "You must configure the 'Adjustment Debit Account' "
                         "on the Accounting Configuration page."))
-                il_vals['account_id'] = company.adjustment_debit_account_id.id
+                il_vals['account_id'] = ictx.adjustment_debit_account_id
             else:
-                if not company.adjustment_credit_account_id:
+                if not ictx.adjustment_credit_account_id:
                     raise UserError(_(
                         "You must configure the 'Adjustment Credit Account' "
                         "on the Accounting Configuration page."))
-                il_vals['account_id'] = company.adjustment_credit_account_id.id
+                il_vals['account_id'] = ictx.adjustment_credit_account_id
         logger.debug("Prepared global ajustment invoice line %s", il_vals)
         return il_vals
 
@@ -704,10 +1486,10 @@ class AccountInvoiceImport(models.TransientModel):
             il_vals = self._prepare_global_adjustment_line(
                 diff_amount, invoice, import_config)
             il_vals['invoice_id'] = invoice.id
-            self.env['account.invoice.line'].create(il_vals)
+            self._get_clean_env()['account.invoice.line'].create(il_vals)
             logger.info('Global adjustment invoice line created')
         # Invalidate cache
-        invoice = self.env['account.invoice'].browse(invoice.id)
+        invoice = self._get_clean_env()['account.invoice'].browse(invoice.id)
         assert not float_compare(
             parsed_inv['amount_untaxed'], invoice.amount_untaxed,
             precision_rounding=prec)
@@ -732,9 +1514,8 @@ class AccountInvoiceImport(models.TransientModel):
     @api.multi
     def update_invoice_lines(self, parsed_inv, invoice, seller):
         chatter = parsed_inv['chatter_msg']
-        ailo = self.env['account.invoice.line']
-        dpo = self.env['decimal.precision']
-        qty_prec = dpo.precision_get('Product Unit of Measure')
+        ailo = self._get_clean_env()['account.invoice.line']
+        qty_prec = self._get_import_context(invoice.company_id.id).prec_uom
         existing_lines = []
         for eline in invoice.invoice_line_ids:
             price_unit = 0.0
@@ -785,9 +1566,11 @@ class AccountInvoiceImport(models.TransientModel):
             compare_res['to_remove'].unlink()
         if compare_res['to_add']:
             to_create_label = []
+            onchange_memo = {}
             for add in compare_res['to_add']:
                 line_vals = self._prepare_create_invoice_line(
-                    add['product'], add['uom'], add['import_line'], invoice)
+                    add['product'], add['uom'], add['import_line'], invoice,
+                    onchange_memo=onchange_memo)
                 new_line = ailo.create(line_vals)
                 to_create_label.append('%s %s x %s' % (
                     new_line.quantity,
@@ -799,23 +1582,46 @@ class AccountInvoiceImport(models.TransientModel):
         return True
 
     @api.model
-    def _prepare_create_invoice_line(self, product, uom, import_line, invoice):
-        new_line = self.env['account.invoice.line'].new({
-            'invoice_id': invoice,
-            'qty': import_line['qty'],
-            'product_id': product,
-        })
-        new_line._onchange_product_id()
-        vals = {
-            f: new_line._fields[f].convert_to_write(new_line[f], new_line)
-            for f in new_line._cache
-        }
+    def _prepare_create_invoice_line(
+            self, product, uom, import_line, invoice, onchange_memo=None):
+        '''onchange_memo is a dict shared by the lines added to the same
+        invoice, so that the onchange of the product is played once per
+        product'''
+        key = self._product_onchange_key(
+            product, invoice.partner_id.id, invoice.fiscal_position_id.id,
+            invoice.company_id.id, invoice.type)
+        if onchange_memo is None or key not in onchange_memo:
+            new_line = self._get_clean_env()['account.invoice.line'].new({
+                'invoice_id': invoice,
+                'qty': import_line['qty'],
+                'product_id': product,
+            })
+            new_line._onchange_product_id()
+            onchange_vals = {
+                f: new_line._fields[f].convert_to_write(new_line[f], new_line)
+                for f in new_line._cache
+            }
+            if onchange_memo is None:
+                onchange_memo = {}
+            onchange_memo[key] = onchange_vals
+        vals = copy.deepcopy(onchange_memo[key])
         vals.update({
             'product_id': product.id,
             'price_unit': import_line.get('price_unit'),
             'quantity': import_line['qty'],
             'invoice_id': invoice.id,
             })
+        # The imported quantity is expressed in the imported unit of
+        # measure, not in the unit of measure set by the onchange
+        if uom:
+            if uom.category_id != product.uom_id.category_id:
+                raise UserError(_(
+                    "The unit of measure '%s' of the imported line with "
+                    "product '%s' is not in the same category as the unit "
+                    "of measure '%s' of the product.") % (
+                        uom.name, product.display_name,
+                        product.uom_id.name))
+            vals['uom_id'] = uom.id
         return vals
 
     @api.model
@@ -841,14 +1647,20 @@ class AccountInvoiceImport(models.TransientModel):
     def update_invoice(self):
         '''Called by the button of the wizard (step 'update-from-invoice')'''
         self.ensure_one()
+        self = self._with_batch_cache()
         iaao = self.env['ir.actions.act_window']
         bdio = self.env['business.document.import']
-        invoice = self.invoice_id
+        invoice = self.invoice_id.with_env(self._get_clean_env())
         if not invoice:
             raise UserError(_(
                 'You must select a supplier invoice or refund to update'))
         parsed_inv = self.parse_invoice(
             self.invoice_file, self.invoice_filename)
+        if parsed_inv.get('streaming'):
+            # the update of the lines needs all the lines
+            parsed_inv['lines'] = list(parsed_inv['lines'])
+        self = self._with_match_trace(parsed_inv)
+        bdio = self.env['business.document.import']
         if self.partner_id:
             # True if state='update' ; False when state='update-from-invoice'
             parsed_inv['partner']['recordset'] = self.partner_id
@@ -875,7 +1687,7 @@ class AccountInvoiceImport(models.TransientModel):
                 currency.name, invoice.currency_id.name))
         vals = self._prepare_update_invoice_vals(parsed_inv, invoice)
         logger.debug('Updating supplier invoice with vals=%s', vals)
-        self.invoice_id.write(vals)
+        invoice.write(vals)
         if (
                 parsed_inv.get('lines') and
                 import_config['invoice_line_method'] == 'nline_auto_product'):
@@ -884,7 +1696,10 @@ class AccountInvoiceImport(models.TransientModel):
         if import_config['account_analytic']:
             invoice.invoice_line_ids.write({
                 'account_analytic_id': import_config['account_analytic'].id})
+        bdio = self._get_clean_env()['business.document.import']
         bdio.post_create_or_update(parsed_inv, invoice)
+        self._record_invoice_file(parsed_inv, invoice)
+        self._store_match_trace(parsed_inv, invoice)
         logger.info(
             'Supplier invoice ID %d updated via import of file %s',
             invoice.id, self.invoice_filename)
@@ -900,50 +1715,82 @@ class AccountInvoiceImport(models.TransientModel):
         return action
 
     def xpath_to_dict_helper(self, xml_root, xpath_dict, namespaces):
+        '''The values of xpath_dict that are lists of XPath expressions
+        are replaced by the result of multi_xpath_helper() (dicts are
+        processed recursively)'''
+        xpath_dict.update(self.evaluate_xpath_dict(
+            xml_root, self.compile_xpath_dict(xpath_dict, namespaces)))
+        return xpath_dict
+        # TODO: think about blocking required fields
+
+    def compile_xpath_dict(self, xpath_dict, namespaces):
+        '''Return a copy of xpath_dict where the lists of XPath expressions
+        are replaced by tuples of compiled expressions, to be given to
+        evaluate_xpath_dict(). The result can be re-used for all the
+        documents (or all the lines of a document) of the same format.'''
+        res = {}
         for key, value in xpath_dict.items():
             if isinstance(value, list):
-                isdate = isfloat = False
-                if 'date' in key:
-                    isdate = True
-                elif 'amount' in key:
-                    isfloat = True
-                xpath_dict[key] = self.multi_xpath_helper(
-                    xml_root, value, namespaces, isdate=isdate,
-                    isfloat=isfloat)
-                if not xpath_dict[key]:
-                    logger.debug('pb')
+                res[key] = tuple([
+                    compile_xpath(xpath, namespaces) for xpath in value])
             elif isinstance(value, dict):
-                xpath_dict[key] = self.xpath_to_dict_helper(
-                    xml_root, value, namespaces)
-        return xpath_dict
-        # TODO: think about blocking required fields
+                res[key] = self.compile_xpath_dict(value, namespaces)
+            else:
+                res[key] = value
+        return res
+
+    def evaluate_xpath_dict(self, xml_root, compiled_dict):
+        '''Evaluate the result of compile_xpath_dict() on xml_root.
+        As in xpath_to_dict_helper(), the values of the keys that contain
+        'date' are converted to dates and the values of the keys that
+        contain 'amount' are converted to floats.'''
+        res = {}
+        for key, value in compiled_dict.items():
+            if isinstance(value, tuple):
+                res[key] = self.multi_xpath_helper(
+                    xml_root, value, None, isdate='date' in key,
+                    isfloat='date' not in key and 'amount' in key)
+                if not res[key]:
+                    logger.debug('No value found for key %s', key)
+            elif isinstance(value, dict):
+                res[key] = self.evaluate_xpath_dict(xml_root, value)
+            else:
+                res[key] = value
+        return res
 
     def multi_xpath_helper(
             self, xml_root, xpath_list, namespaces, isdate=False,
             isfloat=False):
-        assert isinstance(xpath_list, list)
+        '''xpath_list is a list of XPath expressions, as strings or
+        compiled by compile_xpath(): the first one that gives a result
+        with a text is used'''
+        assert isinstance(xpath_list, (list, tuple))
         for xpath in xpath_list:
-            xpath_res = xml_root.xpath(xpath, namespaces=namespaces)
+            xpath_res = compile_xpath(xpath, namespaces)(xml_root)
             if xpath_res and xpath_res[0].text:
-                if isdate:
-                    if (
-                            xpath_res[0].attrib and
-                            xpath_res[0].attrib.get('format') != '102'):
-                        raise UserError(_(
-                            "Only the date format 102 is supported "))
-                    date_dt = datetime.strptime(xpath_res[0].text, '%Y%m%d')
-                    date_str = fields.Date.to_string(date_dt)
-                    return date_str
-                elif isfloat:
-                    res_float = float(xpath_res[0].text)
-                    return res_float
-                else:
-                    return xpath_res[0].text
+                return self.element_value_helper(
+                    xpath_res[0], isdate=isdate, isfloat=isfloat)
         return False
 
+    def element_value_helper(self, element, isdate=False, isfloat=False):
+        '''Text of element (the result of find() for example), converted
+        as in multi_xpath_helper(). Returns False if element is None or
+        has no text'''
+        if element is None or not element.text:
+            return False
+        if isdate:
+            if element.attrib and element.attrib.get('format') != '102':
+                raise UserError(_(
+                    "Only the date format 102 is supported "))
+            date_dt = datetime.strptime(element.text, '%Y%m%d')
+            return fields.Date.to_string(date_dt)
+        elif isfloat:
+            return float(element.text)
+        return element.text
+
     def raw_multi_xpath_helper(self, xml_root, xpath_list, namespaces):
         for xpath in xpath_list:
-            xpath_res = xml_root.xpath(xpath, namespaces=namespaces)
+            xpath_res = compile_xpath(xpath, namespaces)(xml_root)
             if xpath_res:
                 return xpath_res
         return []
@@ -996,46 +1843,49 @@ class AccountInvoiceImport(models.TransientModel):
             company_id = all_companies[0]['id']
 
         self = self.with_context(force_company=company_id)
-        aiico = self.env['account.invoice.import.config']
-        bdio = self.env['business.document.import']
+        background = self.env['res.company'].browse(
+            company_id).invoice_import_background
         i = 0
         if msg_dict.get('attachments'):
             i += 1
             for attach in msg_dict['attachments']:
+                if background:
+                    # Don't create jobs for the files that will be rejected
+                    try:
+                        with self.env.cr.savepoint():
+                            self._triage_invoice_file(
+                                attach.content, attach.fname)
+                    except Exception as e:
+                        error = isinstance(e, UserError) and e.name or str(e)
+                        logger.warning(
+                            "Mail import: file %s rejected: %s",
+                            attach.fname, error)
+                        continue
+                    job = self.env['account.invoice.import.job'].create({
+                        'invoice_file': base64.b64encode(attach.content),
+                        'invoice_filename': attach.fname,
+                        'company_id': company_id,
+                        'origin': _('E-mail from %s: %s') % (
+                            msg_dict.get('email_from'),
+                            msg_dict.get('subject')),
+                        })
+                    logger.info(
+                        'Attachment %d: %s. Invoice import job ID %d created',
+                        i, attach.fname, job.id)
+                    continue
                 logger.info(
                     'Attachment %d: %s. Trying to import it as an invoice',
                     i, attach.fname)
-                parsed_inv = self.parse_invoice(
-                    base64.b64encode(attach.content), attach.fname)
-                partner = bdio._match_partner(
-                    parsed_inv['partner'], parsed_inv['chatter_msg'])
-
-                existing_inv = self.invoice_already_exists(partner, parsed_inv)
-                if existing_inv:
+                try:
+                    with self.env.cr.savepoint():
+                        invoice = self._import_invoice_unattended(
+                            False, attach.fname, file_data=attach.content)
+                except Exception as e:
+                    error = isinstance(e, UserError) and e.name or str(e)
                     logger.warning(
-                        "Mail import: this supplier invoice already exists "
-                        "in Odoo (ID %d number %s supplier number %s)",
-                        existing_inv.id, existing_inv.number,
-                        parsed_inv.get('invoice_number'))
+                        "Mail import: failed to import file %s: %s",
+                        attach.fname, error)
                     continue
-                import_configs = aiico.search([
-                    ('partner_id', '=', partner.id),
-                    ('company_id', '=', company_id)])
-                if not import_configs:
-                    logger.warning(
-                        "Mail import: missing Invoice Import Configuration "
-                        "for partner '%s'.", partner.display_name)
-                    continue
-                elif len(import_configs) == 1:
-                    import_config = import_configs.convert_to_import_config()
-                else:
-                    logger.info(
-                        "There are %d invoice import configs for partner %s. "
-                        "Using the first one '%s''", len(import_configs),
-                        partner.display_name, import_configs[0].name)
-                    import_config =\
-                        import_configs[0].convert_to_import_config()
-                invoice = self.create_invoice(parsed_inv, import_config)
                 logger.info('Invoice ID %d created from email', invoice.id)
                 invoice.message_post(body=_(
                     "Invoice successfully imported from email sent by "
@@ -4,7 +4,7 @@
 
 {
     'name': 'Account Invoice Import Factur-X',
-    'version': '12.0.1.0.0',
+    'version': '12.0.1.1.0',
     'category': 'Invoicing Management',
     'license': 'AGPL-3',
     'summary': 'Import Factur-X/ZUGFeRD supplier invoices/refunds',
@@ -12,7 +12,10 @@
     'website': 'https://github.com/OCA/edi',
     'depends': ['account_invoice_import', 'base_facturx'],
     'external_dependencies': {'python': ['facturx']},
-    'data': ['wizard/account_invoice_import_view.xml'],
+    'data': [
+        'wizard/account_invoice_import_view.xml',
+        'views/res_config_settings.xml',
+        ],
     'demo': ['demo/demo_data.xml'],
     'installable': True,
 }
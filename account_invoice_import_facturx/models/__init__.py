@@ -0,0 +1,2 @@
+from . import company
+from . import res_config_settings
@@ -0,0 +1,26 @@
+# Copyright 2020 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, fields
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    facturx_import_xsd_check = fields.Selection([
+        ('strict', 'Always'),
+        ('on_failure', 'Only When the Import Fails'),
+        ('sampled', 'On a Sample of the Invoices'),
+        ], string='Factur-X XML Schema Check', default='strict',
+        required=True,
+        help="Validation of the imported Factur-X/ZUGFeRD XML files against "
+        "the official XML Schema Definition:\n"
+        "* Always: all the files are validated before being imported.\n"
+        "* Only When the Import Fails: the file is validated only when the "
+        "extraction of the data or the coherence checks fail, to give a "
+        "clearer error message.\n"
+        "* On a Sample of the Invoices: a percentage of the files are "
+        "validated.")
+    facturx_import_xsd_sample_rate = fields.Integer(
+        string='Factur-X XML Schema Check Sample (%)', default=10)
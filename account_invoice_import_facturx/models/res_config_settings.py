@@ -0,0 +1,14 @@
+# Copyright 2020 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, fields
+
+
+class ResConfigSettings(models.TransientModel):
+    _inherit = 'res.config.settings'
+
+    facturx_import_xsd_check = fields.Selection(
+        related='company_id.facturx_import_xsd_check', readonly=False)
+    facturx_import_xsd_sample_rate = fields.Integer(
+        related='company_id.facturx_import_xsd_sample_rate', readonly=False)
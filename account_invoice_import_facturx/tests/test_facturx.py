@@ -7,6 +7,14 @@ import base64
 from odoo.tools import file_open
 from odoo.tools import float_compare
 from odoo import fields
+from odoo.exceptions import UserError
+from odoo.addons.account_invoice_import_facturx.wizard.\
+    account_invoice_import import get_facturx_flavor_level, \
+    get_facturx_schema, get_facturx_flavor
+from odoo.addons.account_invoice_import.wizard.account_invoice_import import\
+    AccountInvoiceImport
+from lxml import etree
+from unittest import mock
 
 
 class TestFacturx(TransactionCase):
@@ -204,3 +212,298 @@ class TestFacturx(TransactionCase):
                 precision_rounding=cur_prec))
             # Delete because several sample invoices have the same number
             invoices.unlink()
+
+    def test_import_facturx_invoice_streaming(self):
+        inv_file = 'ZUGFeRD_1p0_COMFORT_Einfach.pdf-ZUGFeRD-invoice.xml'
+        f = file_open(
+            'account_invoice_import_facturx/tests/files/' + inv_file, 'rb')
+        xml_file = f.read()
+        f.close()
+        aiio = self.env['account.invoice.import']
+        parsed_inv = aiio.parse_invoice(False, inv_file, file_data=xml_file)
+        self.assertFalse(parsed_inv.get('streaming'))
+        parsed_inv_streaming = aiio.with_context(
+            invoice_import_streaming=True).parse_invoice(
+            False, inv_file, file_data=xml_file)
+        self.assertTrue(parsed_inv_streaming['streaming'])
+        self.assertEqual(
+            list(parsed_inv_streaming['lines']), parsed_inv['lines'])
+        # Create the invoice in streaming mode
+        wiz = self.env['account.invoice.import'].create({
+            'invoice_file': base64.b64encode(xml_file),
+            'invoice_filename': inv_file,
+            })
+        wiz.with_context(invoice_import_streaming=True).import_invoice()
+        invoices = self.env['account.invoice'].search([
+            ('state', '=', 'draft'),
+            ('type', '=', 'in_invoice'),
+            ('reference', '=', '471102'),
+            ])
+        self.assertEqual(len(invoices), 1)
+        cur_prec = invoices.currency_id.rounding
+        self.assertFalse(float_compare(
+            invoices.amount_untaxed, 473.0, precision_rounding=cur_prec))
+        self.assertFalse(float_compare(
+            invoices.amount_total, 529.87, precision_rounding=cur_prec))
+
+    def test_import_facturx_invoices_batch(self):
+        aio = self.env['account.invoice']
+        aiio = self.env['account.invoice.import']
+        sample_files = [
+            ('ZUGFeRD_1p0_BASIC_Einfach.pdf', '471102'),
+            ('ZUGFeRD_1p0_EXTENDED_Warenrechnung.pdf', 'R87654321012345'),
+            # a bad file in the middle of the batch
+            ('garbage.pdf', False),
+            ('Facture_FR_EN16931.pdf', 'FA-2017-0010'),
+            ]
+        # same precision as in test_import_facturx_invoice()
+        self.env.ref('product.decimal_price').digits = 4
+        files = []
+        for (inv_file, invoice_number) in sample_files:
+            if invoice_number:
+                f = file_open(
+                    'account_invoice_import_facturx/tests/files/' +
+                    inv_file, 'rb')
+                pdf_file = f.read()
+                f.close()
+            else:
+                pdf_file = b'%PDF-1.4 garbage'
+            files.append((base64.b64encode(pdf_file), inv_file))
+        prepare_import_context = type(aiio)._prepare_import_context
+        with mock.patch.object(
+                type(aiio), '_prepare_import_context', autospec=True,
+                side_effect=prepare_import_context) as mocked:
+            res = aiio.import_invoices_batch(files, chunk_size=2)
+        # the data that only depend on the company are shared by the batch
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(
+            [filename for (filename, invoice_id, error) in res],
+            [inv_file for (inv_file, invoice_number) in sample_files])
+        for (filename, invoice_id, error), (inv_file, invoice_number) in\
+                zip(res, sample_files):
+            if invoice_number:
+                self.assertFalse(error)
+                invoice = aio.browse(invoice_id)
+                self.assertTrue(invoice.exists())
+                self.assertEqual(invoice.reference, invoice_number)
+            else:
+                self.assertFalse(invoice_id)
+                self.assertTrue(error)
+        self.assertEqual(len(aio.search([
+            ('type', 'in', ('in_invoice', 'in_refund')),
+            ('reference', 'in', [
+                invoice_number
+                for (inv_file, invoice_number) in sample_files]),
+            ])), 3)
+
+    def test_facturx_xsd_check(self):
+        inv_file = 'ZUGFeRD_1p0_COMFORT_Einfach.pdf-ZUGFeRD-invoice.xml'
+        f = file_open(
+            'account_invoice_import_facturx/tests/files/' + inv_file, 'rb')
+        file_data = f.read()
+        f.close()
+        xml_root = etree.fromstring(file_data)
+        flavor, level = get_facturx_flavor_level(xml_root)
+        self.assertEqual(flavor, 'zugferd')
+        # the schema is compiled only once
+        self.assertIs(
+            get_facturx_schema(flavor, level),
+            get_facturx_schema(flavor, level))
+        aiio = self.env['account.invoice.import']
+        company = self.env.user.company_id
+        company.facturx_import_xsd_check = 'strict'
+        parsed_inv = aiio.parse_facturx_invoice(xml_root)
+        for xsd_check in ['on_failure', 'sampled']:
+            company.facturx_import_xsd_check = xsd_check
+            self.assertEqual(
+                aiio.parse_facturx_invoice(xml_root)['amount_total'],
+                parsed_inv['amount_total'])
+        # with the policy 'on_failure', the file is also validated when
+        # the coherence checks of post_process_invoice() fail
+        company.facturx_import_xsd_check = 'on_failure'
+        parsed_inv = aiio.parse_invoice(False, inv_file, file_data=file_data)
+        self.assertTrue(parsed_inv['facturx_xsd_on_failure'])
+        self.assertEqual(
+            etree.tostring(aiio._get_facturx_xml_root(parsed_inv)),
+            etree.tostring(xml_root))
+        with mock.patch.object(
+                AccountInvoiceImport, 'post_process_invoice',
+                side_effect=UserError('Wrong total')), \
+                mock.patch.object(
+                    type(aiio), '_check_facturx_xsd',
+                    autospec=True) as mocked:
+            with self.assertRaises(UserError):
+                aiio.post_process_invoice(
+                    parsed_inv, self.env['account.invoice'], {})
+        self.assertEqual(mocked.call_count, 1)
+
+    def test_facturx_flavor_xpaths(self):
+        inv_file = 'ZUGFeRD_1p0_COMFORT_Einfach.pdf-ZUGFeRD-invoice.xml'
+        f = file_open(
+            'account_invoice_import_facturx/tests/files/' + inv_file, 'rb')
+        xml_root = etree.fromstring(f.read())
+        f.close()
+        self.assertEqual(get_facturx_flavor(xml_root), 'zugferd')
+        aiio = self.env['account.invoice.import']
+        for flavor in ['factur-x', 'zugferd']:
+            xpath_dict = aiio.prepare_facturx_xpath_dict(flavor=flavor)
+            for xpaths in xpath_dict['partner'].values():
+                for xpath in xpaths:
+                    self.assertFalse(xpath.startswith('//'))
+        parsed_inv = aiio.parse_facturx_invoice(xml_root)
+        self.assertEqual(parsed_inv['invoice_number'], '471102')
+        self.assertEqual(len(parsed_inv['lines']), 2)
+        self.assertEqual(parsed_inv['lines'][0], {
+            'product': {'barcode': '4012345001235', 'code': 'TB100A4'},
+            'name': u'Trennbl\xe4tter A4',
+            'date_start': False,
+            'date_end': False,
+            'qty': 20.0,
+            'uom': {'unece_code': 'C62'},
+            'price_unit': 9.9,
+            'price_subtotal': 198.0,
+            'taxes': [{
+                'amount_type': 'percent',
+                'amount': 19.0,
+                'unece_type_code': 'VAT',
+                'unece_categ_code': 'S',
+                'unece_due_date_code': False,
+                }],
+            })
+
+    def test_facturx_line_paths(self):
+        aiio = self.env['account.invoice.import']
+        # Line dates: only the ones of the billing period
+        xml_root = etree.fromstring(
+            '<rsm:CrossIndustryInvoice'
+            ' xmlns:rsm="urn:un:unece:uncefact:data:standard:'
+            'CrossIndustryInvoice:100"'
+            ' xmlns:ram="urn:un:unece:uncefact:data:standard:'
+            'ReusableAggregateBusinessInformationEntity:100"'
+            ' xmlns:udt="urn:un:unece:uncefact:data:standard:'
+            'UnqualifiedDataType:100">'
+            '<rsm:SupplyChainTradeTransaction>'
+            '<ram:IncludedSupplyChainTradeLineItem>'
+            '<ram:SpecifiedTradeProduct><ram:Name>Service</ram:Name>'
+            '</ram:SpecifiedTradeProduct>'
+            '<ram:SpecifiedLineTradeDelivery>'
+            '<ram:BilledQuantity unitCode="C62">2</ram:BilledQuantity>'
+            '<ram:StartDateTime>'
+            '<udt:DateTimeString format="102">20170101</udt:DateTimeString>'
+            '</ram:StartDateTime>'
+            '</ram:SpecifiedLineTradeDelivery>'
+            '<ram:SpecifiedLineTradeSettlement>'
+            '<ram:ApplicableTradeTax><ram:TypeCode>VAT</ram:TypeCode>'
+            '<ram:RateApplicablePercent>20.00</ram:RateApplicablePercent>'
+            '</ram:ApplicableTradeTax>'
+            '<ram:BillingSpecifiedPeriod>'
+            '<ram:StartDateTime>'
+            '<udt:DateTimeString format="102">20170801</udt:DateTimeString>'
+            '</ram:StartDateTime>'
+            '<ram:EndDateTime>'
+            '<udt:DateTimeString format="102">20170831</udt:DateTimeString>'
+            '</ram:EndDateTime>'
+            '</ram:BillingSpecifiedPeriod>'
+            '<ram:SpecifiedTradeSettlementLineMonetarySummation>'
+            '<ram:LineTotalAmount>100.00</ram:LineTotalAmount>'
+            '</ram:SpecifiedTradeSettlementLineMonetarySummation>'
+            '</ram:SpecifiedLineTradeSettlement>'
+            '</ram:IncludedSupplyChainTradeLineItem>'
+            '</rsm:SupplyChainTradeTransaction>'
+            '</rsm:CrossIndustryInvoice>')
+        counters = {'lines': 0.0}
+        res = aiio.parse_facturx_invoice_line(
+            xml_root[0][0], [], {}, counters, xml_root.nsmap)
+        self.assertEqual(res[0]['date_start'], '2017-08-01')
+        self.assertEqual(res[0]['date_end'], '2017-08-31')
+        self.assertEqual(res[0]['taxes'][0]['amount'], 20.0)
+        # ZUGFeRD: the taxes of the line may be nested
+        xml_root = etree.fromstring(
+            '<rsm:CrossIndustryDocument'
+            ' xmlns:rsm="urn:ferd:CrossIndustryDocument:invoice:1p0"'
+            ' xmlns:ram="urn:un:unece:uncefact:data:standard:'
+            'ReusableAggregateBusinessInformationEntity:12"'
+            ' xmlns:udt="urn:un:unece:uncefact:data:standard:'
+            'UnqualifiedDataType:15">'
+            '<rsm:SpecifiedSupplyChainTradeTransaction>'
+            '<ram:IncludedSupplyChainTradeLineItem>'
+            '<ram:SpecifiedSupplyChainTradeDelivery>'
+            '<ram:BilledQuantity unitCode="C62">2</ram:BilledQuantity>'
+            '</ram:SpecifiedSupplyChainTradeDelivery>'
+            '<ram:SpecifiedSupplyChainTradeSettlement>'
+            '<ram:SpecifiedTradeSettlementMonetarySummation>'
+            '<ram:LineTotalAmount>100.00</ram:LineTotalAmount>'
+            '<ram:ApplicableTradeTax><ram:TypeCode>VAT</ram:TypeCode>'
+            '<ram:ApplicablePercent>19.00</ram:ApplicablePercent>'
+            '</ram:ApplicableTradeTax>'
+            '</ram:SpecifiedTradeSettlementMonetarySummation>'
+            '</ram:SpecifiedSupplyChainTradeSettlement>'
+            '<ram:SpecifiedTradeProduct><ram:Name>Service</ram:Name>'
+            '</ram:SpecifiedTradeProduct>'
+            '</ram:IncludedSupplyChainTradeLineItem>'
+            '</rsm:SpecifiedSupplyChainTradeTransaction>'
+            '</rsm:CrossIndustryDocument>')
+        res = aiio.parse_facturx_invoice_line(
+            xml_root[0][0], [], {}, counters, xml_root.nsmap)
+        self.assertEqual(len(res[0]['taxes']), 1)
+        self.assertEqual(res[0]['taxes'][0]['amount'], 19.0)
+        self.assertFalse(res[0]['date_start'])
+
+    def test_facturx_profile(self):
+        aiio = self.env['account.invoice.import']
+        for inv_file, profile in [
+                ('Facture_FR_MINIMUM.pdf', 'minimum'),
+                ('Facture_FR_BASICWL.pdf', 'basicwl'),
+                ('Facture_FR_EN16931.pdf', 'en16931'),
+                ]:
+            f = file_open(
+                'account_invoice_import_facturx/tests/files/' + inv_file,
+                'rb')
+            pdf_file = f.read()
+            f.close()
+            parsed_inv = aiio.parse_invoice(
+                False, inv_file, file_data=pdf_file)
+            self.assertEqual(parsed_inv['profile'], profile)
+            if profile == 'en16931':
+                self.assertTrue(parsed_inv['lines'])
+                continue
+            self.assertFalse(parsed_inv['lines'])
+            with self.assertRaises(UserError):
+                aiio._check_invoice_line_method(
+                    parsed_inv, {'invoice_line_method': 'nline_no_product'})
+
+    def test_facturx_invoice_header(self):
+        aiio = self.env['account.invoice.import']
+        inv_file = 'ZUGFeRD_1p0_COMFORT_Einfach.pdf-ZUGFeRD-invoice.xml'
+        f = file_open(
+            'account_invoice_import_facturx/tests/files/' + inv_file, 'rb')
+        xml_file = f.read()
+        f.close()
+        header = aiio.parse_invoice_header(False, inv_file, file_data=xml_file)
+        self.assertNotIn('lines', header)
+        parsed_inv = aiio.parse_invoice(False, inv_file, file_data=xml_file)
+        for key in ['type', 'partner', 'invoice_number', 'date']:
+            self.assertEqual(header[key], parsed_inv[key])
+        for key in ['amount_total', 'amount_untaxed']:
+            self.assertFalse(float_compare(
+                header[key], parsed_inv[key], precision_digits=2))
+        # Embedded XML file of a PDF file
+        inv_file = 'Facture_FR_EXTENDED.pdf'
+        f = file_open(
+            'account_invoice_import_facturx/tests/files/' + inv_file, 'rb')
+        pdf_file = f.read()
+        f.close()
+        header = aiio.parse_invoice_header(False, inv_file, file_data=pdf_file)
+        self.assertEqual(header['invoice_number'], 'FA-2017-0010')
+        self.assertEqual(header['profile'], 'extended')
+        self.assertEqual(
+            aiio._triage_invoice_header(header),
+            self.env.ref('account_invoice_import_facturx.jolie_boutique'))
+        wiz = aiio.create({
+            'invoice_file': base64.b64encode(pdf_file),
+            'invoice_filename': inv_file,
+            })
+        wiz.import_invoice()
+        # the invoice is now a duplicate
+        with self.assertRaises(UserError):
+            aiio._triage_invoice_header(header)
@@ -5,15 +5,265 @@
 from odoo import api, models, _
 from odoo.exceptions import UserError
 from odoo.tools import float_compare, float_is_zero
+from io import BytesIO
+from lxml import etree
 import logging
+import mimetypes
+import os
+import random
+import threading
 
 logger = logging.getLogger(__name__)
 
 try:
-    from facturx import check_facturx_xsd
+    import facturx
+    from facturx import check_facturx_xsd, get_facturx_level
 except ImportError:
     logger.debug('Cannot import facturx')
 
+ZUGFERD_NAMESPACE = 'urn:ferd:CrossIndustryDocument:invoice:1p0'
+
+# Paths of the main elements of the XML file, per flavor. The paths
+# starting with '/' are anchored on the root, the others are relative to
+# a line item (line_*) or to the settlement element (summation)
+FACTURX_XPATHS = {
+    'factur-x': {
+        'context':
+        '/rsm:CrossIndustryInvoice/rsm:ExchangedDocumentContext',
+        'document':
+        '/rsm:CrossIndustryInvoice/rsm:ExchangedDocument',
+        'agreement':
+        '/rsm:CrossIndustryInvoice/rsm:SupplyChainTradeTransaction'
+        '/ram:ApplicableHeaderTradeAgreement',
+        'settlement':
+        '/rsm:CrossIndustryInvoice/rsm:SupplyChainTradeTransaction'
+        '/ram:ApplicableHeaderTradeSettlement',
+        'line_item':
+        '/rsm:CrossIndustryInvoice/rsm:SupplyChainTradeTransaction'
+        '/ram:IncludedSupplyChainTradeLineItem',
+        'summation': 'ram:SpecifiedTradeSettlementHeaderMonetarySummation',
+        'line_delivery': 'ram:SpecifiedLineTradeDelivery',
+        'line_settlement': 'ram:SpecifiedLineTradeSettlement',
+        'line_summation':
+        'ram:SpecifiedTradeSettlementLineMonetarySummation',
+        'tax_percent': 'ram:RateApplicablePercent',
+        },
+    'zugferd': {
+        'context':
+        '/rsm:CrossIndustryDocument/rsm:SpecifiedExchangedDocumentContext',
+        'document':
+        '/rsm:CrossIndustryDocument/rsm:HeaderExchangedDocument',
+        'agreement':
+        '/rsm:CrossIndustryDocument/rsm:SpecifiedSupplyChainTradeTransaction'
+        '/ram:ApplicableSupplyChainTradeAgreement',
+        'settlement':
+        '/rsm:CrossIndustryDocument/rsm:SpecifiedSupplyChainTradeTransaction'
+        '/ram:ApplicableSupplyChainTradeSettlement',
+        'line_item':
+        '/rsm:CrossIndustryDocument/rsm:SpecifiedSupplyChainTradeTransaction'
+        '/ram:IncludedSupplyChainTradeLineItem',
+        'summation': 'ram:SpecifiedTradeSettlementMonetarySummation',
+        'line_delivery': 'ram:SpecifiedSupplyChainTradeDelivery',
+        'line_settlement': 'ram:SpecifiedSupplyChainTradeSettlement',
+        'line_summation': 'ram:SpecifiedTradeSettlementMonetarySummation',
+        'tax_percent': 'ram:ApplicablePercent',
+        },
+    }
+
+# Sections of the XML file that don't exist at some profiles, per
+# (flavor, profile): they are not read at all for these profiles
+FACTURX_PROFILE_SKIPPED_SECTIONS = {
+    ('factur-x', 'minimum'): [
+        'lines', 'allowance_charges', 'taxes', 'payment_means'],
+    ('factur-x', 'basicwl'): ['lines'],
+    }
+FACTURX_SECTIONS = ['lines', 'allowance_charges', 'taxes', 'payment_means']
+
+# Keys of prepare_facturx_xpath_dict() read by the header-only parsing
+FACTURX_HEADER_KEYS = [
+    'partner', 'company', 'invoice_number', 'date', 'currency',
+    'amount_total']
+
+# The compiled XML schemas, like the other lxml objects, must not be shared
+# between threads: they are cached per thread
+_xsd_cache = threading.local()
+
+# Extraction plans of the line items, per flavor and namespaces
+# (see get_facturx_extraction_plan)
+_extraction_plan_cache = {}
+
+
+def is_facturx_tag(tag):
+    """True if tag is the tag of the root of a Factur-X/ZUGFeRD XML file"""
+    return bool(
+        tag and 'crossindustry' in tag.lower() and 'invoice' in tag.lower())
+
+
+def get_xml_root_tag(file_data):
+    """Tag of the root element of the XML file, read without parsing the
+    whole file. None if the file is not XML-compliant"""
+    try:
+        return next(etree.iterparse(
+            BytesIO(file_data), events=('start', )))[1].tag
+    except Exception:
+        return None
+
+
+def get_facturx_flavor(element):
+    """Returns the flavor ('factur-x' or 'zugferd') of the XML tree of
+    element, from the namespace of its root"""
+    root = element.getroottree().getroot()
+    if etree.QName(root).namespace == ZUGFERD_NAMESPACE:
+        return 'zugferd'
+    return 'factur-x'
+
+
+def get_facturx_extraction_plan(flavor, namespaces):
+    """Plan to read all the fields of a line item in a single walk on the
+    line item (see _extract_facturx_line_fields()):
+    - 'line': tree of the paths of the fields of the line item, from the
+      line item. Each node is a dict with the keys 'field' (the field of
+      the element, or None), 'children' ({tag: node}) and 'descendants'
+      ({tag: field} for the '//' steps)
+    - 'line_lists': the fields of the line item that have several values
+    - 'tax': {tag: field} for the children of a tax element
+    - 'allowance_charge': {field: path} for find() on an allowance/charge
+    The tags are in Clark notation. The plan is built only once per
+    flavor and namespaces."""
+    key = (flavor, namespaces.get('ram'), namespaces.get('udt'))
+    if key in _extraction_plan_cache:
+        return _extraction_plan_cache[key]
+
+    def clark(path):
+        steps = []
+        for step in path.split('/'):
+            prefix, name = step.split(':', 1)
+            steps.append(etree.QName(namespaces.get(prefix), name).text)
+        return '/'.join(steps)
+
+    def new_node():
+        return {'field': None, 'children': {}, 'descendants': {}}
+
+    paths = FACTURX_XPATHS[flavor]
+    # Same paths as the XPath expressions used before, from the line item
+    line_fields = {
+        'barcode': 'ram:SpecifiedTradeProduct/ram:GlobalID',
+        'code': 'ram:SpecifiedTradeProduct/ram:SellerAssignedID',
+        'name': 'ram:SpecifiedTradeProduct/ram:Name',
+        'qty': paths['line_delivery'] + '/ram:BilledQuantity',
+        'price_subtotal':
+        paths['line_settlement'] + '/' + paths['line_summation'] +
+        '/ram:LineTotalAmount',
+        }
+    line_lists = ['taxes']
+    if flavor == 'factur-x':
+        line_fields.update({
+            'date_start':
+            paths['line_settlement'] + '/ram:BillingSpecifiedPeriod'
+            '/ram:StartDateTime/udt:DateTimeString',
+            'date_end':
+            paths['line_settlement'] + '/ram:BillingSpecifiedPeriod'
+            '/ram:EndDateTime/udt:DateTimeString',
+            'taxes': paths['line_settlement'] + '/ram:ApplicableTradeTax',
+            'allowance_charges':
+            paths['line_settlement'] + '/ram:SpecifiedTradeAllowanceCharge',
+            })
+        line_lists.append('allowance_charges')
+    else:
+        line_fields.update({
+            'net_price':
+            'ram:SpecifiedSupplyChainTradeAgreement'
+            '/ram:NetPriceProductTradePrice/ram:ChargeAmount',
+            # The taxes of the line may be nested in ZUGFeRD
+            'taxes': paths['line_settlement'] + '//ram:ApplicableTradeTax',
+            })
+    line_plan = new_node()
+    for field, path in line_fields.items():
+        path, sep, descendant = path.partition('//')
+        node = line_plan
+        for tag in clark(path).split('/'):
+            node = node['children'].setdefault(tag, new_node())
+        if descendant:
+            node['descendants'][clark(descendant)] = field
+        else:
+            node['field'] = field
+    plan = {
+        'line': line_plan,
+        'line_lists': line_lists,
+        'tax': {
+            clark('ram:TypeCode'): 'type_code',
+            clark('ram:CategoryCode'): 'categ_code',
+            clark(paths['tax_percent']): 'percent',
+            clark('ram:DueDateTypeCode'): 'due_date_code',
+            },
+        'allowance_charge': {
+            'reason': clark('ram:Reason'),
+            'amount': clark('ram:ActualAmount'),
+            'indicator': clark('ram:ChargeIndicator/udt:Indicator'),
+            'taxes': clark('ram:CategoryTradeTax'),
+            },
+        }
+    _extraction_plan_cache[key] = plan
+    return plan
+
+
+def get_facturx_profile(guideline_id):
+    """Returns the profile ('minimum', 'basicwl', 'basic', 'en16931' or
+    'extended' for Factur-X, 'basic', 'comfort' or 'extended' for ZUGFeRD)
+    from the ID of the GuidelineSpecifiedDocumentContextParameter of the
+    XML file. None if the profile is unknown"""
+    if not guideline_id:
+        return None
+    guideline_id = guideline_id.strip()
+    profile = guideline_id.split(':')[-1].lower()
+    if profile in (
+            'minimum', 'basicwl', 'basic', 'en16931', 'comfort', 'extended'):
+        return profile
+    if guideline_id.startswith('urn:cen.eu:en16931:2017'):
+        return 'en16931'
+    return None
+
+
+def get_facturx_flavor_level(xml_root):
+    """Returns (flavor, level) of a Factur-X/ZUGFeRD XML tree. All the
+    ZUGFeRD 1.0 levels share the same XML schema, so level is None for
+    ZUGFeRD"""
+    if get_facturx_flavor(xml_root) == 'zugferd':
+        return ('zugferd', None)
+    return ('factur-x', get_facturx_level(xml_root))
+
+
+def _find_facturx_xsd_file(flavor, level):
+    """Path of the XSD file shipped with the facturx library, or None if
+    it can't be found"""
+    if flavor == 'zugferd':
+        xsd_filename = 'ZUGFeRD1p0.xsd'
+    else:
+        xsd_filename = getattr(
+            facturx.facturx, 'FACTURX_LEVEL2xsd', {}).get(level)
+    if not xsd_filename:
+        return None
+    for dirpath, dirnames, filenames in os.walk(
+            os.path.dirname(facturx.__file__)):
+        if xsd_filename in filenames:
+            return os.path.join(dirpath, xsd_filename)
+    return None
+
+
+def get_facturx_schema(flavor, level):
+    """Compiled XML schema of the flavor and level, loaded only once
+    (per thread). None if the XSD file of the facturx library can't be
+    found."""
+    cache = getattr(_xsd_cache, 'cache', None)
+    if cache is None:
+        cache = _xsd_cache.cache = {}
+    key = (flavor, level)
+    if key not in cache:
+        xsd_file = _find_facturx_xsd_file(flavor, level)
+        cache[key] = xsd_file and etree.XMLSchema(etree.parse(xsd_file))\
+            or None
+    return cache[key]
+
 
 class AccountInvoiceImport(models.TransientModel):
     _name = 'account.invoice.import'
@@ -21,132 +271,202 @@ class AccountInvoiceImport(models.TransientModel):
 
     @api.model
     def parse_xml_invoice(self, xml_root):
-        if (
-                xml_root.tag and
-                'crossindustry' in xml_root.tag.lower() and
-                'invoice' in xml_root.tag.lower()):
+        if is_facturx_tag(xml_root.tag):
             return self.parse_facturx_invoice(xml_root)
         else:
             return super(AccountInvoiceImport, self).parse_xml_invoice(
                 xml_root)
 
-    def prepare_facturx_xpath_dict(self):
+    @api.model
+    def parse_xml_invoice_streaming(self, file_data):
+        # if the file is not XML-compliant, the usual parsing raises the error
+        if is_facturx_tag(get_xml_root_tag(file_data)):
+            return self.parse_facturx_invoice_streaming(file_data)
+        return super(AccountInvoiceImport, self).parse_xml_invoice_streaming(
+            file_data)
+
+    @api.model
+    def parse_xml_invoice_header(self, xml_root):
+        if is_facturx_tag(xml_root.tag):
+            return self.parse_facturx_invoice_header(xml_root)
+        return super(AccountInvoiceImport, self).parse_xml_invoice_header(
+            xml_root)
+
+    @api.model
+    def parse_xml_invoice_header_streaming(self, file_data):
+        if is_facturx_tag(get_xml_root_tag(file_data)):
+            return self.parse_facturx_invoice_header(
+                self._parse_facturx_without_lines(file_data))
+        return super(
+            AccountInvoiceImport, self).parse_xml_invoice_header_streaming(
+            file_data)
+
+    @api.model
+    def _parse_facturx_without_lines(self, file_data):
+        '''First pass on the XML file: returns the XML tree without the
+        line items (they are removed as soon as they are read)'''
+        context = etree.iterparse(
+            BytesIO(file_data), events=('end', ), huge_tree=True,
+            tag='{*}IncludedSupplyChainTradeLineItem')
+        for event, iline in context:
+            iline.getparent().remove(iline)
+        return context.root
+
+    @api.model
+    def parse_facturx_invoice_streaming(self, file_data):
+        '''The XML tree is built without the line items. The lines are
+        read by a second pass when the invoice is created'''
+        return self.parse_facturx_invoice(
+            self._parse_facturx_without_lines(file_data),
+            line_elements=self._iter_facturx_line_elements(file_data))
+
+    @api.model
+    def _iter_facturx_line_elements(self, file_data):
+        '''Second pass on the XML file: yield the line items one by one
+        and free them once they have been parsed'''
+        for event, iline in etree.iterparse(
+                BytesIO(file_data), events=('end', ), huge_tree=True,
+                tag='{*}IncludedSupplyChainTradeLineItem'):
+            yield iline
+            iline.clear()
+            while iline.getprevious() is not None:
+                del iline.getparent()[0]
+
+    def prepare_facturx_xpath_dict(self, flavor='factur-x'):
+        paths = FACTURX_XPATHS[flavor]
         xpath_dict = {
             'partner': {
                 'vat': [
-                    "//ram:ApplicableHeaderTradeAgreement"
+                    paths['agreement'] +
                     "/ram:SellerTradeParty"
                     "/ram:SpecifiedTaxRegistration"
-                    "/ram:ID[@schemeID='VA']",  # Factur-X
-                    "//ram:ApplicableSupplyChainTradeAgreement"
-                    "/ram:SellerTradeParty"
-                    "/ram:SpecifiedTaxRegistration"
-                    "/ram:ID[@schemeID='VA']",  # ZUGFeRD
-                    ],
+                    "/ram:ID[@schemeID='VA']"],
                 'name': [
-                    '//ram:ApplicableHeaderTradeAgreement'
-                    '/ram:SellerTradeParty'
-                    '/ram:Name',  # Factur-X
-                    '//ram:ApplicableSupplyChainTradeAgreement'
+                    paths['agreement'] +
                     '/ram:SellerTradeParty'
-                    '/ram:Name',  # ZUGFeRD
-                    ],
+                    '/ram:Name'],
                 'email': [
-                    "//ram:ApplicableHeaderTradeAgreement"
+                    paths['agreement'] +
                     "/ram:SellerTradeParty"
                     "/ram:DefinedTradeContact"
                     "/ram:EmailURIUniversalCommunication"
-                    "/ram:URIID",  # Factur-X
-                    "//ram:ApplicableSupplyChainTradeAgreement"
-                    "/ram:SellerTradeParty"
-                    "/ram:DefinedTradeContact"
-                    "/ram:EmailURIUniversalCommunication"
-                    "/ram:URIID",  # ZUGFeRD
-                    ],
+                    "/ram:URIID"],
                 },
             'company': {
                 'vat': [
-                    "//ram:ApplicableHeaderTradeAgreement"
-                    "/ram:BuyerTradeParty"
-                    "/ram:SpecifiedTaxRegistration"
-                    "/ram:ID[@schemeID='VA']",  # Factur-X
-                    "//ram:ApplicableSupplyChainTradeAgreement"
+                    paths['agreement'] +
                     "/ram:BuyerTradeParty"
                     "/ram:SpecifiedTaxRegistration"
-                    "/ram:ID[@schemeID='VA']",  # ZUGFeRD
-                    ],
+                    "/ram:ID[@schemeID='VA']"],
                 },
-            'invoice_number': [
-                '//rsm:ExchangedDocument/ram:ID',  # Factur-X
-                '//rsm:HeaderExchangedDocument/ram:ID',  # ZUGFeRD
-                ],
+            'invoice_number': [paths['document'] + '/ram:ID'],
             'date': [
-                '//rsm:ExchangedDocument'
-                '/ram:IssueDateTime/udt:DateTimeString',  # Factur-X
-                '//rsm:HeaderExchangedDocument'
-                '/ram:IssueDateTime/udt:DateTimeString',  # ZUGFeRD
-                ],
+                paths['document'] + '/ram:IssueDateTime/udt:DateTimeString'],
             'date_due': [
-                "//ram:ApplicableHeaderTradeSettlement"
+                paths['settlement'] +
                 "/ram:SpecifiedTradePaymentTerms"
                 "/ram:DueDateDateTime"
-                "/udt:DateTimeString",  # Factur-X
-                "//ram:ApplicableSupplyChainTradeSettlement"
-                "/ram:SpecifiedTradePaymentTerms"
-                "/ram:DueDateDateTime"
-                "/udt:DateTimeString",  # ZUGFeRD
-                ],
+                "/udt:DateTimeString"],
             'date_start': [
-                "//ram:ApplicableHeaderTradeSettlement"
-                "/ram:BillingSpecifiedPeriod"
-                "/ram:StartDateTime/udt:DateTimeString",
-                "//ram:ApplicableSupplyChainTradeSettlement"
+                paths['settlement'] +
                 "/ram:BillingSpecifiedPeriod"
-                "/ram:StartDateTime/udt:DateTimeString",
-                ],
+                "/ram:StartDateTime/udt:DateTimeString"],
             'date_end': [
-                "//ram:ApplicableHeaderTradeSettlement"
-                "/ram:BillingSpecifiedPeriod"
-                "/ram:EndDateTime/udt:DateTimeString",
-                "//ram:ApplicableSupplyChainTradeSettlement"
+                paths['settlement'] +
                 "/ram:BillingSpecifiedPeriod"
-                "/ram:EndDateTime/udt:DateTimeString",
-                ],
+                "/ram:EndDateTime/udt:DateTimeString"],
             'currency': {
-                'iso': [
-                    "//ram:ApplicableHeaderTradeSettlement"
-                    "/ram:InvoiceCurrencyCode",  # Factur-X
-                    "//ram:ApplicableSupplyChainTradeSettlement"
-                    "/ram:InvoiceCurrencyCode",  # ZUGFeRD
-                    ],
+                'iso': [paths['settlement'] + "/ram:InvoiceCurrencyCode"],
                 },
             'amount_total': [
-                "//ram:ApplicableHeaderTradeSettlement"
-                "/ram:SpecifiedTradeSettlementHeaderMonetarySummation"
-                "/ram:GrandTotalAmount",  # Factur-X
-                "//ram:ApplicableSupplyChainTradeSettlement"
-                "/ram:SpecifiedTradeSettlementMonetarySummation"
-                "/ram:GrandTotalAmount",  # ZUGFeRD
-                ],
+                paths['settlement'] + '/' + paths['summation'] +
+                "/ram:GrandTotalAmount"],
             }
         return xpath_dict
 
     @api.model
-    def parse_facturx_taxes(self, taxes_xpath, namespaces):
+    def _get_facturx_invoice_type(self, xml_root, flavor, namespaces):
+        doc_type = self.multi_xpath_helper(
+            xml_root, [FACTURX_XPATHS[flavor]['document'] + '/ram:TypeCode'],
+            namespaces)
+        if doc_type == '380':
+            # Reminder: the module account_invoice_import supports
+            # refunds with type == 'in_invoice' and negative amounts and qty
+            # It will convert it to type = 'in_refund' and positive amounts/qty
+            return 'in_invoice'
+        elif doc_type == '381':
+            return 'in_refund'
+        raise UserError(_(
+            "For the moment, in the Factur-X import, we only support "
+            "type code 380 and 381. (TypeCode is %s)") % doc_type)
+
+    @api.model
+    def _get_facturx_profile(self, xml_root, flavor, namespaces):
+        return get_facturx_profile(self.multi_xpath_helper(
+            xml_root,
+            [FACTURX_XPATHS[flavor]['context'] +
+             '/ram:GuidelineSpecifiedDocumentContextParameter/ram:ID'],
+            namespaces))
+
+    @api.model
+    def _fix_facturx_partner(self, partner):
+        # Hack for the sample ZUGFeRD invoices that use an invalid VAT number !
+        if partner.get('vat') == 'DE123456789':
+            partner.pop('vat')
+            if not partner.get('email'):
+                partner['name'] = 'Lieferant GmbH'
+
+    @api.model
+    def parse_facturx_invoice_header(self, xml_root):
+        """Header-only parsing of a Cross Industry Invoice XML file (see
+        parse_invoice_header()): the lines, the taxes and the allowances
+        and charges are not read, and the XML schema is not checked"""
+        namespaces = xml_root.nsmap
+        flavor = get_facturx_flavor(xml_root)
+        paths = FACTURX_XPATHS[flavor]
+        xpath_dict = self.prepare_facturx_xpath_dict(flavor=flavor)
+        res = self.xpath_to_dict_helper(
+            xml_root, dict([(key, xpath_dict[key]) for key in
+                            FACTURX_HEADER_KEYS]), namespaces)
+        amount_tax = self.multi_xpath_helper(
+            xml_root,
+            [paths['settlement'] + '/' + paths['summation'] +
+             "/ram:TaxTotalAmount"], namespaces, isfloat=True)
+        res.update({
+            'type': self._get_facturx_invoice_type(
+                xml_root, flavor, namespaces),
+            'amount_untaxed': res['amount_total'] - amount_tax,
+            'profile': self._get_facturx_profile(
+                xml_root, flavor, namespaces),
+            })
+        self._fix_facturx_partner(res['partner'])
+        logger.info('Result of Factur-X XML header parsing: %s', res)
+        return res
+
+    @api.model
+    def _get_facturx_sections(self, flavor, profile):
+        """Returns {section: True/False}: the sections of the XML file
+        that are read for this flavor and profile"""
+        skipped = FACTURX_PROFILE_SKIPPED_SECTIONS.get((flavor, profile), [])
+        return dict(
+            (section, section not in skipped) for section in FACTURX_SECTIONS)
+
+    @api.model
+    def parse_facturx_taxes(self, taxes_xpath, namespaces, flavor=None):
         taxes = []
+        value = self.element_value_helper
         for tax in taxes_xpath:
-            type_code = self.multi_xpath_helper(
-                tax, ["ram:TypeCode"], namespaces) or 'VAT'
+            if flavor is None:
+                flavor = get_facturx_flavor(tax)
+            tax_plan = get_facturx_extraction_plan(flavor, namespaces)['tax']
+            fields = {}
+            for child in tax.iterchildren(*tax_plan):
+                fields.setdefault(tax_plan[child.tag], child)
+            type_code = value(fields.get('type_code')) or 'VAT'
             # CategoryCode not available at Basic level
-            categ_code = self.multi_xpath_helper(
-                tax, ["ram:CategoryCode"], namespaces)
-            percentage = self.multi_xpath_helper(
-                tax,
-                ["ram:RateApplicablePercent",  # Factur-X
-                 "ram:ApplicablePercent",  # ZUGFeRD
-                 ], namespaces, isfloat=True) or 0.0
-            due_date_code = self.multi_xpath_helper(
-                tax, ["ram:DueDateTypeCode"], namespaces)
+            categ_code = value(fields.get('categ_code'))
+            percentage = value(fields.get('percent'), isfloat=True) or 0.0
+            due_date_code = value(fields.get('due_date_code'))
             if due_date_code == '29':
                 due_date_code = '5'
             taxes.append({
@@ -161,17 +481,21 @@ class AccountInvoiceImport(models.TransientModel):
     @api.model
     def parse_facturx_allowance_charge(
             self, acline, global_taxes, label_suffix, ac_qty_dict, counters,
-            namespaces):
+            namespaces, flavor=None):
         # This method is designed to work for global AND line charges/allowance
+        if flavor is None:
+            flavor = get_facturx_flavor(acline)
+        ac_paths = get_facturx_extraction_plan(
+            flavor, namespaces)['allowance_charge']
+        value = self.element_value_helper
         acentry = {}
-        reason = self.multi_xpath_helper(acline, ["ram:Reason"], namespaces)
+        reason = value(acline.find(ac_paths['reason']))
         if reason:
             acentry['name'] = reason
         # ChargeIndicator and ActualAmount are required field
-        acentry['price_unit'] = self.multi_xpath_helper(
-            acline, ['ram:ActualAmount'], namespaces, isfloat=True)
-        ch_indic = self.multi_xpath_helper(
-            acline, ["ram:ChargeIndicator/udt:Indicator"], namespaces)
+        acentry['price_unit'] = value(
+            acline.find(ac_paths['amount']), isfloat=True)
+        ch_indic = value(acline.find(ac_paths['indicator']))
         if ch_indic == 'false':  # allowance
             acentry['qty'] = ac_qty_dict['allowances']
             acentry['product'] = {'code': 'EDI-ALLOWANCE'}
@@ -189,77 +513,83 @@ class AccountInvoiceImport(models.TransientModel):
         else:
             raise UserError(_('Unknown ChargeIndicator %s', ch_indic))
         acentry['name'] = u'%s (%s)' % (acentry['name'], label_suffix)
-        taxes_xpath = self.raw_multi_xpath_helper(
-            acline, ["ram:CategoryTradeTax"], namespaces)
+        taxes_xpath = acline.findall(ac_paths['taxes'])
         if taxes_xpath:
             acentry['taxes'] = self.parse_facturx_taxes(
-                taxes_xpath, namespaces)
+                taxes_xpath, namespaces, flavor=flavor)
         else:
             acentry['taxes'] = global_taxes
         return acentry
 
+    @api.model
+    def _extract_facturx_line_fields(self, iline, plan):
+        """Walk the line item once and return {field: element} for the
+        fields of the extraction plan (a list of elements for the fields
+        that have several values). The missing fields are not in the
+        result. Only the elements on the paths of the plan are visited."""
+        line_lists = plan['line_lists']
+        fields = dict((field, []) for field in line_lists)
+
+        def add(field, element):
+            if field in line_lists:
+                fields[field].append(element)
+            else:
+                fields.setdefault(field, element)
+
+        def walk(element, node):
+            # iterchildren() without tags would return all the children
+            if node['children']:
+                for child in element.iterchildren(*node['children']):
+                    child_node = node['children'][child.tag]
+                    if child_node['field']:
+                        add(child_node['field'], child)
+                    walk(child, child_node)
+            if node['descendants']:
+                for child in element.iter(*node['descendants']):
+                    add(node['descendants'][child.tag], child)
+
+        walk(iline, plan['line'])
+        return fields
+
     @api.model
     def parse_facturx_invoice_line(
-            self, iline, global_taxes, ac_qty_dict, counters, namespaces):
-        xpath_dict = {
+            self, iline, global_taxes, ac_qty_dict, counters, namespaces,
+            flavor=None):
+        # All the fields of the line item are read in a single walk on the
+        # line item, instead of one XPath expression per field: for
+        # invoices with thousands of lines, it is much faster
+        if flavor is None:
+            flavor = get_facturx_flavor(iline)
+        plan = get_facturx_extraction_plan(flavor, namespaces)
+        value = self.element_value_helper
+        fields = self._extract_facturx_line_fields(iline, plan)
+        vals = {
             'product': {
-                'barcode': ["ram:SpecifiedTradeProduct/ram:GlobalID"],
-                'code': ["ram:SpecifiedTradeProduct/ram:SellerAssignedID"],
+                'barcode': value(fields.get('barcode')),
+                'code': value(fields.get('code')),
                 },
-            'name': ["ram:SpecifiedTradeProduct/ram:Name"],
-            'date_start': [
-                "ram:SpecifiedLineTradeSettlement"
-                "/ram:BillingSpecifiedPeriod"
-                "/ram:StartDateTime/udt:DateTimeString"],
-            'date_end': [
-                "ram:SpecifiedLineTradeSettlement"
-                "/ram:BillingSpecifiedPeriod"
-                "/ram:EndDateTime/udt:DateTimeString"],
+            'name': value(fields.get('name')),
+            'date_start': value(fields.get('date_start'), isdate=True),
+            'date_end': value(fields.get('date_end'), isdate=True),
             }
-        vals = self.xpath_to_dict_helper(iline, xpath_dict, namespaces)
-        price_unit_xpath = iline.xpath(
-            "ram:SpecifiedSupplyChainTradeAgreement"
-            "/ram:NetPriceProductTradePrice"
-            "/ram:ChargeAmount",
-            namespaces=namespaces)
-        qty_xpath_list = [
-            "ram:SpecifiedLineTradeDelivery/ram:BilledQuantity",  # Factur-X
-            "ram:SpecifiedSupplyChainTradeDelivery/ram:BilledQuantity",  # ZF
-            ]
-        qty = self.multi_xpath_helper(
-            iline, qty_xpath_list, namespaces, isfloat=True)
+        qty_element = fields.get('qty')
+        qty = value(qty_element, isfloat=True)
         if not qty:
             return False
         uom = {}
-        qty_xpath = self.raw_multi_xpath_helper(
-            iline, qty_xpath_list, namespaces)
-        if qty_xpath[0].attrib and qty_xpath[0].attrib.get('unitCode'):
-            unece_uom = qty_xpath[0].attrib['unitCode']
+        if qty_element.attrib.get('unitCode'):
+            unece_uom = qty_element.attrib['unitCode']
             uom = {'unece_code': unece_uom}
-        price_subtotal = self.multi_xpath_helper(
-            iline,
-            ["ram:SpecifiedLineTradeSettlement"
-             "/ram:SpecifiedTradeSettlementLineMonetarySummation"
-             "/ram:LineTotalAmount",  # Factur-X
-             "ram:SpecifiedSupplyChainTradeSettlement"
-             "/ram:SpecifiedTradeSettlementMonetarySummation"
-             "/ram:LineTotalAmount",  # ZUGFeRD
-             ], namespaces, isfloat=True)
-        if price_unit_xpath:
-            price_unit = float(price_unit_xpath[0].text)
+        price_subtotal = value(fields.get('price_subtotal'), isfloat=True)
+        if fields.get('net_price') is not None:
+            price_unit = float(fields['net_price'].text)
         else:
             price_unit = price_subtotal / qty
         counters['lines'] += price_subtotal
         # Reminder : ApplicableTradeTax not available on lines
         # at Basic level
-        taxes_xpath = self.raw_multi_xpath_helper(
-            iline,
-            ["ram:SpecifiedLineTradeSettlement"
-             "/ram:ApplicableTradeTax",  # Factur-X
-             "ram:SpecifiedSupplyChainTradeSettlement"
-             "//ram:ApplicableTradeTax",  # ZUGFeRD
-             ], namespaces)
-        taxes = self.parse_facturx_taxes(taxes_xpath, namespaces)
+        taxes = self.parse_facturx_taxes(
+            fields['taxes'], namespaces, flavor=flavor)
         vals.update({
             'qty': qty,
             'uom': uom,
@@ -267,188 +597,71 @@ class AccountInvoiceImport(models.TransientModel):
             'price_subtotal': price_subtotal,
             'taxes': taxes or global_taxes,
             })
-        iline_allowance_charge_xpath = self.raw_multi_xpath_helper(
-            iline,
-            ["ram:SpecifiedLineTradeSettlement"
-             "/ram:SpecifiedTradeAllowanceCharge",  # Factur-X
-             ], namespaces)
         res = [vals]
-        for ac_element in iline_allowance_charge_xpath:
+        for ac_element in fields.get('allowance_charges', []):
             acentry = self.parse_facturx_allowance_charge(
                 ac_element, taxes or global_taxes, vals['name'], ac_qty_dict,
-                {}, namespaces)
+                {}, namespaces, flavor=flavor)
             counters['lines'] += acentry['price_unit'] * acentry['qty']
             res.append(acentry)
         return res
 
     @api.model
-    def parse_facturx_invoice(self, xml_root):
-        """Parse Cross Industry Invoice XML file"""
-        logger.debug('Starting to parse XML file as Factur-X/ZUGFeRD file')
-        namespaces = xml_root.nsmap
-        # Check XML schema to avoid headaches trying to import invalid files
-        try:
-            check_facturx_xsd(xml_root)
-        except Exception:
-            raise UserError(_(
-                "The XML file embedded in the Factur-X invoice is invalid "
-                "according to the official XML Schema Definition."))
-        prec = self.env['decimal.precision'].precision_get('Account')  # TODO
-        logger.debug('XML file namespaces=%s', namespaces)
-        doc_type = self.multi_xpath_helper(
-            xml_root,
-            ['//rsm:ExchangedDocument/ram:TypeCode',  # Factur-X
-             '//rsm:HeaderExchangedDocument/ram:TypeCode',  # ZUGFeRD
-             ], namespaces)
-        if doc_type == '380':
-            inv_type = 'in_invoice'
-            # Reminder: the module account_invoice_import supports
-            # refunds with type == 'in_invoice' and negative amounts and qty
-            # It will convert it to type = 'in_refund' and positive amounts/qty
-        elif doc_type == '381':
-            inv_type = 'in_refund'
-        else:
-            raise UserError(_(
-                "For the moment, in the Factur-X import, we only support "
-                "type code 380 and 381. (TypeCode is %s)") % doc_type)
-
-        xpath_dict = self.prepare_facturx_xpath_dict()
-        res = self.xpath_to_dict_helper(xml_root, xpath_dict, namespaces)
-        amount_total = res['amount_total']
-        ac_qty_dict = {
-            'charges': 1,
-            'allowances': -1}
-        if (
-                float_compare(amount_total, 0, precision_digits=prec) < 0 and
-                inv_type == 'in_invoice'):
-            ac_qty_dict = {
-                'charges': -1,
-                'allowances': 1}
-
-        total_line = self.multi_xpath_helper(
-            xml_root,
-            ["//ram:ApplicableHeaderTradeSettlement"
-             "/ram:SpecifiedTradeSettlementHeaderMonetarySummation"
-             "/ram:LineTotalAmount",  # Factur-X
-             "//ram:ApplicableSupplyChainTradeSettlement"
-             "/ram:SpecifiedTradeSettlementMonetarySummation"
-             "/ram:LineTotalAmount",  # ZUGFeRD
-             ], namespaces, isfloat=True)
-        # reminder : total_line is not present in MINIMUM profile
-        total_charge = self.multi_xpath_helper(
-            xml_root,
-            ["//ram:ApplicableHeaderTradeSettlement"
-             "/ram:SpecifiedTradeSettlementHeaderMonetarySummation"
-             "/ram:ChargeTotalAmount",  # Factur-X
-             "//ram:ApplicableSupplyChainTradeSettlement"
-             "/ram:SpecifiedTradeSettlementMonetarySummation"
-             "/ram:ChargeTotalAmount",  # ZUGFeRD
-             ], namespaces, isfloat=True)
-        total_tradeallowance = self.multi_xpath_helper(
-            xml_root,
-            ["//ram:ApplicableHeaderTradeSettlement"
-             "/ram:SpecifiedTradeSettlementHeaderMonetarySummation"
-             "/ram:AllowanceTotalAmount",  # Factur-X
-             "//ram:ApplicableSupplyChainTradeSettlement"
-             "/ram:SpecifiedTradeSettlementMonetarySummation"
-             "/ram:AllowanceTotalAmount",  # ZUGFeRD
-             ], namespaces, isfloat=True)
-        amount_tax = self.multi_xpath_helper(
-            xml_root,
-            ["//ram:ApplicableHeaderTradeSettlement"
-             "/ram:SpecifiedTradeSettlementHeaderMonetarySummation"
-             "/ram:TaxTotalAmount",  # Factur-X
-             "//ram:ApplicableSupplyChainTradeSettlement"
-             "/ram:SpecifiedTradeSettlementMonetarySummation"
-             "/ram:TaxTotalAmount",  # ZUGFeRD
-             ], namespaces, isfloat=True)
-        # Check coherence
-        if total_line:
-            check_total = total_line + total_charge - total_tradeallowance\
-                + amount_tax
-            if float_compare(check_total, amount_total, precision_digits=prec):
-                raise UserError(_(
-                    "The GrandTotalAmount is %s but the sum of "
-                    "the lines plus the total charge plus the total trade "
-                    "allowance plus the total taxes is %s.")
-                    % (amount_total, check_total))
-
-        amount_untaxed = amount_total - amount_tax
-        payment_type_code = self.multi_xpath_helper(
-            xml_root,
-            ["//ram:SpecifiedTradeSettlementPaymentMeans/ram:TypeCode"],
-            namespaces)  # ZUGFeRD and Factur-X
-        iban = bic = False
-        if payment_type_code and payment_type_code in ('30', '31'):
-            iban = self.multi_xpath_helper(
-                xml_root,
-                ["//ram:SpecifiedTradeSettlementPaymentMeans"
-                 "/ram:PayeePartyCreditorFinancialAccount"
-                 "/ram:IBANID"], namespaces)  # ZUGFeRD and Factur-X
-            bic = self.multi_xpath_helper(
-                xml_root,
-                ["//ram:SpecifiedTradeSettlementPaymentMeans"
-                 "/ram:PayeeSpecifiedCreditorFinancialInstitution"
-                 "/ram:BICID"], namespaces)  # ZUGFeRD and Factur-X
-        # global_taxes only used as fallback when taxes are not detailed
-        # on invoice lines (which is the case at Basic level)
-        global_taxes_xpath = self.raw_multi_xpath_helper(
-            xml_root,
-            ["//ram:ApplicableHeaderTradeSettlement"
-             "/ram:ApplicableTradeTax",  # Factur-X
-             "//ram:ApplicableSupplyChainTradeSettlement"
-             "/ram:ApplicableTradeTax",  # ZUGFeRD
-             ], namespaces)
-        global_taxes = self.parse_facturx_taxes(global_taxes_xpath, namespaces)
-        logger.debug('global_taxes=%s', global_taxes)
-        res_lines = []
+    def _iter_facturx_lines(
+            self, xml_root, line_elements, global_taxes, ac_qty_dict, totals,
+            namespaces, flavor='factur-x', sections=None):
+        '''Generator of the lines of the invoice: the line items, then
+        the global allowances and charges'''
+        paths = FACTURX_XPATHS[flavor]
+        if sections is None:
+            sections = self._get_facturx_sections(flavor, None)
+        prec = self.env['decimal.precision'].precision_get('Account')
         counters = {
             'allowances': 0.0,
             'charges': 0.0,
             'lines': 0.0,
             }
-
-        inv_line_xpath = self.raw_multi_xpath_helper(
-            xml_root, ["//ram:IncludedSupplyChainTradeLineItem"], namespaces)
-        for iline in inv_line_xpath:
+        for iline in line_elements:
             line_list = self.parse_facturx_invoice_line(
-                iline, global_taxes, ac_qty_dict, counters, namespaces)
+                iline, global_taxes, ac_qty_dict, counters, namespaces,
+                flavor=flavor)
             if line_list is False:
                 continue
-            res_lines += line_list
+            for line in line_list:
+                yield line
 
-        if float_compare(
-                total_line, counters['lines'], precision_digits=prec):
+        if sections['lines'] and float_compare(
+                totals['line'], counters['lines'], precision_digits=prec):
             logger.warning(
                 "The global LineTotalAmount (%s) doesn't match the "
                 "sum of the LineTotalAmount of each line (%s). It can "
                 "have a diff of a few cents due to sum of rounded values vs "
-                "rounded sum policies.", total_line, counters['lines'])
+                "rounded sum policies.", totals['line'], counters['lines'])
 
         # In Factur-X, "SpecifiedTradeAllowanceCharge" is used both for
         # charges (<ram:ChargeIndicator> = TRUE, counted in ChargeTotalAmount)
         # and for allowance (<ram:ChargeIndicator> = False, counted in
         # AllowanceTotalAmount)
-        global_allowance_charge_xpath = self.raw_multi_xpath_helper(
-            xml_root,
-            ["//ram:ApplicableHeaderTradeSettlement"
-             "/ram:SpecifiedTradeAllowanceCharge",  # Factur-X
-             "//ram:ApplicableSupplyChainTradeSettlement"
-             "/ram:SpecifiedTradeAllowanceCharge",  # ZUGFeRD
-             ], namespaces)
+        global_allowance_charge_xpath = []
+        if sections['allowance_charges']:
+            global_allowance_charge_xpath = self.raw_multi_xpath_helper(
+                xml_root,
+                [paths['settlement'] + "/ram:SpecifiedTradeAllowanceCharge"],
+                namespaces)
         for ac_element in global_allowance_charge_xpath:
             acentry = self.parse_facturx_allowance_charge(
                 ac_element, global_taxes, _('Global'), ac_qty_dict, counters,
-                namespaces)
-            res_lines.append(acentry)
+                namespaces, flavor=flavor)
+            yield acentry
 
         # These LogisticsServiceCharge lines don't seem to exist in Factur-X
         # but we keep them for ZUGFeRD
-        charge_line_xpath = self.raw_multi_xpath_helper(
-            xml_root,
-            ["//ram:ApplicableSupplyChainTradeSettlement"
-             "/ram:SpecifiedLogisticsServiceCharge",  # ZUGFeRD
-             ], namespaces)
+        charge_line_xpath = []
+        if flavor == 'zugferd' and sections['allowance_charges']:
+            charge_line_xpath = self.raw_multi_xpath_helper(
+                xml_root,
+                [paths['settlement'] + "/ram:SpecifiedLogisticsServiceCharge"],
+                namespaces)
         for chline in charge_line_xpath:
             name = self.multi_xpath_helper(
                 chline, ["ram:Description"], namespaces)\
@@ -458,26 +671,27 @@ class AccountInvoiceImport(models.TransientModel):
             counters['charges'] += price_unit
             taxes_xpath = self.raw_multi_xpath_helper(
                 chline, ["ram:AppliedTradeTax"], namespaces)
-            taxes = self.parse_facturx_taxes(taxes_xpath, namespaces)
+            taxes = self.parse_facturx_taxes(
+                taxes_xpath, namespaces, flavor=flavor)
             vals = {
                 'name': name,
                 'qty': ac_qty_dict['charges'],
                 'price_unit': price_unit,
                 'taxes': taxes or global_taxes,
                 }
-            res_lines.append(vals)
+            yield vals
 
         if float_compare(
-                total_charge, counters['charges'], precision_digits=prec):
+                totals['charge'], counters['charges'], precision_digits=prec):
             if (
                     len(global_taxes) <= 1 and
                     float_is_zero(counters['charges'], precision_digits=prec)):
-                res_lines.append({
+                yield {
                     'name': _("Misc Global Charge"),
                     'qty': ac_qty_dict['charges'],
-                    'price_unit': total_charge,
+                    'price_unit': totals['charge'],
                     'taxes': global_taxes,
-                    })
+                    }
             else:
                 raise UserError(_(
                     "ChargeTotalAmount (%s) doesn't match the "
@@ -485,21 +699,21 @@ class AccountInvoiceImport(models.TransientModel):
                     "because the Factur-X XML file is at BASIC level, "
                     "and we don't have the details of taxes for the "
                     "charge lines.")
-                    % (total_charge, counters['charges']))
+                    % (totals['charge'], counters['charges']))
 
         if float_compare(
-                abs(total_tradeallowance), counters['allowances'],
+                abs(totals['tradeallowance']), counters['allowances'],
                 precision_digits=prec):
             if (
                     len(global_taxes) <= 1 and
                     float_is_zero(
                         counters['allowances'], precision_digits=prec)):
-                res_lines.append({
+                yield {
                     'name': _("Misc Global Allowance"),
                     'qty': ac_qty_dict['allowances'],
-                    'price_unit': total_tradeallowance,
+                    'price_unit': totals['tradeallowance'],
                     'taxes': global_taxes,
-                    })
+                    }
             else:
                 raise UserError(_(
                     "AllowanceTotalAmount (%s) doesn't match the "
@@ -507,8 +721,193 @@ class AccountInvoiceImport(models.TransientModel):
                     "because the Factur-X XML file is at BASIC level, "
                     "and we don't have the details of taxes for the "
                     "allowance lines.")
-                    % (abs(total_tradeallowance), counters['allowances']))
+                    % (abs(totals['tradeallowance']), counters['allowances']))
+
+    @api.model
+    def _check_facturx_xsd(self, xml_root):
+        """Validate the XML tree against the official XML Schema Definition,
+        with the compiled schema of its flavor and level"""
+        try:
+            schema = get_facturx_schema(*get_facturx_flavor_level(xml_root))
+        except Exception as e:
+            logger.debug('Cannot get the compiled Factur-X schema: %s', e)
+            schema = None
+        try:
+            if schema is None:
+                check_facturx_xsd(xml_root)
+            else:
+                schema.assertValid(xml_root)
+        except Exception:
+            raise UserError(_(
+                "The XML file embedded in the Factur-X invoice is invalid "
+                "according to the official XML Schema Definition."))
 
+    @api.model
+    def parse_facturx_invoice(self, xml_root, line_elements=None):
+        """Parse Cross Industry Invoice XML file.
+        In streaming mode, xml_root doesn't contain the line items: they
+        are given by the iterator line_elements, and the key 'lines'
+        of the result is a generator"""
+        logger.debug('Starting to parse XML file as Factur-X/ZUGFeRD file')
+        # Check XML schema to avoid headaches trying to import invalid files
+        # (not possible in streaming mode, where we never have the full
+        # XML tree in memory)
+        if line_elements is not None:
+            return self._parse_facturx_invoice(xml_root, line_elements)
+        company = self.env['res.company'].browse(
+            self.env.context.get('force_company') or
+            self.env.user.company_id.id)
+        xsd_check = company.facturx_import_xsd_check
+        if xsd_check == 'on_failure':
+            try:
+                res = self._parse_facturx_invoice(xml_root)
+            except Exception:
+                # if the file is invalid, it's the best error message
+                self._check_facturx_xsd(xml_root)
+                raise
+            # the coherence checks of post_process_invoice() also
+            # validate the file when they fail
+            res['facturx_xsd_on_failure'] = True
+            return res
+        if xsd_check == 'strict' or (
+                xsd_check == 'sampled' and
+                random.randint(1, 100) <=
+                company.facturx_import_xsd_sample_rate):
+            self._check_facturx_xsd(xml_root)
+        return self._parse_facturx_invoice(xml_root)
+
+    @api.model
+    def _get_facturx_xml_root(self, parsed_inv):
+        """Read again the XML tree of the imported Factur-X file, from the
+        file recorded in parsed_inv by parse_invoice()"""
+        file_name = parsed_inv.get('file_name')
+        file_data = (parsed_inv.get('attachments') or {}).get(file_name)
+        if file_data is None:
+            return None
+        file_data = bytes(file_data)
+        filetype = mimetypes.guess_type(file_name)
+        if filetype and filetype[0] in ['application/xml', 'text/xml']:
+            xml_roots = [etree.fromstring(file_data)]
+        else:
+            bdio = self.env['business.document.import']
+            xml_roots = bdio.get_xml_files_from_pdf(file_data).values()
+        for xml_root in xml_roots:
+            if is_facturx_tag(xml_root.tag):
+                return xml_root
+        return None
+
+    @api.model
+    def post_process_invoice(self, parsed_inv, invoice, import_config):
+        try:
+            return super(AccountInvoiceImport, self).post_process_invoice(
+                parsed_inv, invoice, import_config)
+        except UserError:
+            if parsed_inv.get('facturx_xsd_on_failure'):
+                xml_root = self._get_facturx_xml_root(parsed_inv)
+                if xml_root is not None:
+                    self._check_facturx_xsd(xml_root)
+            raise
+
+    @api.model
+    def _parse_facturx_invoice(self, xml_root, line_elements=None):
+        namespaces = xml_root.nsmap
+        streaming = line_elements is not None
+        # Detect the flavor once, and then only use the anchored paths
+        # of this flavor
+        flavor = get_facturx_flavor(xml_root)
+        paths = FACTURX_XPATHS[flavor]
+        summation = paths['settlement'] + '/' + paths['summation']
+        prec = self.env['decimal.precision'].precision_get('Account')  # TODO
+        # Read the profile first: the sections of the XML file that don't
+        # exist at this profile are skipped
+        profile = self._get_facturx_profile(xml_root, flavor, namespaces)
+        sections = self._get_facturx_sections(flavor, profile)
+        logger.debug(
+            'XML file flavor=%s profile=%s namespaces=%s',
+            flavor, profile, namespaces)
+        inv_type = self._get_facturx_invoice_type(xml_root, flavor, namespaces)
+        xpath_dict = self.prepare_facturx_xpath_dict(flavor=flavor)
+        res = self.xpath_to_dict_helper(xml_root, xpath_dict, namespaces)
+        amount_total = res['amount_total']
+        ac_qty_dict = {
+            'charges': 1,
+            'allowances': -1}
+        if (
+                float_compare(amount_total, 0, precision_digits=prec) < 0 and
+                inv_type == 'in_invoice'):
+            ac_qty_dict = {
+                'charges': -1,
+                'allowances': 1}
+
+        total_line = self.multi_xpath_helper(
+            xml_root,
+            [summation + "/ram:LineTotalAmount"], namespaces, isfloat=True)
+        # reminder : total_line is not present in MINIMUM profile
+        total_charge = self.multi_xpath_helper(
+            xml_root,
+            [summation + "/ram:ChargeTotalAmount"], namespaces, isfloat=True)
+        total_tradeallowance = self.multi_xpath_helper(
+            xml_root,
+            [summation + "/ram:AllowanceTotalAmount"], namespaces,
+            isfloat=True)
+        amount_tax = self.multi_xpath_helper(
+            xml_root,
+            [summation + "/ram:TaxTotalAmount"], namespaces, isfloat=True)
+        # Check coherence
+        if total_line:
+            check_total = total_line + total_charge - total_tradeallowance\
+                + amount_tax
+            if float_compare(check_total, amount_total, precision_digits=prec):
+                raise UserError(_(
+                    "The GrandTotalAmount is %s but the sum of "
+                    "the lines plus the total charge plus the total trade "
+                    "allowance plus the total taxes is %s.")
+                    % (amount_total, check_total))
+
+        amount_untaxed = amount_total - amount_tax
+        payment_means = paths['settlement'] +\
+            "/ram:SpecifiedTradeSettlementPaymentMeans"
+        payment_type_code = False
+        if sections['payment_means']:
+            payment_type_code = self.multi_xpath_helper(
+                xml_root, [payment_means + "/ram:TypeCode"], namespaces)
+        iban = bic = False
+        if payment_type_code and payment_type_code in ('30', '31'):
+            iban = self.multi_xpath_helper(
+                xml_root,
+                [payment_means +
+                 "/ram:PayeePartyCreditorFinancialAccount"
+                 "/ram:IBANID"], namespaces)
+            bic = self.multi_xpath_helper(
+                xml_root,
+                [payment_means +
+                 "/ram:PayeeSpecifiedCreditorFinancialInstitution"
+                 "/ram:BICID"], namespaces)
+        # global_taxes only used as fallback when taxes are not detailed
+        # on invoice lines (which is the case at Basic level)
+        global_taxes = []
+        if sections['taxes']:
+            global_taxes_xpath = self.raw_multi_xpath_helper(
+                xml_root, [paths['settlement'] + "/ram:ApplicableTradeTax"],
+                namespaces)
+            global_taxes = self.parse_facturx_taxes(
+                global_taxes_xpath, namespaces, flavor=flavor)
+        logger.debug('global_taxes=%s', global_taxes)
+        if not sections['lines']:
+            line_elements = []
+        elif not streaming:
+            line_elements = self.raw_multi_xpath_helper(
+                xml_root, [paths['line_item']], namespaces)
+        totals = {
+            'line': total_line,
+            'charge': total_charge,
+            'tradeallowance': total_tradeallowance,
+            }
+        res_lines = self._iter_facturx_lines(
+            xml_root, line_elements, global_taxes, ac_qty_dict, totals,
+            namespaces, flavor=flavor, sections=sections)
+        if not streaming:
+            res_lines = list(res_lines)
         res.update({
             'type': inv_type,
             'amount_total': amount_total,
@@ -516,11 +915,10 @@ class AccountInvoiceImport(models.TransientModel):
             'iban': iban,
             'bic': bic,
             'lines': res_lines,
+            'profile': profile,
             })
-        # Hack for the sample ZUGFeRD invoices that use an invalid VAT number !
-        if res['partner'].get('vat') == 'DE123456789':
-            res['partner'].pop('vat')
-            if not res['partner'].get('email'):
-                res['partner']['name'] = 'Lieferant GmbH'
+        if streaming:
+            res['streaming'] = True
+        self._fix_facturx_partner(res['partner'])
         logger.info('Result of Factur-X XML parsing: %s', res)
         return res
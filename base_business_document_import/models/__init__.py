@@ -1 +1,11 @@
 from . import business_document_import
+from . import res_partner
+from . import account_tax
+from . import res_country
+from . import res_currency
+from . import uom_uom
+from . import account_account
+from . import account_analytic_account
+from . import account_journal
+from . import business_document_import_memory
+from . import product
@@ -0,0 +1,34 @@
+# Copyright 2015-2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, api
+
+
+class AccountAnalyticAccount(models.Model):
+    _inherit = 'account.analytic.account'
+
+    @api.model
+    def _clear_speed_dict_cache(self):
+        self.env['business.document.import']._bump_cache_version(
+            'analytic_account')
+
+    # Invalidate business.document.import._get_analytic_account_speed_dict()
+    @api.model
+    def create(self, vals):
+        record = super().create(vals)
+        self._clear_speed_dict_cache()
+        return record
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if any(field in vals for field in ['code', 'company_id', 'active']):
+            self._clear_speed_dict_cache()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self._clear_speed_dict_cache()
+        return res
@@ -0,0 +1,42 @@
+# Copyright 2015-2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, api
+
+# Fields read by business.document.import._get_tax_match_table()
+# (sequence is used to sort the taxes of a key)
+TAX_MATCH_FIELDS = [
+    'amount', 'amount_type', 'type_tax_use', 'price_include', 'company_id',
+    'active', 'sequence']
+
+
+class AccountTax(models.Model):
+    _inherit = 'account.tax'
+
+    @api.model
+    def _clear_tax_match_table(self):
+        self.env['business.document.import']._bump_cache_version(
+            'tax_match')
+
+    # Invalidate business.document.import._get_tax_match_table()
+    @api.model
+    def create(self, vals):
+        tax = super().create(vals)
+        self._clear_tax_match_table()
+        return tax
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if any(
+                field in TAX_MATCH_FIELDS or field.startswith('unece_')
+                for field in vals):
+            self._clear_tax_match_table()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self._clear_tax_match_table()
+        return res
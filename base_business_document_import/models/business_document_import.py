@@ -2,13 +2,21 @@
 # @author: Alexis de Lattre <alexis.delattre@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import models, api, _
-from odoo.tools import float_compare
+from odoo import models, api, sql_db, tools, _
+from odoo.tools import float_compare, float_round, mute_logger
 from odoo.addons.base_iban.models.res_partner_bank import validate_iban
 from odoo.exceptions import UserError
 from lxml import etree
 from io import BytesIO
+from collections import deque
+import base64
+import bisect
+import functools
+import hashlib
+import itertools
 import mimetypes
+import psycopg2
+import time
 from urllib.parse import urlparse
 import logging
 logger = logging.getLogger(__name__)
@@ -19,10 +27,229 @@ except ImportError:
     logger.debug('Cannot import PyPDF2')
 
 
+def get_website_domain(website):
+    """Return the last 2 labels of the host of an URL, in lowercase.
+    Example: 'https://www.akretion.com/fr' -> 'akretion.com'"""
+    if not website:
+        return False
+    urlp = urlparse(website.strip())
+    netloc = urlp.netloc
+    if not urlp.scheme and not netloc:
+        netloc = urlp.path.split('/')[0]
+    netloc = netloc.split('@')[-1].split(':')[0].lower()
+    if netloc and len(netloc.split('.')) >= 2:
+        return '.'.join(netloc.split('.')[-2:])
+    return False
+
+
+def normalize_email(email):
+    """Return the e-mail address as stored in res.partner.import_email"""
+    return email and email.strip().lower() or False
+
+
+def normalize_partner_name(name):
+    """Return the name as stored in res.partner.import_name_key"""
+    return name and name.strip().casefold() or False
+
+
+def get_email_domain(email):
+    if email and '@' in email:
+        return email.strip().split('@')[-1].lower() or False
+    return False
+
+
+# Context key of the match trace: when it contains a list, the _match_*()
+# methods append an entry to it (see match_trace())
+MATCH_TRACE_KEY = 'business_document_import_match_trace'
+MATCH_TRACE_INPUT_TYPES = (str, int, float, bool)
+
+# Caches whose entries are versioned (see _get_cache_version()): the
+# version of each cache is held by a PostgreSQL sequence
+CACHE_VERSION_NAMES = [
+    'partner_identity', 'tax_match', 'country', 'country_state', 'currency',
+    'uom', 'account', 'analytic_account', 'journal']
+CACHE_VERSION_SEQUENCE = 'business_document_import_%s_cache_seq'
+
+# Strategies of _match_partner() whose result is remembered in
+# business.document.import.memory
+PARTNER_MEMORY_STRATEGIES = ('vat', 'email', 'ref')
+
+# Keys of the partner identity index -> stored column of res.partner
+PARTNER_IDENTITY_COLUMNS = {
+    'vat': 'sanitized_vat',
+    'email': 'import_email',
+    'email_domain': 'import_email_domain',
+    'website_domain': 'import_website_domain',
+    'ref': 'ref',
+    'name': 'import_name_key',
+    }
+
+
+def match_trace(entity):
+    """Decorator of the _match_*() methods of business.document.import.
+    When the context contains a list under the key MATCH_TRACE_KEY,
+    an entry is appended to it with the input of the match, the strategy
+    that matched (reported by the method via _trace_match_strategy()),
+    the matched record(s), the number of SQL queries and the elapsed time.
+    Without this context key, the method is called as usual."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, match_dict, *args, **kwargs):
+            trace = self._context.get(MATCH_TRACE_KEY)
+            if not isinstance(trace, list):
+                return method(self, match_dict, *args, **kwargs)
+            entry = {
+                'entity': entity,
+                'input': {},
+                'strategy': False,
+                'res_ids': [],
+                'error': False,
+                }
+            if isinstance(match_dict, dict):
+                entry['input'] = dict(
+                    (key, value) for (key, value) in match_dict.items()
+                    if isinstance(value, MATCH_TRACE_INPUT_TYPES) and
+                    key != 'id')
+            trace.append(entry)
+            cr = self.env.cr
+            start_queries = cr.sql_log_count
+            start = time.perf_counter()
+            try:
+                res = method(self, match_dict, *args, **kwargs)
+            except Exception as e:
+                entry['error'] = str(e)
+                raise
+            finally:
+                entry['queries'] = cr.sql_log_count - start_queries
+                entry['duration'] = round(time.perf_counter() - start, 6)
+            if not entry['strategy'] and isinstance(match_dict, dict):
+                if match_dict.get('recordset'):
+                    entry['strategy'] = 'recordset'
+                elif match_dict.get('id'):
+                    entry['strategy'] = 'id'
+            if isinstance(res, models.BaseModel):
+                entry['res_ids'] = res.ids
+            return res
+        return wrapper
+    return decorate
+
+
+class CodeIndex(dict):
+    """Speed dict (key = code in uppercase, value = record ID) that can also
+    answer prefix queries in O(log n): the codes are kept sorted in one
+    list per code length, so the shortest code starting with a prefix is
+    found with one bisect per code length."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._codes_by_length = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._codes_by_length = None
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._codes_by_length = None
+
+    def prefix_match(self, prefix):
+        """Return (code, record ID) of the shortest code that starts
+        with prefix (the lowest code if there are several codes with the
+        same length) or None if no code starts with prefix"""
+        if self._codes_by_length is None:
+            codes_by_length = {}
+            for code in self:
+                codes_by_length.setdefault(len(code), []).append(code)
+            for codes in codes_by_length.values():
+                codes.sort()
+            self._codes_by_length = sorted(codes_by_length.items())
+        for length, codes in self._codes_by_length:
+            if length < len(prefix):
+                continue
+            i = bisect.bisect_left(codes, prefix)
+            if i < len(codes) and codes[i].startswith(prefix):
+                return codes[i], self[codes[i]]
+        return None
+
+
 class BusinessDocumentImport(models.AbstractModel):
     _name = 'business.document.import'
     _description = 'Common methods to import business documents'
 
+    def init(self):
+        for name in CACHE_VERSION_NAMES:
+            self._init_cache_version(name)
+
+    @api.model
+    def _init_cache_version(self, name):
+        """Create the sequence that holds the version of the cache name
+        (to be called by the init() method of the modules that add a
+        versioned cache)"""
+        sequence = CACHE_VERSION_SEQUENCE % name
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_class WHERE relkind = 'S' AND relname = %s",
+            (sequence, ))
+        if not self.env.cr.fetchone():
+            self.env.cr.execute('CREATE SEQUENCE %s' % sequence)
+            # so that the first nextval() changes last_value
+            self.env.cr.execute('SELECT nextval(%s)', (sequence, ))
+
+    @api.model
+    def _get_cache_state(self):
+        """Versions of the caches read or bumped by the current
+        transaction: {'versions': {name: version}, 'bumped': set(names)}.
+        It is dropped at the end of the transaction."""
+        cr = self.env.cr
+        state = getattr(cr, '_business_document_import_caches', None)
+        if state is None:
+            state = {'versions': {}, 'bumped': set()}
+            cr._business_document_import_caches = state
+            dbname = cr.dbname
+
+            def end_transaction():
+                cr._business_document_import_caches = None
+
+            def after_commit():
+                end_transaction()
+                # another worker may have cached the data of its snapshot
+                # with the new versions before the commit
+                with sql_db.db_connect(dbname).cursor() as new_cr:
+                    for name in state['bumped']:
+                        new_cr.execute(
+                            'SELECT nextval(%s)',
+                            (CACHE_VERSION_SEQUENCE % name, ))
+
+            cr.after('commit', after_commit)
+            cr.after('rollback', end_transaction)
+        return state
+
+    @api.model
+    def _get_cache_version(self, name):
+        """Version of the cache name, to use in the key of the ormcache
+        of the cached methods: when the version is bumped, the entries of
+        the previous versions are not used any more (they are dropped by
+        the LRU of the ormcache). The version is read once per
+        transaction."""
+        versions = self._get_cache_state()['versions']
+        if name not in versions:
+            self.env.cr.execute(
+                'SELECT last_value FROM %s' % (CACHE_VERSION_SEQUENCE % name))
+            versions[name] = self.env.cr.fetchone()[0]
+        return versions[name]
+
+    @api.model
+    def _bump_cache_version(self, name):
+        """Invalidate the entries of the cache name in all the workers.
+        Unlike clear_cache() on an ormcache method, which clears the
+        ormcache of the whole registry in all the workers, the other
+        caches are left untouched. The version is bumped at once for
+        the current transaction, and again after the commit."""
+        state = self._get_cache_state()
+        self.env.cr.execute(
+            'SELECT nextval(%s)', (CACHE_VERSION_SEQUENCE % name, ))
+        state['versions'][name] = self.env.cr.fetchone()[0]
+        state['bumped'].add(name)
+
     @api.model
     def user_error_wrap(self, error_msg):
         assert error_msg
@@ -43,6 +270,173 @@ class BusinessDocumentImport(models.AbstractModel):
                 match_dict['state_code'] = match_dict['state_code'].upper()
 
     @api.model
+    def _trace_match_strategy(self, strategy):
+        """To be called by the _match_*() methods right before returning
+        the matched record: reports the matching strategy in the entry of
+        the match trace (if any) of the running match"""
+        trace = self._context.get(MATCH_TRACE_KEY)
+        if isinstance(trace, list):
+            # the running match is the last one that is not finished yet
+            for entry in reversed(trace):
+                if 'duration' not in entry:
+                    entry['strategy'] = strategy
+                    break
+
+    # Reference data: these records are almost never modified, so they
+    # are cached by worker. The version of the cache is bumped by the
+    # create/write/unlink methods of the related models.
+    @api.model
+    @tools.ormcache("self._get_cache_version('country')", 'code')
+    def _get_country_id(self, code):
+        return self.env['res.country'].sudo().search(
+            [('code', '=', code)], limit=1).id
+
+    @api.model
+    @tools.ormcache(
+        "self._get_cache_version('country_state')", 'country_id', 'code')
+    def _get_country_state_id(self, country_id, code):
+        return self.env['res.country.state'].sudo().search([
+            ('code', '=', code),
+            ('country_id', '=', country_id)], limit=1).id
+
+    @api.model
+    @tools.ormcache("self._get_cache_version('currency')", 'iso')
+    def _get_currency_id(self, iso):
+        return self.env['res.currency'].sudo().search(
+            [('name', '=', iso)], limit=1).id
+
+    @api.model
+    @tools.ormcache("self._get_cache_version('currency')", 'symbol')
+    def _get_currency_ids_by_symbol(self, symbol):
+        return tuple(self.env['res.currency'].sudo().search(
+            [('symbol', '=', symbol)]).ids)
+
+    @api.model
+    @tools.ormcache(
+        "self._get_cache_version('currency')", 'iso_or_symbol')
+    def _get_currency_ids_by_iso_or_symbol(self, iso_or_symbol):
+        return tuple(self.env['res.currency'].sudo().search([
+            '|',
+            ('name', '=', iso_or_symbol.upper()),
+            ('symbol', '=', iso_or_symbol)]).ids)
+
+    @api.model
+    @tools.ormcache("self._get_cache_version('uom')", 'unece_code')
+    def _get_uom_id(self, unece_code):
+        return self.env['uom.uom'].sudo().search(
+            [('unece_code', '=', unece_code)], limit=1).id
+
+    @api.model
+    def _get_match_memory_key(self, entity_dict, *extra):
+        """Return the hash that identifies the entity described by
+        entity_dict in the business documents (False if entity_dict
+        doesn't contain any identification data). extra contains the
+        parameters of the _match_*() method that influence the result
+        (partner_type, seller...)"""
+        identity = [repr(value) for value in extra]
+        entity_identity = []
+        for key in sorted(entity_dict):
+            value = entity_dict[key]
+            if (
+                    key in ('recordset', 'id', 'match_memory') or
+                    not value or
+                    not isinstance(value, (str, int, float))):
+                continue
+            if isinstance(value, str):
+                value = ' '.join(value.split()).casefold()
+            entity_identity.append('%s=%s' % (key, value))
+        if not entity_identity:
+            return False
+        identity += entity_identity
+        return hashlib.sha256(
+            '\n'.join(identity).encode('utf-8')).hexdigest()
+
+    @api.model
+    def _get_match_memory_bulk(
+            self, match_type, memory_keys, partner_type=False):
+        """Return a dict key = memory key, value = recordset
+        The remembered records must still pass the checks of the _match_*()
+        methods (company, supplier/customer): the other ones are ignored,
+        so they are matched again and their memory is updated."""
+        if not memory_keys:
+            return {}
+        company_id = self._context.get('force_company') or\
+            self.env.user.company_id.id
+        memories = self.env['business.document.import.memory'].sudo().search([
+            ('match_type', '=', match_type),
+            ('company_id', '=', company_id),
+            ('identity_hash', 'in', memory_keys)])
+        res = {}
+        for memory in memories:
+            record = memory['%s_id' % match_type].sudo(self.env.uid)
+            if not record.active:
+                continue
+            if record.company_id and record.company_id.id != company_id:
+                continue
+            if (
+                    partner_type in ('supplier', 'customer') and
+                    not record[partner_type]):
+                continue
+            res[memory.identity_hash] = record
+        return res
+
+    @api.model
+    def _get_match_memory(self, match_type, memory_key, partner_type=False):
+        if not memory_key:
+            return False
+        return self._get_match_memory_bulk(
+            match_type, [memory_key],
+            partner_type=partner_type).get(memory_key, False)
+
+    @api.model
+    def _store_match_memory(self, parsed_dict):
+        """Store the partners and products matched for this business
+        document, so that the next documents with the same identification
+        data are matched with a single lookup.
+        The products are read from parsed_dict['lines']: in streaming
+        mode, the caller must call this method on each chunk of lines."""
+        entity_dicts = [parsed_dict.get('partner') or {}]
+        for line in parsed_dict.get('lines') or []:
+            if isinstance(line, dict) and line.get('product'):
+                entity_dicts.append(line['product'])
+        to_store = {}
+        for entity_dict in entity_dicts:
+            if entity_dict.get('match_memory'):
+                match_type, memory_key, res_id = entity_dict['match_memory']
+                to_store[(match_type, memory_key)] = res_id
+        if not to_store:
+            return
+        company_id = self._context.get('force_company') or\
+            self.env.user.company_id.id
+        bdimo = self.env['business.document.import.memory'].sudo()
+        existing = bdimo.search([
+            ('company_id', '=', company_id),
+            ('identity_hash', 'in', [key for (mtype, key) in to_store])])
+        for memory in existing:
+            res_id = to_store.pop(
+                (memory.match_type, memory.identity_hash), None)
+            field = '%s_id' % memory.match_type
+            if res_id and memory[field].id != res_id:
+                # the remembered record didn't pass the checks any more
+                memory.write({field: res_id})
+        for (match_type, memory_key), res_id in to_store.items():
+            # Another import may store the same memory at the same time:
+            # then, keep its memory
+            try:
+                with mute_logger('odoo.sql_db'), self.env.cr.savepoint():
+                    bdimo.create({
+                        'match_type': match_type,
+                        'identity_hash': memory_key,
+                        'company_id': company_id,
+                        '%s_id' % match_type: res_id,
+                        })
+            except psycopg2.IntegrityError:
+                logger.debug(
+                    'Match memory %s already stored by another transaction',
+                    memory_key)
+
+    @api.model
+    @match_trace('partner')
     def _match_partner(
             self, partner_dict, chatter_msg, partner_type='supplier'):
         """Example:
@@ -65,6 +459,25 @@ class BusinessDocumentImport(models.AbstractModel):
             return partner_dict['recordset']
         if partner_dict.get('id'):
             return rpo.browse(partner_dict['id'])
+        memory_key = self._get_match_memory_key(partner_dict, partner_type)
+        partner = self._get_match_memory(
+            'partner', memory_key, partner_type=partner_type)
+        if partner:
+            self._trace_match_strategy('memory')
+            return partner
+        partner, strategy = self._match_partner_cascade(
+            partner_dict, chatter_msg, partner_type=partner_type)
+        # The guesses of the weak strategies (domain name, name...) are
+        # not remembered: they must be checked on every document
+        if memory_key and strategy in PARTNER_MEMORY_STRATEGIES:
+            # will be stored by post_create_or_update()
+            partner_dict['match_memory'] = ('partner', memory_key, partner.id)
+        return partner
+
+    @api.model
+    def _match_partner_cascade(
+            self, partner_dict, chatter_msg, partner_type='supplier'):
+        """Return (partner, matching strategy)"""
         company_id = self._context.get('force_company') or\
             self.env.user.company_id.id
         domain = [
@@ -78,10 +491,10 @@ class BusinessDocumentImport(models.AbstractModel):
             partner_type_label = _('customer')
         else:
             partner_type_label = _('partner')
-        country = False
+        country = state = False
         if partner_dict.get('country_code'):
-            country = self.env['res.country'].search([
-                ('code', '=', partner_dict['country_code'])], limit=1)
+            country = self.env['res.country'].browse(
+                self._get_country_id(partner_dict['country_code']))
             if country:
                 domain += [
                     '|',
@@ -93,23 +506,28 @@ class BusinessDocumentImport(models.AbstractModel):
                     "country code. But there are no country with that code "
                     "in Odoo.") % partner_dict['country_code'])
         if country and partner_dict.get('state_code'):
-            state = self.env['res.country.state'].search([
-                ('code', '=', partner_dict['state_code']),
-                ('country_id', '=', country.id)], limit=1)
+            state = self.env['res.country.state'].browse(
+                self._get_country_state_id(
+                    country.id, partner_dict['state_code']))
             if state:
                 domain += [
                     '|',
                     ('state_id', '=', False),
                     ('state_id', '=', state.id)]
+        index = self._get_partner_identity_index(company_id)
+        probe_kwargs = {
+            'partner_type': partner_type,
+            'country_id': country and country.id or False,
+            'state_id': state and state.id or False,
+            }
         if partner_dict.get('vat'):
             vat = partner_dict['vat'].replace(' ', '').upper()
             # use base_vat_sanitized
-            partner = rpo.search(
-                domain + [
-                    ('parent_id', '=', False),
-                    ('sanitized_vat', '=', vat)], limit=1)
+            partner = self._probe_partner_identity_index(
+                index, 'vat', vat, commercial_only=True, **probe_kwargs)
             if partner:
-                return partner
+                self._trace_match_strategy('vat')
+                return partner, 'vat'
             else:
                 chatter_msg.append(_(
                     "The analysis of the business document returned '%s' as "
@@ -120,53 +538,53 @@ class BusinessDocumentImport(models.AbstractModel):
         partner = self._hook_match_partner(
             partner_dict, chatter_msg, domain, partner_type_label)
         if partner:
-            return partner
-        website_domain = False
+            self._trace_match_strategy('hook')
+            return partner, 'hook'
+        website_domain = get_website_domain(partner_dict.get('website'))
         email_domain = False
         if partner_dict.get('email') and '@' in partner_dict['email']:
-            partner = rpo.search(
-                domain + [('email', '=ilike', partner_dict['email'])], limit=1)
+            partner = self._probe_partner_identity_index(
+                index, 'email', normalize_email(partner_dict['email']),
+                **probe_kwargs)
             if partner:
-                return partner
+                self._trace_match_strategy('email')
+                return partner, 'email'
             else:
-                email_domain = partner_dict['email'].split('@')[1]
-        if partner_dict.get('website'):
-            urlp = urlparse(partner_dict['website'])
-            netloc = urlp.netloc
-            if not urlp.scheme and not netloc:
-                netloc = urlp.path
-            if netloc and len(netloc.split('.')) >= 2:
-                website_domain = '.'.join(netloc.split('.')[-2:])
+                email_domain = get_email_domain(partner_dict['email'])
         if website_domain or email_domain:
             partner_domain = website_domain or email_domain
-            partner = rpo.search(
-                domain +
-                [('website', '=ilike', '%' + partner_domain + '%')], limit=1)
+            partner = self._probe_partner_identity_index(
+                index, 'website_domain', partner_domain, **probe_kwargs)
+            strategy = 'website_domain'
             # I can't search on email addresses with
             # email_domain because of the emails such as
             # @gmail.com, @yahoo.com that may match random partners
             if not partner and website_domain:
-                partner = rpo.search(
-                    domain +
-                    [('email', '=ilike', '%@' + website_domain)], limit=1)
+                partner = self._probe_partner_identity_index(
+                    index, 'email_domain', website_domain, **probe_kwargs)
+                strategy = 'email_domain'
             if partner:
+                self._trace_match_strategy(strategy)
                 chatter_msg.append(_(
                     "The %s has been identified by the domain name '%s' "
                     "so please check carefully that the %s is correct.") % (
                         partner_type_label,
                         partner_domain,
                         partner_type_label))
-                return partner
+                return partner, strategy
         if partner_dict.get('ref'):
-            partner = rpo.search(
-                domain + [('ref', '=', partner_dict['ref'])], limit=1)
+            partner = self._probe_partner_identity_index(
+                index, 'ref', partner_dict['ref'], **probe_kwargs)
             if partner:
-                return partner
+                self._trace_match_strategy('ref')
+                return partner, 'ref'
         if partner_dict.get('name'):
-            partner = rpo.search(
-                domain + [('name', '=ilike', partner_dict['name'])], limit=1)
+            partner = self._probe_partner_identity_index(
+                index, 'name', normalize_partner_name(partner_dict['name']),
+                **probe_kwargs)
             if partner:
-                return partner
+                self._trace_match_strategy('name')
+                return partner, 'name'
         raise self.user_error_wrap(_(
             "Odoo couldn't find any %s corresponding to the following "
             "information extracted from the business document:\n"
@@ -194,6 +612,95 @@ class BusinessDocumentImport(models.AbstractModel):
         return False
 
     @api.model
+    @tools.ormcache(
+        "self._get_cache_version('partner_identity')", 'company_id')
+    def _get_partner_identity_index(self, company_id):
+        """Build the in-memory index used by _match_partner() for the
+        partners of company_id (and the partners without company).
+        The result is cached by worker, and its version is bumped by the
+        create/write/unlink methods of res.partner when they modify the
+        fields read here.
+        When there are more partners than the value of the system
+        parameter business_document_import.partner_index_max_size,
+        the index is not built: _probe_partner_identity_index() then
+        searches the indexed identity columns of res.partner.
+        Don't modify the returned dict !"""
+        rpo = self.env['res.partner'].sudo()
+        cdomain = [('company_id', 'in', [False, company_id])]
+        max_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'business_document_import.partner_index_max_size', 50000))
+        if rpo.search_count(cdomain) > max_size:
+            logger.debug(
+                'Too many partners for company ID %d: matching partners '
+                'via SQL', company_id)
+            return {'company_id': company_id, 'partners': None}
+        logger.debug('Building partner identity index for company ID %d',
+                     company_id)
+        partners = rpo.search(cdomain)
+        index = {
+            'company_id': company_id,
+            'partners': {},
+            'vat': {},
+            'email': {},
+            'email_domain': {},
+            'website_domain': {},
+            'ref': {},
+            'name': {},
+            }
+        # read() keeps the order of search(), so the first partner of each
+        # list is the one that search(limit=1) would have returned
+        for pdict in partners.read(
+                list(PARTNER_IDENTITY_COLUMNS.values()) + [
+                    'supplier', 'customer', 'parent_id', 'country_id',
+                    'state_id'], load='_classic_write'):
+            index['partners'][pdict['id']] = (
+                pdict['supplier'], pdict['customer'], pdict['parent_id'],
+                pdict['country_id'], pdict['state_id'])
+            for key, column in PARTNER_IDENTITY_COLUMNS.items():
+                if pdict[column]:
+                    index[key].setdefault(
+                        pdict[column], []).append(pdict['id'])
+        return index
+
+    @api.model
+    def _probe_partner_identity_index(
+            self, index, key, value, partner_type=False, country_id=False,
+            state_id=False, commercial_only=False):
+        """Return the first partner of the index for this key/value that
+        has the same properties as the ones required by the search domain
+        built in _match_partner()"""
+        rpo = self.env['res.partner']
+        if index['partners'] is None:
+            domain = [
+                ('company_id', 'in', [False, index['company_id']]),
+                (PARTNER_IDENTITY_COLUMNS[key], '=', value)]
+            if partner_type in ('supplier', 'customer'):
+                domain.append((partner_type, '=', True))
+            if commercial_only:
+                domain.append(('parent_id', '=', False))
+            if country_id:
+                domain.append(('country_id', 'in', [False, country_id]))
+            if state_id:
+                domain.append(('state_id', 'in', [False, state_id]))
+            return rpo.browse(rpo.sudo().search(domain, limit=1).id)
+        for partner_id in index[key].get(value, []):
+            supplier, customer, parent_id, pcountry_id, pstate_id =\
+                index['partners'][partner_id]
+            if partner_type == 'supplier' and not supplier:
+                continue
+            if partner_type == 'customer' and not customer:
+                continue
+            if commercial_only and parent_id:
+                continue
+            if country_id and pcountry_id not in (False, country_id):
+                continue
+            if state_id and pstate_id not in (False, state_id):
+                continue
+            return rpo.browse(partner_id)
+        return rpo
+
+    @api.model
+    @match_trace('shipping_partner')
     def _match_shipping_partner(self, shipping_dict, partner, chatter_msg):
         """Example:
         shipping_dict = {
@@ -225,8 +732,8 @@ class BusinessDocumentImport(models.AbstractModel):
         country = False
         parent_partner_matches = True
         if address_dict.get('country_code'):
-            country = self.env['res.country'].search([
-                ('code', '=', address_dict['country_code'])], limit=1)
+            country = self.env['res.country'].browse(
+                self._get_country_id(address_dict['country_code']))
             if country:
                 domain += [
                     '|',
@@ -240,9 +747,9 @@ class BusinessDocumentImport(models.AbstractModel):
                     "country code. But there are no country with that code "
                     "in Odoo.") % address_dict['country_code'])
         if country and address_dict.get('state_code'):
-            state = self.env['res.country.state'].search([
-                ('code', '=', address_dict['state_code']),
-                ('country_id', '=', country.id)], limit=1)
+            state = self.env['res.country.state'].browse(
+                self._get_country_state_id(
+                    country.id, address_dict['state_code']))
             if state:
                 domain += [
                     '|',
@@ -257,11 +764,14 @@ class BusinessDocumentImport(models.AbstractModel):
                 parent_partner_matches = False
         spartner = rpo.search(domain + [('type', '=', 'delivery')], limit=1)
         if spartner:
+            self._trace_match_strategy('delivery_address')
             return spartner
         spartner = rpo.search(domain, limit=1)
         if spartner:
+            self._trace_match_strategy('address')
             return spartner
         if parent_partner_matches:
+            self._trace_match_strategy('parent_partner')
             return partner
         raise self.user_error_wrap(_(
             "Odoo couldn't find any shipping partner corresponding to the "
@@ -278,6 +788,7 @@ class BusinessDocumentImport(models.AbstractModel):
                 ))
 
     @api.model
+    @match_trace('partner_bank')
     def _match_partner_bank(
             self, partner, iban, bic, chatter_msg, create_if_not_found=False):
         assert iban, 'iban is a required arg'
@@ -300,6 +811,7 @@ class BusinessDocumentImport(models.AbstractModel):
             ('sanitized_acc_number', '=', iban),
             ('partner_id', '=', partner.id)], limit=1)
         if bankaccount:
+            self._trace_match_strategy('iban')
             return bankaccount
         elif create_if_not_found:
             bank_id = False
@@ -324,6 +836,7 @@ class BusinessDocumentImport(models.AbstractModel):
                 "added on the supplier "
                 "<a href=# data-oe-model=res.partner data-oe-id=%d>%s</a>") % (
                 iban, partner.id, partner.display_name))
+            self._trace_match_strategy('created')
             return partner_bank
         else:
             chatter_msg.append(_(
@@ -336,6 +849,7 @@ class BusinessDocumentImport(models.AbstractModel):
                 % (iban, partner.id, partner.display_name))
 
     @api.model
+    @match_trace('product')
     def _match_product(self, product_dict, chatter_msg, seller=False):
         """Example:
         product_dict = {
@@ -349,6 +863,22 @@ class BusinessDocumentImport(models.AbstractModel):
             return product_dict['recordset']
         if product_dict.get('id'):
             return ppo.browse(product_dict['id'])
+        memory_key = self._get_match_memory_key(
+            product_dict, seller and seller.id)
+        product = self._get_match_memory('product', memory_key)
+        if product:
+            self._trace_match_strategy('memory')
+            return product
+        product = self._match_product_cascade(
+            product_dict, chatter_msg, seller=seller)
+        if memory_key:
+            # will be stored by post_create_or_update()
+            product_dict['match_memory'] = ('product', memory_key, product.id)
+        return product
+
+    @api.model
+    def _match_product_cascade(self, product_dict, chatter_msg, seller=False):
+        ppo = self.env['product.product']
         company_id = self._context.get('force_company') or\
             self.env.user.company_id.id
         cdomain = [
@@ -357,6 +887,7 @@ class BusinessDocumentImport(models.AbstractModel):
             product = ppo.search(cdomain + [
                 ('barcode', '=', product_dict['barcode'])], limit=1)
             if product:
+                self._trace_match_strategy('barcode')
                 return product
         if product_dict.get('code'):
             product = ppo.search(cdomain + [
@@ -364,6 +895,7 @@ class BusinessDocumentImport(models.AbstractModel):
                 ('barcode', '=', product_dict['code']),
                 ('default_code', '=', product_dict['code'])], limit=1)
             if product:
+                self._trace_match_strategy('code')
                 return product
             # WARNING: Won't work for multi-variant products
             # because product.supplierinfo is attached to product template
@@ -378,6 +910,7 @@ class BusinessDocumentImport(models.AbstractModel):
                         len(
                         sinfo.product_tmpl_id.product_variant_ids) == 1
                 ):
+                    self._trace_match_strategy('supplierinfo')
                     return sinfo.product_tmpl_id.product_variant_ids[0]
         raise self.user_error_wrap(_(
             "Odoo couldn't find any product corresponding to the "
@@ -390,6 +923,7 @@ class BusinessDocumentImport(models.AbstractModel):
                 seller and seller.name or 'None'))
 
     @api.model
+    @match_trace('currency')
     def _match_currency(self, currency_dict, chatter_msg):
         """Example:
         currency_dict = {
@@ -408,9 +942,9 @@ class BusinessDocumentImport(models.AbstractModel):
             return rco.browse(currency_dict['id'])
         if currency_dict.get('iso'):
             currency_iso = currency_dict['iso'].upper()
-            currency = rco.search(
-                [('name', '=', currency_iso)], limit=1)
+            currency = rco.browse(self._get_currency_id(currency_iso))
             if currency:
+                self._trace_match_strategy('iso')
                 return currency
             else:
                 raise self.user_error_wrap(_(
@@ -418,9 +952,10 @@ class BusinessDocumentImport(models.AbstractModel):
                     "the currency ISO code. But there are no currency "
                     "with that code in Odoo.") % currency_iso)
         if currency_dict.get('symbol'):
-            currencies = rco.search(
-                [('symbol', '=', currency_dict['symbol'])])
+            currencies = rco.browse(
+                self._get_currency_ids_by_symbol(currency_dict['symbol']))
             if len(currencies) == 1:
+                self._trace_match_strategy('symbol')
                 return currencies[0]
             else:
                 chatter_msg.append(_(
@@ -429,11 +964,10 @@ class BusinessDocumentImport(models.AbstractModel):
                     "currencies with that symbol in Odoo.")
                     % currency_dict['symbol'])
         if currency_dict.get('iso_or_symbol'):
-            currencies = rco.search([
-                '|',
-                ('name', '=', currency_dict['iso_or_symbol'].upper()),
-                ('symbol', '=', currency_dict['iso_or_symbol'])])
+            currencies = rco.browse(self._get_currency_ids_by_iso_or_symbol(
+                currency_dict['iso_or_symbol']))
             if len(currencies) == 1:
+                self._trace_match_strategy('iso_or_symbol')
                 return currencies[0]
             else:
                 raise self.user_error_wrap(_(
@@ -443,10 +977,11 @@ class BusinessDocumentImport(models.AbstractModel):
                     % currency_dict['iso_or_symbol'])
         if currency_dict.get('country_code'):
             country_code = currency_dict['country_code']
-            country = self.env['res.country'].search([
-                ('code', '=', country_code)], limit=1)
+            country = self.env['res.country'].browse(
+                self._get_country_id(country_code))
             if country:
                 if country.currency_id:
+                    self._trace_match_strategy('country')
                     return country.currency_id
                 else:
                     raise self.user_error_wrap(_(
@@ -470,9 +1005,11 @@ class BusinessDocumentImport(models.AbstractModel):
         chatter_msg.append(_(
             'No currency specified, so Odoo used the company currency (%s)')
             % company_cur.name)
+        self._trace_match_strategy('company')
         return company_cur
 
     @api.model
+    @match_trace('uom')
     def _match_uom(self, uom_dict, chatter_msg, product=False):
         """Example:
         uom_dict = {
@@ -492,9 +1029,9 @@ class BusinessDocumentImport(models.AbstractModel):
             # Map NIU to Unit
             if uom_dict['unece_code'] == 'NIU':
                 uom_dict['unece_code'] = 'C62'
-            uom = uuo.search([
-                ('unece_code', '=', uom_dict['unece_code'])], limit=1)
+            uom = uuo.browse(self._get_uom_id(uom_dict['unece_code']))
             if uom:
+                self._trace_match_strategy('unece_code')
                 return uom
             else:
                 chatter_msg.append(_(
@@ -507,8 +1044,10 @@ class BusinessDocumentImport(models.AbstractModel):
             uom = uuo.search([
                 ('name', '=ilike', uom_dict['name'] + '%')], limit=1)
             if uom:
+                self._trace_match_strategy('name')
                 return uom
         if product:
+            self._trace_match_strategy('product')
             return product.uom_id
         chatter_msg.append(_(
             "<p>Odoo couldn't find any unit of measure corresponding to the "
@@ -518,6 +1057,7 @@ class BusinessDocumentImport(models.AbstractModel):
             "<p>So the unit of measure 'Unit(s)' has been used. <em>You may "
             "have to change it manually.</em></p>")
             % (uom_dict.get('unece_code'), uom_dict.get('name')))
+        self._trace_match_strategy('default')
         return self.env.ref('uom.product_uom_unit')
 
     @api.model
@@ -533,6 +1073,7 @@ class BusinessDocumentImport(models.AbstractModel):
         return taxes_recordset
 
     @api.model
+    @match_trace('tax')
     def _match_tax(
             self, tax_dict, chatter_msg,
             type_tax_use='purchase', price_include=False):
@@ -553,38 +1094,15 @@ class BusinessDocumentImport(models.AbstractModel):
             return ato.browse(tax_dict['id'])
         company_id = self._context.get('force_company') or\
             self.env.user.company_id.id
-        domain = [('company_id', '=', company_id)]
-        if type_tax_use == 'purchase':
-            domain.append(('type_tax_use', '=', 'purchase'))
-        elif type_tax_use == 'sale':
-            domain.append(('type_tax_use', '=', 'sale'))
-        if price_include is False:
-            domain.append(('price_include', '=', False))
-        elif price_include is True:
-            domain.append(('price_include', '=', True))
-        # with the code above, if you set price_include=None, it will
-        # won't depend on the value of the price_include parameter
         assert tax_dict.get('amount_type') in ['fixed', 'percent'],\
             'bad tax type'
         assert 'amount' in tax_dict, 'Missing amount key in tax_dict'
-        domain.append(('amount_type', '=', tax_dict['amount_type']))
-        if tax_dict.get('unece_type_code'):
-            domain.append(
-                ('unece_type_code', '=', tax_dict['unece_type_code']))
-        if tax_dict.get('unece_categ_code'):
-            domain.append(
-                ('unece_categ_code', '=', tax_dict['unece_categ_code']))
-        if tax_dict.get('unece_due_date_code'):
-            domain += [
-                '|',
-                ('unece_due_date_code', '=', tax_dict['unece_due_date_code']),
-                ('unece_due_date_code', '=', False)]
-        taxes = ato.search(domain, order='unece_due_date_code')
-        for tax in taxes:
-            tax_amount = tax.amount  # 'amount' field : digits=(16, 4)
-            if not float_compare(
-                    tax_dict['amount'], tax_amount, precision_digits=4):
-                return tax
+        tax_ids = self._get_tax_match_ids(
+            self._get_tax_match_table(company_id), tax_dict, type_tax_use,
+            price_include)
+        if tax_ids:
+            self._trace_match_strategy('signature')
+            return ato.browse(tax_ids[0])
         raise self.user_error_wrap(_(
             "Odoo couldn't find any tax with 'Tax Application' = '%s' "
             "and 'Tax Included in Price' = '%s' which correspond to the "
@@ -599,6 +1117,227 @@ class BusinessDocumentImport(models.AbstractModel):
                 tax_dict['amount'],
                 tax_dict['amount_type'] == 'percent' and '%' or _('(fixed)')))
 
+    @api.model
+    def resolve_parsed_document(
+            self, parsed_doc, seller=False, products=True, uoms=True,
+            taxes=True, type_tax_use='purchase', price_include=False):
+        """Resolve in bulk the products, units of measure and taxes of
+        parsed_doc['lines'] and write the result in the 'recordset' key of
+        each dict, so that the calls to _match_product(), _match_uom() and
+        _match_tax() that follow don't hit the database any more.
+        The dicts that can't be resolved are left untouched: the _match_*()
+        methods will process them as usual (and raise the usual errors).
+        type_tax_use and price_include must have the same value as the ones
+        that will be given to _match_taxes() afterwards."""
+        lines = parsed_doc.get('lines') or []
+        if products:
+            self._resolve_products(
+                [line['product'] for line in lines if line.get('product')],
+                seller=seller)
+        if uoms:
+            self._resolve_uoms(
+                [line['uom'] for line in lines if line.get('uom')])
+        if taxes:
+            self._resolve_taxes(
+                [tax for line in lines for tax in line.get('taxes') or []],
+                type_tax_use=type_tax_use, price_include=price_include)
+        return parsed_doc
+
+    @api.model
+    def _resolve_products(self, product_dicts, seller=False):
+        ppo = self.env['product.product']
+        todo = []
+        for product_dict in product_dicts:
+            self._strip_cleanup_dict(product_dict)
+            if (
+                    not product_dict.get('recordset') and
+                    not product_dict.get('id') and
+                    (product_dict.get('barcode') or product_dict.get('code'))):
+                todo.append(product_dict)
+        if not todo:
+            return
+        memory_keys = {}
+        for product_dict in todo:
+            memory_key = self._get_match_memory_key(
+                product_dict, seller and seller.id)
+            if memory_key:
+                memory_keys[id(product_dict)] = memory_key
+        memory = self._get_match_memory_bulk(
+            'product', list(memory_keys.values()))
+        for product_dict in todo:
+            product = memory.get(memory_keys.get(id(product_dict)))
+            if product:
+                product_dict['recordset'] = product
+        todo = [pd for pd in todo if not pd.get('recordset')]
+        if not todo:
+            return
+        barcodes = set([pd['barcode'] for pd in todo if pd.get('barcode')])
+        codes = set([pd['code'] for pd in todo if pd.get('code')])
+        company_id = self._context.get('force_company') or\
+            self.env.user.company_id.id
+        cdomain = [
+            '|', ('company_id', '=', False), ('company_id', '=', company_id)]
+        # Same order as the search(limit=1) of _match_product(), so the
+        # first product registered for a key is the one it would return
+        by_barcode = {}
+        by_code = {}
+        for product in ppo.search(cdomain + [
+                '|',
+                ('barcode', 'in', list(barcodes | codes)),
+                ('default_code', 'in', list(codes))]):
+            if product.barcode:
+                by_barcode.setdefault(product.barcode, product)
+                by_code.setdefault(product.barcode, product)
+            if product.default_code:
+                by_code.setdefault(product.default_code, product)
+        unresolved_codes = set()
+        for product_dict in todo:
+            product = by_barcode.get(product_dict.get('barcode')) or\
+                by_code.get(product_dict.get('code'))
+            if product:
+                product_dict['recordset'] = product
+            elif product_dict.get('code'):
+                unresolved_codes.add(product_dict['code'])
+        if not seller or not unresolved_codes:
+            return
+        by_seller_code = {}
+        for sinfo in self.env['product.supplierinfo'].search(cdomain + [
+                ('name', '=', seller.id),
+                ('product_code', 'in', list(unresolved_codes)),
+                ]):
+            by_seller_code.setdefault(sinfo.product_code, sinfo)
+        for product_dict in todo:
+            sinfo = by_seller_code.get(product_dict.get('code'))
+            if (
+                    not product_dict.get('recordset') and
+                    sinfo and
+                    len(sinfo.product_tmpl_id.product_variant_ids) == 1):
+                product_dict['recordset'] =\
+                    sinfo.product_tmpl_id.product_variant_ids[0]
+        for product_dict in todo:
+            if (
+                    product_dict.get('recordset') and
+                    id(product_dict) in memory_keys):
+                product_dict['match_memory'] = (
+                    'product', memory_keys[id(product_dict)],
+                    product_dict['recordset'].id)
+
+    @api.model
+    def _resolve_uoms(self, uom_dicts):
+        todo = []
+        for uom_dict in uom_dicts:
+            self._strip_cleanup_dict(uom_dict)
+            if (
+                    not uom_dict.get('recordset') and
+                    not uom_dict.get('id') and
+                    uom_dict.get('unece_code')):
+                # Map NIU to Unit, as in _match_uom()
+                if uom_dict['unece_code'] == 'NIU':
+                    uom_dict['unece_code'] = 'C62'
+                todo.append(uom_dict)
+        if not todo:
+            return
+        uuo = self.env['uom.uom']
+        for uom_dict in todo:
+            uom_id = self._get_uom_id(uom_dict['unece_code'])
+            if uom_id:
+                uom_dict['recordset'] = uuo.browse(uom_id)
+
+    @api.model
+    def _resolve_taxes(
+            self, tax_dicts, type_tax_use='purchase', price_include=False):
+        todo = []
+        for tax_dict in tax_dicts:
+            self._strip_cleanup_dict(tax_dict)
+            if (
+                    not tax_dict.get('recordset') and
+                    not tax_dict.get('id') and
+                    tax_dict.get('amount_type') in ('fixed', 'percent') and
+                    'amount' in tax_dict):
+                todo.append(tax_dict)
+        if not todo:
+            return
+        ato = self.env['account.tax']
+        company_id = self._context.get('force_company') or\
+            self.env.user.company_id.id
+        # All the tax dicts are looked up in the same tax match table:
+        # no query, whatever the number of lines
+        table = self._get_tax_match_table(company_id)
+        for tax_dict in todo:
+            tax_ids = self._get_tax_match_ids(
+                table, tax_dict, type_tax_use, price_include)
+            if tax_ids:
+                tax_dict['recordset'] = ato.browse(tax_ids[0])
+
+    @api.model
+    def _get_tax_match_ids(
+            self, table, tax_dict, type_tax_use, price_include):
+        """Return the IDs of the taxes of the tax match table that
+        correspond to tax_dict, the best one first"""
+        # None is the wildcard of the keys of the table: with
+        # price_include=None, the match won't depend on the value of the
+        # price_include field of the tax
+        key = (
+            type_tax_use if type_tax_use in ('purchase', 'sale') else None,
+            price_include if price_include in (True, False) else None,
+            tax_dict['amount_type'],
+            tax_dict.get('unece_type_code') or None,
+            tax_dict.get('unece_categ_code') or None,
+            self._tax_match_rate_key(tax_dict['amount']),
+            )
+        if tax_dict.get('unece_due_date_code'):
+            # taxes with the same due date code first,
+            # then taxes without due date code
+            return table.get(
+                key + (tax_dict['unece_due_date_code'], ), []) +\
+                table.get(key + (False, ), [])
+        return table.get(key + (None, ), [])
+
+    @api.model
+    def _tax_match_rate_key(self, amount):
+        # 'amount' field of account.tax: digits=(16, 4)
+        # float_compare(precision_digits=4) compares the values rounded
+        # with float_round(precision_digits=4), so 2 amounts have the same
+        # key if and only if float_compare() says they are equal (round()
+        # would not give the same result at the rounding boundaries, for
+        # example for 19.99995)
+        return float_round(amount, precision_digits=4)
+
+    @api.model
+    @tools.ormcache("self._get_cache_version('tax_match')", 'company_id')
+    def _get_tax_match_table(self, company_id):
+        """Return a dict used by _match_tax():
+        key = (type_tax_use, price_include, amount_type, unece_type_code,
+               unece_categ_code, rate, unece_due_date_code)
+        value = list of tax IDs ordered by unece_due_date_code
+        Each tax is registered under every combination of its own values
+        and None (wildcard) for the criteria that are optional in
+        _match_tax(). The result is cached by worker, and its version is
+        bumped by the create/write/unlink methods of account.tax.
+        Don't modify the returned dict !"""
+        taxes = self.env['account.tax'].sudo().search([
+            ('company_id', '=', company_id)])
+        tax_list = taxes.read([
+            'type_tax_use', 'price_include', 'amount_type', 'amount',
+            'unece_type_code', 'unece_categ_code', 'unece_due_date_code',
+            'sequence'])
+        # same as ORDER BY unece_due_date_code (NULLs last in PostgreSQL)
+        tax_list.sort(key=lambda t: (
+            not t['unece_due_date_code'], t['unece_due_date_code'] or '',
+            t['sequence'], t['id']))
+        table = {}
+        for tax in tax_list:
+            for key in itertools.product(
+                    (tax['type_tax_use'], None),
+                    (tax['price_include'], None),
+                    (tax['amount_type'], ),
+                    (tax['unece_type_code'], None),
+                    (tax['unece_categ_code'], None),
+                    (self._tax_match_rate_key(tax['amount']), ),
+                    (tax['unece_due_date_code'], None)):
+                table.setdefault(key, []).append(tax['id'])
+        return table
+
     def compare_lines(
             self, existing_lines, import_lines, chatter_msg,
             qty_precision=None, price_precision=None, seller=False):
@@ -644,12 +1383,18 @@ class BusinessDocumentImport(models.AbstractModel):
 
         The check existing_currency == import_currency must be done before
         the call to compare_lines()
+
+        Lines are paired by (product, unit of measure). When the same
+        product and unit of measure are used on several lines, the lines
+        are paired in their order.
         """
         dpo = self.env['decimal.precision']
         if qty_precision is None:
             qty_precision = dpo.precision_get('Product Unit of Measure')
         if price_precision is None:
             price_precision = dpo.precision_get('Product Price')
+        # key = (product, uom), value = existing lines in their order, so
+        # that a product present on several lines is paired in order
         existing_lines_dict = {}
         for eline in existing_lines:
             if not eline.get('product'):
@@ -658,100 +1403,89 @@ class BusinessDocumentImport(models.AbstractModel):
                     "so <b>the lines haven't been updated</b>.")
                     % eline.get('name'))
                 return False
-            if eline['product'] in existing_lines_dict:
+            existing_lines_dict.setdefault(
+                (eline['product'], eline['uom']), deque()).append(eline)
+        for iline in import_lines:
+            if not iline.get('product'):
                 chatter_msg.append(_(
-                    "The product '%s' is used on several existing "
-                    "lines, so <b>the lines haven't been updated</b>.")
-                    % eline['product'].display_name)
+                    "One of the imported lines doesn't have any product, "
+                    "so <b>the lines haven't been updated</b>."))
                 return False
-            existing_lines_dict[eline['product']] = eline
-        unique_import_products = []
+        self._resolve_products(
+            [iline['product'] for iline in import_lines], seller=seller)
+        self._resolve_uoms(
+            [iline['uom'] for iline in import_lines if iline.get('uom')])
         res = {
             'to_remove': False,
             'to_add': [],
             'to_update': {},
         }
         for iline in import_lines:
-            if not iline.get('product'):
-                chatter_msg.append(_(
-                    "One of the imported lines doesn't have any product, "
-                    "so <b>the lines haven't been updated</b>."))
-                return False
             product = self._match_product(
                 iline['product'], chatter_msg, seller=seller)
             uom = self._match_uom(iline.get('uom'), chatter_msg, product)
-            if product in unique_import_products:
-                chatter_msg.append(_(
-                    "The product '%s' is used on several imported lines, "
-                    "so <b>the lines haven't been updated</b>.")
-                    % product.display_name)
-                return False
-            unique_import_products.append(product)
-            if product in existing_lines_dict:
-                if uom != existing_lines_dict[product]['uom']:
-                    chatter_msg.append(_(
-                        "For product '%s', the unit of measure is %s on the "
-                        "existing line, but it is %s on the imported line. "
-                        "We don't support this scenario for the moment, so "
-                        "<b>the lines haven't been updated</b>.") % (
-                            product.display_name,
-                            existing_lines_dict[product]['uom'].name,
-                            uom.name,
-                    ))
-                    return False
-                # used for to_remove
-                existing_lines_dict[product]['import'] = True
-                oline = existing_lines_dict[product]['line']
+            elines = existing_lines_dict.get((product, uom))
+            if elines:
+                eline = elines.popleft()
+                oline = eline['line']
                 res['to_update'][oline] = {}
                 if float_compare(
-                        iline['qty'],
-                        existing_lines_dict[product]['qty'],
+                        iline['qty'], eline['qty'],
                         precision_digits=qty_precision):
                     res['to_update'][oline]['qty'] = [
-                        existing_lines_dict[product]['qty'],
-                        iline['qty']]
+                        eline['qty'], iline['qty']]
                 if (
                         'price_unit' in iline and
                         float_compare(
-                            iline['price_unit'],
-                            existing_lines_dict[product]['price_unit'],
+                            iline['price_unit'], eline['price_unit'],
                             precision_digits=price_precision)):
                     res['to_update'][oline]['price_unit'] = [
-                        existing_lines_dict[product]['price_unit'],
-                        iline['price_unit']]
+                        eline['price_unit'], iline['price_unit']]
             else:
                 res['to_add'].append({
                     'product': product,
                     'uom': uom,
                     'import_line': iline,
                 })
-        for exiting_dict in existing_lines_dict.values():
-            if not exiting_dict.get('import'):
-                if res['to_remove']:
-                    res['to_remove'] += exiting_dict['line']
-                else:
-                    res['to_remove'] = exiting_dict['line']
+        to_remove = [
+            eline['line'] for elines in existing_lines_dict.values()
+            for eline in elines]
+        if to_remove:
+            res['to_remove'] = self.env[to_remove[0]._name].browse(
+                [line.id for line in to_remove])
         return res
 
+    # The speed dicts are cached by worker and company. The version of
+    # their cache is bumped by the create/write/unlink methods of
+    # account.account, account.analytic.account and account.journal.
+    # Don't modify the returned speed dicts !
     def _prepare_account_speed_dict(self):
         company_id = self._context.get('force_company') or\
             self.env.user.company_id.id
-        res = self.env['account.account'].search_read([
+        return self._get_account_speed_dict(company_id)
+
+    @api.model
+    @tools.ormcache("self._get_cache_version('account')", 'company_id')
+    def _get_account_speed_dict(self, company_id):
+        res = self.env['account.account'].sudo().search_read([
             ('company_id', '=', company_id),
             ('deprecated', '=', False)], ['code'])
-        speed_dict = {}
+        speed_dict = CodeIndex()
         for l in res:
             speed_dict[l['code'].upper()] = l['id']
         return speed_dict
 
     @api.model
+    @match_trace('account')
     def _match_account(self, account_dict, chatter_msg, speed_dict=None):
         """Example:
         account_dict = {
             'code': '411100',
             }
         speed_dict is usefull to gain performance when you have a lot of
-        accounts to match
+        accounts to match. It should be built once per import by
+        _prepare_account_speed_dict(), which returns a CodeIndex: with a
+        plain dict, the match on a shorter code scans all the codes.
         """
         if not account_dict:
             account_dict = {}
@@ -766,6 +1500,7 @@ class BusinessDocumentImport(models.AbstractModel):
         if account_dict.get('code'):
             acc_code = account_dict['code'].upper()
             if acc_code in speed_dict:
+                self._trace_match_strategy('code')
                 return aao.browse(speed_dict[acc_code])
             # Match when account_dict['code'] is longer than Odoo's account
             # codes because of trailing '0'
@@ -774,15 +1509,25 @@ class BusinessDocumentImport(models.AbstractModel):
             while acc_code_tmp and acc_code_tmp[-1] == '0':
                 acc_code_tmp = acc_code_tmp[:-1]
                 if acc_code_tmp and acc_code_tmp in speed_dict:
+                    self._trace_match_strategy('code_trailing_zeros')
                     return aao.browse(speed_dict[acc_code_tmp])
             # Match when account_dict['code'] is shorter than Odoo's accounts
             # -> warns the user about this
-            for code, account_id in speed_dict.items():
-                if code.startswith(acc_code):
-                    chatter_msg.append(_(
-                        "Approximate match: account %s has been matched "
-                        "with account %s") % (account_dict['code'], code))
-                    return aao.browse(account_id)
+            if isinstance(speed_dict, CodeIndex):
+                prefix_match = speed_dict.prefix_match(acc_code)
+            else:
+                prefix_match = min((
+                    (code, account_id)
+                    for (code, account_id) in speed_dict.items()
+                    if code.startswith(acc_code)),
+                    key=lambda item: (len(item[0]), item[0]), default=None)
+            if prefix_match:
+                code, account_id = prefix_match
+                chatter_msg.append(_(
+                    "Approximate match: account %s has been matched "
+                    "with account %s") % (account_dict['code'], code))
+                self._trace_match_strategy('code_prefix')
+                return aao.browse(account_id)
         raise self.user_error_wrap(_(
             "Odoo couldn't find any account corresponding to the "
             "following information extracted from the business document: "
@@ -791,7 +1536,13 @@ class BusinessDocumentImport(models.AbstractModel):
     def _prepare_analytic_account_speed_dict(self):
         company_id = self._context.get('force_company') or\
             self.env.user.company_id.id
-        res = self.env['account.analytic.account'].search_read(
+        return self._get_analytic_account_speed_dict(company_id)
+
+    @api.model
+    @tools.ormcache(
+        "self._get_cache_version('analytic_account')", 'company_id')
+    def _get_analytic_account_speed_dict(self, company_id):
+        res = self.env['account.analytic.account'].sudo().search_read(
             [('company_id', '=', company_id)],
             ['code'])
         speed_dict = {}
@@ -801,6 +1552,7 @@ class BusinessDocumentImport(models.AbstractModel):
         return speed_dict
 
     @api.model
+    @match_trace('analytic_account')
     def _match_analytic_account(
             self, aaccount_dict, chatter_msg, speed_dict=None):
         """Example:
@@ -823,6 +1575,7 @@ class BusinessDocumentImport(models.AbstractModel):
         if aaccount_dict.get('code'):
             aacode = aaccount_dict['code'].upper()
             if aacode in speed_dict:
+                self._trace_match_strategy('code')
                 return aaao.browse(speed_dict[aacode])
         raise self.user_error_wrap(_(
             "Odoo couldn't find any analytic account corresponding to the "
@@ -832,7 +1585,12 @@ class BusinessDocumentImport(models.AbstractModel):
     def _prepare_journal_speed_dict(self):
         company_id = self._context.get('force_company') or\
             self.env.user.company_id.id
-        res = self.env['account.journal'].search_read([
+        return self._get_journal_speed_dict(company_id)
+
+    @api.model
+    @tools.ormcache("self._get_cache_version('journal')", 'company_id')
+    def _get_journal_speed_dict(self, company_id):
+        res = self.env['account.journal'].sudo().search_read([
             ('company_id', '=', company_id)], ['code'])
         speed_dict = {}
         for l in res:
@@ -840,6 +1598,7 @@ class BusinessDocumentImport(models.AbstractModel):
         return speed_dict
 
     @api.model
+    @match_trace('journal')
     def _match_journal(self, journal_dict, chatter_msg, speed_dict=None):
         """Example:
         journal_dict = {
@@ -861,6 +1620,7 @@ class BusinessDocumentImport(models.AbstractModel):
         if journal_dict.get('code'):
             jcode = journal_dict['code'].upper()
             if jcode in speed_dict:
+                self._trace_match_strategy('code')
                 return ajo.browse(speed_dict[jcode])
             # case insensitive
         raise self.user_error_wrap(_(
@@ -872,6 +1632,7 @@ class BusinessDocumentImport(models.AbstractModel):
     # Now that the incoterm obj (account.incoterms) is defined in
     # the 'account' module (since Odoo v12) instead of 'stock'
     @api.model
+    @match_trace('incoterm')
     def _match_incoterm(self, incoterm_dict, chatter_msg):
         aio = self.env['account.incoterms']
         if not incoterm_dict:
@@ -886,6 +1647,7 @@ class BusinessDocumentImport(models.AbstractModel):
                 ('name', '=ilike', incoterm_dict['code']),
                 ('code', '=ilike', incoterm_dict['code'])], limit=1)
             if incoterm:
+                self._trace_match_strategy('code')
                 return incoterm
             else:
                 self.user_error_wrap(_(
@@ -959,9 +1721,15 @@ class BusinessDocumentImport(models.AbstractModel):
 
     @api.model
     def post_create_or_update(self, parsed_dict, record, doc_filename=None):
+        self._store_match_memory(parsed_dict)
         if parsed_dict.get('attachments'):
             for filename, data_base64 in\
                     parsed_dict['attachments'].items():
+                # The parsers give the raw content of the file as a
+                # memoryview (to avoid copies of big files), but the values
+                # may also be base64-encoded
+                if isinstance(data_base64, memoryview):
+                    data_base64 = base64.b64encode(data_base64)
                 self.env['ir.attachment'].create({
                     'name': filename,
                     'res_id': record.id,
@@ -0,0 +1,38 @@
+# Copyright 2015-2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import api, fields, models
+
+
+class BusinessDocumentImportMemory(models.Model):
+    _name = 'business.document.import.memory'
+    _description = 'Partners and products matched upon document import'
+
+    match_type = fields.Selection([
+        ('partner', 'Partner'),
+        ('product', 'Product'),
+        ], required=True, readonly=True)
+    identity_hash = fields.Char(
+        required=True, readonly=True,
+        help="SHA-256 of the normalized identification data of the partner "
+        "or product written in the business document")
+    company_id = fields.Many2one(
+        'res.company', required=True, readonly=True, ondelete='cascade')
+    partner_id = fields.Many2one(
+        'res.partner', readonly=True, ondelete='cascade', index=True)
+    product_id = fields.Many2one(
+        'product.product', readonly=True, ondelete='cascade', index=True)
+
+    _sql_constraints = [(
+        'identity_company_uniq',
+        'unique(identity_hash, company_id, match_type)',
+        'This identity hash already exists in this company!')]
+
+    @api.model
+    def _purge(self, match_type, records):
+        """Called when partners or products are archived, or when the
+        identification data of partners are modified"""
+        self.sudo().search([
+            ('match_type', '=', match_type),
+            ('%s_id' % match_type, 'in', records.ids)]).unlink()
@@ -0,0 +1,17 @@
+# Copyright 2015-2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, api
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if 'active' in vals and not vals['active']:
+            self.env['business.document.import.memory']._purge(
+                'product', self)
+        return res
@@ -0,0 +1,64 @@
+# Copyright 2015-2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, api
+
+
+class ResCountry(models.Model):
+    _inherit = 'res.country'
+
+    @api.model
+    def _clear_country_id_cache(self):
+        self.env['business.document.import']._bump_cache_version('country')
+
+    # Invalidate business.document.import._get_country_id()
+    @api.model
+    def create(self, vals):
+        record = super().create(vals)
+        self._clear_country_id_cache()
+        return record
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if 'code' in vals:
+            self._clear_country_id_cache()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        # the states of the country are deleted with it
+        self._clear_country_id_cache()
+        self.env['res.country.state']._clear_country_state_id_cache()
+        return res
+
+
+class ResCountryState(models.Model):
+    _inherit = 'res.country.state'
+
+    @api.model
+    def _clear_country_state_id_cache(self):
+        self.env['business.document.import']._bump_cache_version(
+            'country_state')
+
+    # Invalidate business.document.import._get_country_state_id()
+    @api.model
+    def create(self, vals):
+        record = super().create(vals)
+        self._clear_country_state_id_cache()
+        return record
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if 'code' in vals or 'country_id' in vals:
+            self._clear_country_state_id_cache()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self._clear_country_state_id_cache()
+        return res
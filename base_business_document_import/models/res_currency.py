@@ -0,0 +1,34 @@
+# Copyright 2015-2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, api
+
+
+class ResCurrency(models.Model):
+    _inherit = 'res.currency'
+
+    @api.model
+    def _clear_currency_id_cache(self):
+        self.env['business.document.import']._bump_cache_version(
+            'currency')
+
+    # Invalidate business.document.import._get_currency_*()
+    @api.model
+    def create(self, vals):
+        record = super().create(vals)
+        self._clear_currency_id_cache()
+        return record
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if any(field in vals for field in ['name', 'symbol', 'active']):
+            self._clear_currency_id_cache()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self._clear_currency_id_cache()
+        return res
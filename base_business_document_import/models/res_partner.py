@@ -0,0 +1,99 @@
+# Copyright 2015-2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, fields, api
+from .business_document_import import get_email_domain, \
+    get_website_domain, normalize_email, normalize_partner_name, \
+    PARTNER_IDENTITY_COLUMNS
+
+# Fields read by business.document.import._get_partner_identity_index()
+PARTNER_IDENTITY_FIELDS = [
+    'vat', 'sanitized_vat', 'email', 'website', 'ref', 'name', 'supplier',
+    'customer', 'parent_id', 'country_id', 'state_id', 'company_id',
+    'active']
+# Fields of the partner matched by the strategies whose result is stored
+# in business.document.import.memory: when they change, the memory of
+# the partner may be wrong
+PARTNER_MEMORY_FIELDS = ['vat', 'email', 'ref', 'name', 'website']
+
+
+class ResPartner(models.Model):
+    _inherit = 'res.partner'
+
+    # Normalized identity keys used by _match_partner(): they are stored
+    # and indexed so that matching is an equality search on a B-tree index
+    # instead of an ilike search on the raw fields
+    import_email = fields.Char(
+        compute='_compute_import_identity_keys', store=True, index=True,
+        string='Normalized E-mail')
+    import_email_domain = fields.Char(
+        compute='_compute_import_identity_keys', store=True, index=True,
+        string='E-mail Domain')
+    import_website_domain = fields.Char(
+        compute='_compute_import_identity_keys', store=True, index=True,
+        string='Website Domain')
+    import_name_key = fields.Char(
+        compute='_compute_import_identity_keys', store=True, index=True,
+        string='Normalized Name')
+
+    @api.depends('email', 'website', 'name')
+    def _compute_import_identity_keys(self):
+        for partner in self:
+            email = normalize_email(partner.email)
+            partner.import_email = email
+            partner.import_email_domain = get_email_domain(email)
+            partner.import_website_domain = get_website_domain(
+                partner.website)
+            partner.import_name_key = normalize_partner_name(partner.name)
+
+    @api.multi
+    def _is_import_matchable(self):
+        """Return True if one of the partners can be matched by
+        business.document.import._match_partner(), i.e. has one of the
+        identity keys of the partner identity index. The other ones (for
+        example contacts without name, e-mail nor VAT number) are not
+        in the index, so they don't need to invalidate it."""
+        for partner in self:
+            if any(
+                    partner[column]
+                    for column in PARTNER_IDENTITY_COLUMNS.values()):
+                return True
+        return False
+
+    @api.model
+    def _clear_partner_identity_index(self):
+        self.env['business.document.import']._bump_cache_version(
+            'partner_identity')
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        partners = super().create(vals_list)
+        if partners._is_import_matchable():
+            self._clear_partner_identity_index()
+        return partners
+
+    @api.multi
+    def write(self, vals):
+        # a partner enters or leaves the index when its identity keys
+        # are modified: check before and after the write
+        identity_write = any(
+            field in vals for field in PARTNER_IDENTITY_FIELDS)
+        matchable = identity_write and self._is_import_matchable()
+        res = super().write(vals)
+        if identity_write and (matchable or self._is_import_matchable()):
+            self._clear_partner_identity_index()
+        if (
+                ('active' in vals and not vals['active']) or
+                any(field in vals for field in PARTNER_MEMORY_FIELDS)):
+            self.env['business.document.import.memory']._purge(
+                'partner', self)
+        return res
+
+    @api.multi
+    def unlink(self):
+        matchable = self._is_import_matchable()
+        res = super().unlink()
+        if matchable:
+            self._clear_partner_identity_index()
+        return res
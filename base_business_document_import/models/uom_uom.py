@@ -0,0 +1,33 @@
+# Copyright 2015-2019 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, api
+
+
+class UomUom(models.Model):
+    _inherit = 'uom.uom'
+
+    @api.model
+    def _clear_uom_id_cache(self):
+        self.env['business.document.import']._bump_cache_version('uom')
+
+    # Invalidate business.document.import._get_uom_id()
+    @api.model
+    def create(self, vals):
+        record = super().create(vals)
+        self._clear_uom_id_cache()
+        return record
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if 'unece_code' in vals or 'active' in vals:
+            self._clear_uom_id_cache()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self._clear_uom_id_cache()
+        return res
@@ -4,6 +4,9 @@
 
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import UserError
+from odoo.addons.base_business_document_import.models.\
+    business_document_import import normalize_email, normalize_partner_name
+import base64
 
 
 class TestBaseBusinessDocumentImport(TransactionCase):
@@ -31,6 +34,147 @@ class TestBaseBusinessDocumentImport(TransactionCase):
         res = bdio._match_partner(partner_dict, [], partner_type=False)
         self.assertEqual(res, partner1)
 
+    def test_match_partner_index_invalidation(self):
+        bdio = self.env['business.document.import']
+        partner1 = self.env['res.partner'].create({
+            'name': 'Akretion Lyon',
+            'supplier': True,
+            'email': 'contact@akretion.com',
+        })
+        partner_dict = {'email': 'Contact@Akretion.com'}
+        res = bdio._match_partner(partner_dict, [], partner_type='supplier')
+        self.assertEqual(res, partner1)
+        # only the writes on the identity fields bump the version of the
+        # index, and the other caches are kept
+        fr_id = bdio._get_country_id('FR')
+        version = bdio._get_cache_version('partner_identity')
+        partner1.write({'comment': 'Not an identity field'})
+        self.assertEqual(
+            bdio._get_cache_version('partner_identity'), version)
+        partner1.write({'email': 'lyon@akretion.com'})
+        self.assertGreater(
+            bdio._get_cache_version('partner_identity'), version)
+        sql_log_count = self.cr.sql_log_count
+        self.assertEqual(bdio._get_country_id('FR'), fr_id)
+        self.assertEqual(self.cr.sql_log_count, sql_log_count)
+        partner_dict = {'email': 'lyon@akretion.com'}
+        res = bdio._match_partner(partner_dict, [], partner_type='supplier')
+        self.assertEqual(res, partner1)
+        partner1.write({'supplier': False})
+        with self.assertRaises(UserError):
+            bdio._match_partner(
+                {'email': 'lyon@akretion.com'}, [], partner_type='supplier')
+
+    def test_match_partner_sql(self):
+        # without in-memory index, the partners are matched by searching
+        # the normalized identity columns
+        self.env['ir.config_parameter'].sudo().set_param(
+            'business_document_import.partner_index_max_size', '0')
+        self.env['business.document.import'].clear_caches()
+        bdio = self.env['business.document.import']
+        partner1 = self.env['res.partner'].create({
+            'name': ' Akretion  SQL ',
+            'supplier': True,
+            'customer': False,
+            'email': ' Contact@Akretion-SQL.com',
+            'website': 'https://www.akretion-sql.com/fr',
+        })
+        self.assertEqual(partner1.import_email, 'contact@akretion-sql.com')
+        self.assertEqual(partner1.import_email_domain, 'akretion-sql.com')
+        self.assertEqual(partner1.import_website_domain, 'akretion-sql.com')
+        self.assertEqual(partner1.import_name_key, 'akretion  sql')
+        # the probe normalizes the value like the stored columns
+        index = bdio._get_partner_identity_index(
+            self.env.user.company_id.id)
+        self.assertEqual(bdio._probe_partner_identity_index(
+            index, 'email', normalize_email(' CONTACT@akretion-sql.com ')),
+            partner1)
+        self.assertEqual(bdio._probe_partner_identity_index(
+            index, 'name', normalize_partner_name('AKRETION  SQL ')),
+            partner1)
+        res = bdio._match_partner(
+            {'email': 'CONTACT@akretion-sql.com'}, [])
+        self.assertEqual(res, partner1)
+        res = bdio._match_partner(
+            {'website': 'akretion-sql.com'}, [])
+        self.assertEqual(res, partner1)
+        res = bdio._match_partner({'name': 'AKRETION  SQL'}, [])
+        self.assertEqual(res, partner1)
+        with self.assertRaises(UserError):
+            bdio._match_partner(
+                {'name': 'AKRETION  SQL'}, [], partner_type='customer')
+
+    def test_match_partner_memory(self):
+        bdio = self.env['business.document.import']
+        partner1 = self.env['res.partner'].create({
+            'name': 'Akretion Memory',
+            'supplier': True,
+            'ref': 'AKMEM',
+        })
+        parsed_dict = {
+            'partner': {'ref': 'AKMEM', 'name': 'Akretion  memory'},
+            'chatter_msg': [],
+        }
+        res = bdio._match_partner(parsed_dict['partner'], [])
+        self.assertEqual(res, partner1)
+        bdio._store_match_memory(parsed_dict)
+        memory_key = parsed_dict['partner']['match_memory'][1]
+        self.assertEqual(bdio._get_match_memory('partner', memory_key), res)
+        # the memory is purged when the identification data of the
+        # partner are modified
+        partner1.write({'ref': 'AKMEM2'})
+        self.assertFalse(bdio._get_match_memory('partner', memory_key))
+        # the matches of the weak strategies (here: the name) are not
+        # remembered
+        partner_dict = {'ref': 'AKMEM ', 'name': 'AKRETION memory'}
+        self.assertEqual(bdio._match_partner(partner_dict, []), partner1)
+        self.assertNotIn('match_memory', partner_dict)
+        partner1.write({'ref': 'AKMEM'})
+        parsed_dict['partner'] = {'ref': 'AKMEM', 'name': 'Akretion  memory'}
+        bdio._match_partner(parsed_dict['partner'], [])
+        bdio._store_match_memory(parsed_dict)
+        # the remembered partner must still be a supplier
+        partner1.write({'supplier': False})
+        with self.assertRaises(UserError):
+            bdio._match_partner(
+                {'ref': 'AKMEM', 'name': 'Akretion memory'}, [])
+        partner1.write({'supplier': True})
+        # storing the same memory again doesn't fail
+        bdio._store_match_memory(parsed_dict)
+        self.assertEqual(
+            bdio._get_match_memory('partner', memory_key, 'supplier'), res)
+        # the memory is purged when the partner is archived
+        partner1.write({'active': False})
+        self.assertFalse(bdio._get_match_memory('partner', memory_key))
+        self.assertFalse(self.env['business.document.import.memory'].search(
+            [('identity_hash', '=', memory_key)]))
+
+    def test_match_trace(self):
+        partner1 = self.env['res.partner'].create({
+            'name': 'Akretion Trace',
+            'supplier': True,
+            'ref': 'AKTRACE',
+        })
+        trace = []
+        bdio = self.env['business.document.import'].with_context(
+            business_document_import_match_trace=trace)
+        res = bdio._match_partner({'ref': 'AKTRACE'}, [])
+        self.assertEqual(res, partner1)
+        bdio._match_partner({'recordset': partner1}, [])
+        with self.assertRaises(UserError):
+            bdio._match_partner({'ref': 'AKTRACE-UNKNOWN'}, [])
+        self.assertEqual(len(trace), 3)
+        self.assertEqual(trace[0]['entity'], 'partner')
+        self.assertEqual(trace[0]['strategy'], 'ref')
+        self.assertEqual(trace[0]['input'], {'ref': 'AKTRACE'})
+        self.assertEqual(trace[0]['res_ids'], [partner1.id])
+        self.assertEqual(trace[1]['strategy'], 'recordset')
+        self.assertFalse(trace[2]['strategy'])
+        self.assertTrue(trace[2]['error'])
+        for entry in trace:
+            self.assertTrue(entry['queries'] >= 0)
+            self.assertTrue(entry['duration'] >= 0)
+
     def test_match_shipping_partner(self):
         rpo = self.env['res.partner']
         bdio = self.env['business.document.import']
@@ -149,6 +293,125 @@ class TestBaseBusinessDocumentImport(TransactionCase):
             pass
         self.assertTrue(raise_test)
 
+    def test_resolve_parsed_document(self):
+        bdio = self.env['business.document.import']
+        product1 = self.env['product.product'].create({
+            'name': 'Test Product Bulk',
+            'barcode': '9782203121119',
+            'default_code': 'BULK1242',
+        })
+        tax_dict = {
+            'amount_type': 'percent',
+            'amount': 1242.0,  # doesn't exist
+            'unece_type_code': 'VAT',
+        }
+        parsed_doc = {
+            'chatter_msg': [],
+            'lines': [{
+                'product': {'barcode': '9782203121119'},
+                'uom': {'unece_code': 'NIU'},
+                'taxes': [tax_dict],
+            }, {
+                'product': {'code': 'BULK1242'},
+                'uom': {'unece_code': 'KGM'},
+                'taxes': [tax_dict],
+            }, {
+                'product': {'code': 'UNKNOWN-1242'},
+                'taxes': [tax_dict],
+            }],
+        }
+        bdio.resolve_parsed_document(parsed_doc)
+        lines = parsed_doc['lines']
+        self.assertEqual(lines[0]['product']['recordset'], product1)
+        self.assertEqual(lines[1]['product']['recordset'], product1)
+        self.assertNotIn('recordset', lines[2]['product'])
+        self.assertEqual(
+            lines[0]['uom']['recordset'],
+            self.env.ref('uom.product_uom_unit'))
+        self.assertEqual(
+            lines[1]['uom']['recordset'],
+            self.env.ref('uom.product_uom_kgm'))
+        self.assertNotIn('recordset', tax_dict)
+        with self.assertRaises(UserError):
+            bdio._match_product(lines[2]['product'], [])
+
+    def test_resolve_parsed_document_query_count(self):
+        bdio = self.env['business.document.import']
+        # on purpose, I use a rate that doesn't exist
+        tax = self.env['account.tax'].create({
+            'name': 'Bulk VAT purchase 18.0%',
+            'type_tax_use': 'purchase',
+            'amount': 18,
+            'amount_type': 'percent',
+            'unece_type_id': self.env.ref('account_tax_unece.tax_type_vat').id,
+        })
+        products = [self.env['product.product'].create({
+            'name': 'Test Product Bulk %d' % i,
+            'default_code': 'BULKQC%d' % i,
+            }) for i in range(20)]
+
+        def get_parsed_doc(nb_lines):
+            return {'lines': [{
+                'product': {'code': 'BULKQC%d' % i},
+                'uom': {'unece_code': 'C62'},
+                'taxes': [{
+                    'amount_type': 'percent',
+                    'amount': 18.0,
+                    'unece_type_code': 'VAT',
+                    }],
+                } for i in range(nb_lines)]}
+
+        def resolve_query_count(parsed_doc):
+            self.env.invalidate_all()
+            sql_log_count = self.cr.sql_log_count
+            bdio.resolve_parsed_document(parsed_doc)
+            return self.cr.sql_log_count - sql_log_count
+
+        # fill the caches of the reference data
+        bdio.resolve_parsed_document(get_parsed_doc(1))
+        small_doc = get_parsed_doc(2)
+        big_doc = get_parsed_doc(20)
+        self.assertEqual(
+            resolve_query_count(small_doc), resolve_query_count(big_doc))
+        unit = self.env.ref('uom.product_uom_unit')
+        for product, line in zip(products, big_doc['lines']):
+            self.assertEqual(line['product']['recordset'], product)
+            self.assertEqual(line['uom']['recordset'], unit)
+            self.assertEqual(line['taxes'][0]['recordset'], tax)
+
+    def test_compare_lines(self):
+        bdio = self.env['business.document.import']
+        unit = self.env.ref('uom.product_uom_unit')
+        product1 = self.env.ref('product.product_product_1')
+        product2 = self.env.ref('product.product_product_2')
+        product1.default_code = 'CMP-1'
+        product2.default_code = 'CMP-2'
+        # compare_lines() only needs recordsets for the 'line' key
+        line1, line2, line3 = [self.env['res.partner'].create({
+            'name': 'Line %d' % i}) for i in range(3)]
+        existing_lines = [
+            {'product': product1, 'uom': unit, 'qty': 1, 'price_unit': 10,
+             'line': line1},
+            {'product': product1, 'uom': unit, 'qty': 2, 'price_unit': 10,
+             'line': line2},
+            {'product': product2, 'uom': unit, 'qty': 3, 'price_unit': 5,
+             'line': line3},
+        ]
+        import_lines = [
+            {'product': {'code': 'CMP-1'}, 'uom': {'unece_code': 'C62'},
+             'qty': 1, 'price_unit': 10},
+            {'product': {'code': 'CMP-1'}, 'uom': {'unece_code': 'C62'},
+             'qty': 4, 'price_unit': 10},
+            {'product': {'code': 'CMP-1'}, 'uom': {'unece_code': 'C62'},
+             'qty': 5, 'price_unit': 11},
+        ]
+        res = bdio.compare_lines(existing_lines, import_lines, [])
+        self.assertEqual(res['to_update'], {line1: {}, line2: {'qty': [2, 4]}})
+        self.assertEqual(len(res['to_add']), 1)
+        self.assertEqual(res['to_add'][0]['product'], product1)
+        self.assertEqual(res['to_add'][0]['import_line']['qty'], 5)
+        self.assertEqual(res['to_remove'], line3)
+
     def test_match_uom(self):
         bdio = self.env['business.document.import']
         uom_dict = {'unece_code': 'KGM'}
@@ -168,6 +431,69 @@ class TestBaseBusinessDocumentImport(TransactionCase):
         res = bdio._match_uom(uom_dict, [], product=product)
         self.assertEqual(res, product.uom_id)
 
+    def test_reference_data_cache(self):
+        bdio = self.env['business.document.import']
+        fr_id = self.env.ref('base.fr').id
+        self.assertEqual(bdio._get_country_id('FR'), fr_id)
+        # a cache hit doesn't hit the database
+        sql_log_count = self.cr.sql_log_count
+        self.assertEqual(bdio._get_country_id('FR'), fr_id)
+        self.assertEqual(bdio._get_country_id('FR'), fr_id)
+        self.assertEqual(self.cr.sql_log_count, sql_log_count)
+        # the cache is invalidated when a key field changes
+        self.assertFalse(bdio._get_country_id('XZ'))
+        country = self.env['res.country'].create({
+            'name': 'Test Country XZ',
+            'code': 'XZ',
+        })
+        self.assertEqual(bdio._get_country_id('XZ'), country.id)
+        self.assertFalse(bdio._get_country_state_id(country.id, 'XZ1'))
+        state = self.env['res.country.state'].create({
+            'name': 'Test State XZ1',
+            'code': 'XZ1',
+            'country_id': country.id,
+        })
+        self.assertEqual(
+            bdio._get_country_state_id(country.id, 'XZ1'), state.id)
+        state.code = 'XZ2'
+        self.assertFalse(bdio._get_country_state_id(country.id, 'XZ1'))
+        country.code = 'XY'
+        self.assertFalse(bdio._get_country_id('XZ'))
+        self.assertEqual(bdio._get_country_id('XY'), country.id)
+        self.assertFalse(bdio._get_currency_id('XZZ'))
+        self.assertFalse(bdio._get_currency_ids_by_symbol('XZ$'))
+        currency = self.env['res.currency'].create({
+            'name': 'XZZ',
+            'symbol': 'XZ$',
+        })
+        self.assertEqual(bdio._get_currency_id('XZZ'), currency.id)
+        self.assertEqual(
+            bdio._get_currency_ids_by_symbol('XZ$'), (currency.id, ))
+        self.assertEqual(
+            bdio._get_currency_ids_by_iso_or_symbol('xzz'), (currency.id, ))
+        currency.active = False
+        self.assertFalse(bdio._get_currency_id('XZZ'))
+        self.assertFalse(bdio._get_currency_ids_by_symbol('XZ$'))
+        self.assertFalse(bdio._get_currency_ids_by_iso_or_symbol('xzz'))
+        self.assertFalse(bdio._get_uom_id('XZU'))
+        uom = self.env['uom.uom'].create({
+            'name': 'Test UoM XZU',
+            'category_id': self.env.ref('uom.product_uom_categ_unit').id,
+            'uom_type': 'bigger',
+            'factor_inv': 1242,
+            'unece_code': 'XZU',
+        })
+        self.assertEqual(bdio._get_uom_id('XZU'), uom.id)
+        uom.unece_code = 'XZV'
+        self.assertFalse(bdio._get_uom_id('XZU'))
+        self.assertEqual(bdio._get_uom_id('XZV'), uom.id)
+        # the caches of the other models are kept
+        self.assertEqual(bdio._get_country_id('FR'), fr_id)
+        uom.unece_code = 'XZW'
+        sql_log_count = self.cr.sql_log_count
+        self.assertEqual(bdio._get_country_id('FR'), fr_id)
+        self.assertEqual(self.cr.sql_log_count, sql_log_count)
+
     def test_match_tax(self):
         # on purpose, I use a rate that doesn't exist
         # so that this test works even if the l10n_de is installed
@@ -209,6 +535,60 @@ class TestBaseBusinessDocumentImport(TransactionCase):
         res = bdio._match_taxes([tax_dict], [], type_tax_use='purchase')
         self.assertEqual(res, de_tax_21)
 
+    def test_match_tax_rate(self):
+        bdio = self.env['business.document.import']
+        # on purpose, I use a rate that doesn't exist
+        tax = self.env['account.tax'].create({
+            'name': 'Rate VAT purchase 18.5%',
+            'type_tax_use': 'purchase',
+            'price_include': False,
+            'amount': 18.5,
+            'amount_type': 'percent',
+        })
+        tax_ttc = self.env['account.tax'].create({
+            'name': 'Rate VAT purchase 18.5% TTC',
+            'type_tax_use': 'purchase',
+            'price_include': True,
+            'amount': 18.5,
+            'amount_type': 'percent',
+        })
+        # hit
+        res = bdio._match_tax(
+            {'amount_type': 'percent', 'amount': 18.5}, [],
+            type_tax_use='purchase')
+        self.assertEqual(res, tax)
+        res = bdio._match_tax(
+            {'amount_type': 'percent', 'amount': 18.5}, [],
+            type_tax_use='purchase', price_include=True)
+        self.assertEqual(res, tax_ttc)
+        # miss
+        with self.assertRaises(UserError):
+            bdio._match_tax(
+                {'amount_type': 'percent', 'amount': 18.6}, [],
+                type_tax_use='purchase')
+        with self.assertRaises(UserError):
+            bdio._match_tax(
+                {'amount_type': 'fixed', 'amount': 18.5}, [],
+                type_tax_use='purchase')
+        # same result as float_compare(precision_digits=4) at the rounding
+        # boundaries
+        res = bdio._match_tax(
+            {'amount_type': 'percent', 'amount': 18.49995}, [],
+            type_tax_use='purchase')
+        self.assertEqual(res, tax)
+        res = bdio._match_tax(
+            {'amount_type': 'percent', 'amount': 18.50004}, [],
+            type_tax_use='purchase')
+        self.assertEqual(res, tax)
+        with self.assertRaises(UserError):
+            bdio._match_tax(
+                {'amount_type': 'percent', 'amount': 18.49994}, [],
+                type_tax_use='purchase')
+        with self.assertRaises(UserError):
+            bdio._match_tax(
+                {'amount_type': 'percent', 'amount': 18.50005}, [],
+                type_tax_use='purchase')
+
     def test_match_account_exact(self):
         bdio = self.env['business.document.import']
         acc = self.env['account.account'].create({
@@ -243,3 +623,85 @@ class TestBaseBusinessDocumentImport(TransactionCase):
         res = bdio._match_account({'code': '898999'}, chatter)
         self.assertEqual(acc, res)
         self.assertEqual(len(chatter), 1)
+
+    def test_match_account_smaller_in_shortest(self):
+        bdio = self.env['business.document.import']
+        acc_type_id = self.env.ref('account.data_account_type_expenses').id
+        for code in ['89899700', '8989971', '898997100']:
+            acc = self.env['account.account'].create({
+                'name': 'Test %s' % code,
+                'code': code,
+                'user_type_id': acc_type_id,
+            })
+            if code == '8989971':
+                shortest_acc = acc
+        chatter = []
+        res = bdio._match_account({'code': '898997'}, chatter)
+        self.assertEqual(res, shortest_acc)
+        self.assertEqual(len(chatter), 1)
+        # also works with a plain dict as speed_dict
+        speed_dict = dict(bdio._prepare_account_speed_dict())
+        res = bdio._match_account({'code': '898997'}, [], speed_dict)
+        self.assertEqual(res, shortest_acc)
+
+    def test_speed_dict_invalidation(self):
+        bdio = self.env['business.document.import']
+        # fill the caches of the speed dicts
+        with self.assertRaises(UserError):
+            bdio._match_account({'code': '898996'}, [])
+        with self.assertRaises(UserError):
+            bdio._match_analytic_account({'code': 'AA8996'}, [])
+        with self.assertRaises(UserError):
+            bdio._match_journal({'code': 'JX896'}, [])
+        # new records
+        acc = self.env['account.account'].create({
+            'name': 'Test 898996',
+            'code': '898996',
+            'user_type_id':
+            self.env.ref('account.data_account_type_expenses').id,
+        })
+        aacc = self.env['account.analytic.account'].create({
+            'name': 'Test AA8996',
+            'code': 'AA8996',
+        })
+        journal = self.env['account.journal'].create({
+            'name': 'Test JX896',
+            'code': 'JX896',
+            'type': 'general',
+        })
+        self.assertEqual(bdio._match_account({'code': '898996'}, []), acc)
+        self.assertEqual(
+            bdio._match_analytic_account({'code': 'AA8996'}, []), aacc)
+        self.assertEqual(bdio._match_journal({'code': 'JX896'}, []), journal)
+        # renamed records
+        acc.code = '898995'
+        aacc.code = 'AA8995'
+        journal.code = 'JX895'
+        self.assertEqual(bdio._match_account({'code': '898995'}, []), acc)
+        self.assertEqual(
+            bdio._match_analytic_account({'code': 'AA8995'}, []), aacc)
+        self.assertEqual(bdio._match_journal({'code': 'JX895'}, []), journal)
+        with self.assertRaises(UserError):
+            bdio._match_account({'code': '898996'}, [])
+        with self.assertRaises(UserError):
+            bdio._match_analytic_account({'code': 'AA8996'}, [])
+        with self.assertRaises(UserError):
+            bdio._match_journal({'code': 'JX896'}, [])
+
+    def test_post_create_or_update_attachments(self):
+        bdio = self.env['business.document.import']
+        partner = self.env['res.partner'].create({'name': 'Attachment Test'})
+        parsed_dict = {
+            'attachments': {
+                'raw.txt': memoryview(b'raw content'),
+                'b64.txt': base64.b64encode(b'base64 content'),
+            },
+            'chatter_msg': [],
+        }
+        bdio.post_create_or_update(parsed_dict, partner)
+        attachments = self.env['ir.attachment'].search([
+            ('res_model', '=', 'res.partner'), ('res_id', '=', partner.id)])
+        self.assertEqual(
+            dict((att.name, base64.b64decode(att.datas))
+                 for att in attachments),
+            {'raw.txt': b'raw content', 'b64.txt': b'base64 content'})